@@ -1,39 +1,175 @@
+"""
+SageMaker 训练任务入口：以子进程方式监督 torchrun
+
+- SM_HOSTS 按 JSON 解析；默认 --nnodes=N_NODES（非弹性）。显式设置 MIN_NODES < N_NODES 时使用弹性的
+  --nnodes=MIN:MAX，凑齐 MIN_NODES 个节点后最多再等 last_call_timeout 秒即开始训练；
+- --max-restarts：worker 失败（包括节点掉线）后 torchrun 重新 rendezvous 并拉起，无需重新提交任务；
+- 限制：c10d rendezvous 服务固定在 hosts[0]，第一个节点掉线时其余节点无法重新 rendezvous，整个任务失败；
+  train_ddp.py 不保存 / 恢复 checkpoint，每次重新拉起（包括弹性模式下迟到节点加入触发的重新 rendezvous）
+  都从第 0 步重新训练。因此弹性和 --max-restarts 只适合能接受重跑的短任务，启用时会打印警告；
+- SIGTERM / SIGINT（Spot 回收、任务停止）转发给 torchrun，由它通知各 worker，超时后强制结束；
+- 子进程输出逐行加上主机名前缀实时转发；
+- 记录从启动到 rendezvous 完成、到第一个训练步完成的耗时。
+
+环境变量（均可用同名小写命令行参数覆盖）：
+    SM_HOSTS, SM_CURRENT_HOST, N_NODES, NPROC_PER_NODE, BASE_JOB_NAME, SM_PATH, HYP_PARAMS,
+    MIN_NODES（默认 N_NODES）, MAX_RESTARTS（默认 0）
+"""
+
 import os
 import sys
-import uuid
+import json
+import time
+import shlex
+import signal
+import argparse
+import threading
+import subprocess
+
+RDZV_PORT = 7777
+
+# 出现在输出中即视为 rendezvous 完成（torchrun 的日志或训练脚本 init_process_group 之后的输出）
+RDZV_MARKERS = ("Rendezvous complete", "Initialized DDP")
+# train_ddp.py 在第一个优化步完成后输出
+FIRST_STEP_MARKER = "First step completed"
+
+# 转发 SIGTERM 后等待 torchrun 退出的时间，之后 SIGKILL
+TERMINATE_GRACE_SECONDS = 60
+
+
+def parse_hosts(value):
+    """SM_HOSTS 是 JSON 数组，例如 ["algo-1","algo-2"]"""
+    hosts = json.loads(value)
+    if not isinstance(hosts, list) or not hosts:
+        raise ValueError(f"SM_HOSTS 格式错误: {value!r}")
+    return hosts
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Supervised torchrun launcher")
+    parser.add_argument("--min-nodes", type=int, default=int(os.environ.get("MIN_NODES", 0)) or None,
+                        help="开始训练所需的最少节点数，默认等于 N_NODES（非弹性）。小于 N_NODES 时迟到节点加入会触发"
+                             "重新 rendezvous，训练从第 0 步重新开始")
+    parser.add_argument("--max-restarts", type=int, default=int(os.environ.get("MAX_RESTARTS", 0)),
+                        help="失败后重新拉起的次数，默认 0。重新拉起后训练从第 0 步开始；hosts[0] 掉线时无法恢复")
+    parser.add_argument("--join-timeout", type=int, default=600, help="等待凑齐 min-nodes 的超时，秒")
+    parser.add_argument("--last-call-timeout", type=int, default=30,
+                        help="凑齐 min-nodes 后继续等待其余节点加入的时间，秒")
+    parser.add_argument("--script", default=None, help="训练脚本，默认 $SM_PATH/codes/train_ddp.py")
+    # SageMaker 可能追加 hyperparameters，这里忽略未知参数
+    args, _ = parser.parse_known_args()
+    return args
+
+
+def warn_restart_limitations(args, hosts, num_nodes, prefix):
+    """弹性 / 自动重启依赖的前提在这个 sample 中不成立的地方，启用时明确告知"""
+    if args.min_nodes and args.min_nodes < num_nodes:
+        print(f"[{prefix}] ⚠️ 弹性模式 --nnodes={args.min_nodes}:{num_nodes}：迟到节点加入会重新 rendezvous，"
+              f"train_ddp.py 没有 checkpoint，训练将从第 0 步重新开始", flush=True)
+    if args.max_restarts > 0:
+        print(f"[{prefix}] ⚠️ --max-restarts={args.max_restarts}：重新拉起后训练从第 0 步开始；"
+              f"rendezvous 服务在 {hosts[0]} 上，该节点掉线时无法重启", flush=True)
+
+
+def build_torchrun_cmd(args, hosts, num_nodes, num_gpus, base_job, script, hyp_params):
+    min_nodes = min(args.min_nodes or num_nodes, num_nodes)
+    nnodes = f"{min_nodes}:{num_nodes}" if min_nodes < num_nodes else str(num_nodes)
+    return [
+        "torchrun",
+        f"--nnodes={nnodes}",
+        f"--nproc_per_node={num_gpus}",
+        f"--max-restarts={args.max_restarts}",
+        f"--rdzv_id={base_job}",
+        "--rdzv_backend=c10d",
+        f"--rdzv_endpoint={hosts[0]}:{RDZV_PORT}",
+        f"--rdzv_conf=join_timeout={args.join_timeout},last_call_timeout={args.last_call_timeout}",
+        script,
+        *shlex.split(hyp_params),
+    ]
+
+
+class TorchrunSupervisor:
+    """启动 torchrun 子进程，转发信号、带前缀转发输出并记录启动阶段耗时"""
+
+    def __init__(self, cmd, prefix):
+        self.cmd = cmd
+        self.prefix = prefix
+        self.proc = None
+        self.start_time = None
+        self.rdzv_latency = None
+        self.first_step_latency = None
+        self._terminating = False
+
+    def _log(self, message):
+        print(f"[{self.prefix}] {message}", flush=True)
+
+    def _forward_signal(self, signum, frame):
+        if self.proc is None or self.proc.poll() is not None:
+            return
+        self._log(f"收到 {signal.Signals(signum).name}，转发给 torchrun")
+        self.proc.send_signal(signal.SIGTERM)
+        if not self._terminating:
+            self._terminating = True
+            threading.Thread(target=self._kill_after_grace, daemon=True).start()
+
+    def _kill_after_grace(self):
+        try:
+            self.proc.wait(timeout=TERMINATE_GRACE_SECONDS)
+        except subprocess.TimeoutExpired:
+            self._log(f"torchrun {TERMINATE_GRACE_SECONDS}s 内未退出，强制结束")
+            self.proc.kill()
+
+    def _observe(self, line):
+        elapsed = time.time() - self.start_time
+        if self.rdzv_latency is None and any(marker in line for marker in RDZV_MARKERS):
+            self.rdzv_latency = elapsed
+            self._log(f"⏱️ rendezvous 完成: {elapsed:.1f}s")
+        if self.first_step_latency is None and FIRST_STEP_MARKER in line:
+            self.first_step_latency = elapsed
+            self._log(f"⏱️ 第一个训练步完成: {elapsed:.1f}s")
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._forward_signal)
+        signal.signal(signal.SIGINT, self._forward_signal)
+
+        env = dict(os.environ, PYTHONUNBUFFERED="1")
+        self._log(f"Executing: {shlex.join(self.cmd)}")
+        self.start_time = time.time()
+        self.proc = subprocess.Popen(self.cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                     env=env, text=True, bufsize=1, errors="replace")
+        for line in self.proc.stdout:
+            line = line.rstrip("\n")
+            self._observe(line)
+            print(f"[{self.prefix}] {line}", flush=True)
+        returncode = self.proc.wait()
+
+        summary = {
+            "exit_code": returncode,
+            "rendezvous_latency_s": self.rdzv_latency,
+            "first_step_latency_s": self.first_step_latency,
+            "total_s": round(time.time() - self.start_time, 1),
+        }
+        self._log(f"📊 {json.dumps(summary)}")
+        # 被信号结束时返回码为负数，按 shell 惯例转换为 128 + signum
+        return 128 - returncode if returncode < 0 else returncode
+
 
 def main():
+    args = parse_args()
 
-    hosts = eval(os.environ['SM_HOSTS'])
+    hosts = parse_hosts(os.environ['SM_HOSTS'])
     current_host = os.environ['SM_CURRENT_HOST']
     num_nodes = int(os.environ['N_NODES'])
     num_gpus = int(os.environ['NPROC_PER_NODE'])
-    rank = hosts.index(current_host)
     base_job = os.environ['BASE_JOB_NAME']
     base_path = os.environ['SM_PATH']
-    
-    # job_uuid = str(uuid.uuid4())[-4:]
-    # job_name = f"{base_job}-{job_uuid}"
-    
-    hyp_params = os.environ['HYP_PARAMS']
-    hostaddr = hosts[0]
-    
-    # print("=== Distributed Training Setup ===")
-    # print(f"MASTER_ADDR: {master_addr}")
-    # print(f"MASTER_PORT: {master_port}")
-    # print(f"WORLD_SIZE: {world_size}")
-    # print(f"CURRENT_HOST: {current_host}")
-    # print(f"ALL_HOSTS: {hosts}")
-    # print("===================================")
-    
-    # 构建torchrun命令，使用带UUID的job_name
-    # args = " ".join(sys.argv[1:])
-    cmd = f"torchrun --nnodes={num_nodes} --nproc_per_node={num_gpus} --rdzv_id={base_job} --rdzv_backend=c10d --rdzv_endpoint={hostaddr}:7777 {base_path}/codes/train_ddp.py {hyp_params}"
-    print(f"Executing: {cmd}")
-    
-    # 执行torchrun
-    exit_code = os.system(cmd)
-    sys.exit(exit_code >> 8)  # os.system返回的是shifted exit code
+    hyp_params = os.environ.get('HYP_PARAMS', '')
+
+    script = args.script or f"{base_path}/codes/train_ddp.py"
+    cmd = build_torchrun_cmd(args, hosts, num_nodes, num_gpus, base_job, script, hyp_params)
+    warn_restart_limitations(args, hosts, num_nodes, prefix=current_host)
+    sys.exit(TorchrunSupervisor(cmd, prefix=current_host).run())
+
 
 if __name__ == '__main__':
     main()
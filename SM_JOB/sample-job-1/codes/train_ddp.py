@@ -1,15 +1,23 @@
 import os
+import time
+import contextlib
 import torch
 import torch.nn as nn
 import torch.distributed as dist
 from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks, powerSGD_hook
 from torch.utils.data import DataLoader, DistributedSampler
 from torchvision import datasets, transforms
 import argparse
 
-def setup_ddp():
+MNIST_MEAN, MNIST_STD = 0.1307, 0.3081
+CACHE_NAME = 'mnist_train_normalized.pt'
+
+def setup_ddp(backend='gloo'):
     # torchrun会自动设置这些环境变量
-    dist.init_process_group(backend='gloo')
+    if backend == 'nccl':
+        torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', 0)))
+    dist.init_process_group(backend=backend)
     
     rank = dist.get_rank()
     world_size = dist.get_world_size()
@@ -34,46 +42,196 @@ class SimpleModel(nn.Module):
         x = torch.relu(self.fc1(x))
         return self.fc2(x)
 
+def load_mnist_tensors(data_dir, cache_dirs):
+    """返回已归一化的 (images[N,1,28,28] float32, targets[N] int64)
+
+    依次查找 cache_dirs 中的缓存（torch.load mmap 打开，不复制到内存）；都没有时下载 MNIST，
+    一次性解码、归一化后写入 data_dir 下的缓存。调用方保证每个节点只有 local rank 0 先执行。
+    """
+    for cache_dir in cache_dirs:
+        path = os.path.join(cache_dir, CACHE_NAME)
+        if os.path.exists(path):
+            cache = torch.load(path, mmap=True)
+            return cache['images'], cache['targets']
+    
+    raw = datasets.MNIST(data_dir, train=True, download=True)
+    images = ((raw.data.float() / 255.0 - MNIST_MEAN) / MNIST_STD).unsqueeze(1).contiguous()
+    targets = raw.targets.clone()
+    torch.save({'images': images, 'targets': targets}, os.path.join(data_dir, CACHE_NAME))
+    print(f"Cached normalized MNIST {tuple(images.shape)} to {os.path.join(data_dir, CACHE_NAME)}")
+    return images, targets
+
+class TensorBatchLoader:
+    """按 DistributedSampler 给出的本 rank 索引，直接对整块张量做索引切片得到 batch"""
+    
+    def __init__(self, images, targets, sampler, batch_size):
+        self.images = images
+        self.targets = targets
+        self.sampler = sampler
+        self.batch_size = batch_size
+    
+    def __len__(self):
+        return (len(self.sampler) + self.batch_size - 1) // self.batch_size
+    
+    def __iter__(self):
+        indices = torch.tensor(list(self.sampler), dtype=torch.long)
+        for batch in indices.split(self.batch_size):
+            yield self.images[batch], self.targets[batch]
+
+def mnist_cache_dirs(args):
+    # SM_PATH 是只读的输入通道，预先上传的缓存放在 <SM_PATH>/cache/ 下即可跳过下载
+    cache_dirs = [args.data_dir]
+    if os.environ.get('SM_PATH'):
+        cache_dirs.insert(0, os.path.join(os.environ['SM_PATH'], 'cache'))
+    return cache_dirs
+
+def build_dataloader(args, rank, world_size):
+    if args.data_mode == 'torchvision':
+        transform = transforms.Compose([
+            transforms.ToTensor(),
+            transforms.Normalize((MNIST_MEAN,), (MNIST_STD,))
+        ])
+        dataset = datasets.MNIST(args.data_dir, train=True, download=False, transform=transform)
+        sampler = DistributedSampler(dataset, num_replicas=world_size, rank=rank)
+        return DataLoader(dataset, batch_size=args.batch_size, sampler=sampler), sampler
+    
+    images, targets = load_mnist_tensors(args.data_dir, mnist_cache_dirs(args))
+    sampler = DistributedSampler(range(len(targets)), num_replicas=world_size, rank=rank)
+    return TensorBatchLoader(images, targets, sampler, args.batch_size), sampler
+
+class CommCounter:
+    """统计每个优化步经 DDP 通信 hook 发送的梯度字节数（每个 rank 参与 all-reduce 的数据量）"""
+    
+    def __init__(self):
+        self.step_bytes = 0
+        self.total_bytes = 0
+    
+    def add(self, nbytes):
+        self.step_bytes += nbytes
+        self.total_bytes += nbytes
+    
+    def pop_step(self):
+        nbytes, self.step_bytes = self.step_bytes, 0
+        return nbytes
+
+def _powersgd_bytes(state, grads):
+    """PowerSGD 对可压缩的矩阵 all-reduce P、Q 两个低秩因子，其余张量拼在一起按原精度 all-reduce"""
+    nbytes = 0
+    for grad in grads:
+        if grad.dim() > 1:
+            rows, cols = grad.shape[0], grad.numel() // grad.shape[0]
+            # 与 powerSGD_hook / _should_compress 一致：秩不超过矩阵的行列数，压缩率严格大于 min_compression_rate 才压缩
+            rank = min(rows, cols, state.matrix_approximation_rank)
+            if (rows + cols) * rank * state.min_compression_rate < rows * cols:
+                nbytes += (rows + cols) * rank * grad.element_size()
+                continue
+        nbytes += grad.numel() * grad.element_size()
+    return nbytes
+
+def register_comm_hook(model, args, counter):
+    """注册所选的 DDP 通信 hook，并在外面包一层统计每个 bucket 实际发送的字节数"""
+    if args.comm_hook == 'powersgd':
+        state = powerSGD_hook.PowerSGDState(
+            process_group=None,
+            matrix_approximation_rank=args.powersgd_rank,
+            start_powerSGD_iter=args.powersgd_start_iter,
+        )
+        hook = powerSGD_hook.powerSGD_hook
+        
+        def payload(bucket):
+            # 前 start_powerSGD_iter 步仍是未压缩的 all-reduce（误差反馈需要热身）
+            if state.iter < state.start_powerSGD_iter:
+                return bucket.buffer().numel() * bucket.buffer().element_size()
+            return _powersgd_bytes(state, bucket.gradients())
+    else:
+        state = None
+        hook, element_size = {
+            'none': (default_hooks.allreduce_hook, None),
+            'fp16': (default_hooks.fp16_compress_hook, 2),
+            'bf16': (default_hooks.bf16_compress_hook, 2),
+        }[args.comm_hook]
+        
+        def payload(bucket):
+            return bucket.buffer().numel() * (element_size or bucket.buffer().element_size())
+    
+    def counting_hook(hook_state, bucket):
+        counter.add(payload(bucket))
+        return hook(hook_state, bucket)
+    
+    model.register_comm_hook(state, counting_hook)
+
 def train(args):
-    setup_ddp()
+    setup_ddp(args.backend)
     
     rank = dist.get_rank()
     world_size = dist.get_world_size()
     
     print(f"Training on rank {rank}/{world_size}")
     
-    transform = transforms.Compose([
-        transforms.ToTensor(),
-        transforms.Normalize((0.1307,), (0.3081,))
-    ])
-    
-    # 创建临时数据目录
-    data_dir = '/tmp/mnist_data'
-    os.makedirs(data_dir, exist_ok=True)
+    # 每个节点由 local rank 0 下载并预处理一次，其余 rank 等待后直接读取缓存
+    os.makedirs(args.data_dir, exist_ok=True)
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if local_rank == 0:
+        if args.data_mode == 'torchvision':
+            datasets.MNIST(args.data_dir, train=True, download=True)
+        else:
+            load_mnist_tensors(args.data_dir, mnist_cache_dirs(args))
+    dist.barrier()
     
-    dataset = datasets.MNIST(data_dir, train=True, download=True, transform=transform)
-    sampler = DistributedSampler(dataset, num_replicas=world_size, rank=rank)
-    dataloader = DataLoader(dataset, batch_size=args.batch_size, sampler=sampler)
+    dataloader, sampler = build_dataloader(args, rank, world_size)
     
-    model = SimpleModel()
-    model = DDP(model)
+    device = torch.device('cuda', torch.cuda.current_device()) if args.backend == 'nccl' else torch.device('cpu')
+    model = SimpleModel().to(device)
+    model = DDP(model, bucket_cap_mb=args.bucket_cap_mb, static_graph=args.static_graph)
+    comm = CommCounter()
+    register_comm_hook(model, args, comm)
+    if rank == 0:
+        print(f"DDP: backend={args.backend}, comm_hook={args.comm_hook}, bucket_cap_mb={args.bucket_cap_mb}, "
+              f"static_graph={args.static_graph}, grad_accum={args.grad_accum}")
     
     criterion = nn.CrossEntropyLoss()
     optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
     
     model.train()
+    step = 0
+    start = time.time()
     for epoch in range(args.epochs):
         sampler.set_epoch(epoch)
+        num_batches = len(dataloader)
+        optimizer.zero_grad()
         
         for batch_idx, (data, target) in enumerate(dataloader):
-            optimizer.zero_grad()
-            output = model(data)
-            loss = criterion(output, target)
-            loss.backward()
+            data, target = data.to(device), target.to(device)
+            # 非累积边界的 micro-step 只在本地累加梯度，不触发 all-reduce
+            boundary = (batch_idx + 1) % args.grad_accum == 0 or batch_idx + 1 == num_batches
+            # epoch 末尾不足 grad_accum 的累积组按实际长度求平均
+            group_start = batch_idx - batch_idx % args.grad_accum
+            group_len = min(args.grad_accum, num_batches - group_start)
+            with contextlib.nullcontext() if boundary else model.no_sync():
+                output = model(data)
+                loss = criterion(output, target)
+                (loss / group_len).backward()
+            if not boundary:
+                continue
+            
             optimizer.step()
+            optimizer.zero_grad()
+            step += 1
+            step_bytes = comm.pop_step()
+            if step == 1 and local_rank == 0:
+                # launcher.py 据此统计启动到第一个训练步的耗时
+                print(f"First step completed on rank {rank} ({time.time() - start:.2f}s after data loading)", flush=True)
             
-            if batch_idx % 100 == 0 and rank == 0:
-                print(f'Epoch {epoch}, Batch {batch_idx}, Loss: {loss.item():.6f}')
+            if step % args.log_interval == 0 and rank == 0:
+                print(f'Epoch {epoch}, Step {step}, Batch {batch_idx}, Loss: {loss.item():.6f}, '
+                      f'Comm: {step_bytes / 1024 ** 2:.2f} MiB/step')
+    
+    if rank == 0 and step:
+        # ring all-reduce 中每个 rank 实际收发约 2(W-1)/W 倍的数据量
+        wire = comm.total_bytes * 2 * (world_size - 1) / world_size
+        print(f"Communication: {comm.total_bytes / step / 1024 ** 2:.2f} MiB/step all-reduce payload, "
+              f"~{wire / step / 1024 ** 2:.2f} MiB/step on the wire per rank, "
+              f"{step} steps in {time.time() - start:.1f}s")
     
     if rank == 0:
         # SM_PATH = os.environ['SM_PATH']
@@ -89,6 +247,20 @@ if __name__ == '__main__':
     parser.add_argument('--batch-size', type=int, default=64)
     parser.add_argument('--epochs', type=int, default=2)
     parser.add_argument('--lr', type=float, default=0.001)
+    parser.add_argument('--data-dir', type=str, default='/tmp/mnist_data')
+    parser.add_argument('--data-mode', type=str, default='tensor', choices=['tensor', 'torchvision'],
+                        help='tensor: 归一化后的整块张量按索引切片; torchvision: 逐样本 PIL 变换')
+    parser.add_argument('--backend', type=str, default='gloo', choices=['gloo', 'nccl'])
+    parser.add_argument('--grad-accum', type=int, default=1,
+                        help='梯度累积的 micro-batch 数，只在最后一个 micro-batch 上同步梯度')
+    parser.add_argument('--comm-hook', type=str, default='none', choices=['none', 'fp16', 'bf16', 'powersgd'],
+                        help='DDP 梯度通信 hook：fp16/bf16 压缩后 all-reduce，powersgd 低秩近似')
+    parser.add_argument('--powersgd-rank', type=int, default=1)
+    parser.add_argument('--powersgd-start-iter', type=int, default=10,
+                        help='前若干步使用未压缩的 all-reduce')
+    parser.add_argument('--bucket-cap-mb', type=float, default=25)
+    parser.add_argument('--static-graph', action='store_true')
+    parser.add_argument('--log-interval', type=int, default=100)
     
     args = parser.parse_args()
     train(args)
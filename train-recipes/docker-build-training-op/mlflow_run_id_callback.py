@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+训练开始时把 MLflow run ID 写入 /docker_workspace，供 set_mlflow_tags.py 直接定位 run
+
+Hugging Face Trainer 用法（report_to="mlflow" 时，MLflowCallback 会先创建 run）：
+    from mlflow_run_id_callback import MlflowRunIdCallback
+    trainer = Trainer(..., callbacks=[MlflowRunIdCallback()])
+
+其它训练脚本可以在 mlflow.start_run() 之后直接调用 write_run_id_file()。
+"""
+import os
+import json
+
+from transformers import TrainerCallback
+
+RUN_ID_FILE = os.getenv("MLFLOW_RUN_ID_FILE", "/docker_workspace/mlflow-run-id.json")
+
+
+def write_run_id_file(run, path=RUN_ID_FILE):
+    """写入 run ID / experiment ID / run 名称，先写临时文件再 rename，读取方不会看到半个文件"""
+    info = {
+        "run_id": run.info.run_id,
+        "experiment_id": run.info.experiment_id,
+        "run_name": run.info.run_name,
+    }
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(info, f, indent=2)
+    os.replace(tmp_path, path)
+    print(f"MLflow run ID 已写入: {path} ({info['run_id']})")
+    return info
+
+
+class MlflowRunIdCallback(TrainerCallback):
+    """在全局 rank 0 上记录当前 MLflow run，只写一次"""
+
+    def __init__(self, path=RUN_ID_FILE):
+        self.path = path
+        self.written = False
+
+    def _write(self, state):
+        if self.written or not state.is_world_process_zero:
+            return
+        import mlflow
+        run = mlflow.active_run()
+        if run is not None:
+            write_run_id_file(run, self.path)
+            self.written = True
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self._write(state)
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        # MLflowCallback 在 on_train_begin 中延迟创建 run，回调顺序靠后时在第一次 log 补写
+        self._write(state)
@@ -6,46 +6,25 @@ import mlflow
 import os
 import sys
 import json
+import time
 from pathlib import Path
+from mlflow.entities import RunTag
 
-def set_infrastructure_tags():
-    """设置基础设施相关的MLflow tags"""
-    
-    # 设置tracking URI
-    tracking_uri = os.getenv("MLFLOW_TRACKING_URI", "arn:aws:sagemaker:us-west-2:633205212955:mlflow-tracking-server/pdx-mlflow")
-    mlflow.set_tracking_uri(tracking_uri)
-    
-    # experiment_name = "test-model-1-20250815_101449"
-    # run_name = "run-name-1-20250815_101449"
+# 训练脚本（mlflow_run_id_callback.py）写入的 run ID 文件
+RUN_ID_FILE = os.getenv("MLFLOW_RUN_ID_FILE", "/docker_workspace/mlflow-run-id.json")
 
-    experiment_name = os.getenv("MLFLOW_EXPERIMENT_NAME")
-    # run_name = os.getenv("MLFLOW_RUN_NAME")
+# run ID 文件或 run 尚不可见时的有界重试
+MAX_RETRIES = int(os.getenv("MLFLOW_TAG_MAX_RETRIES", "6"))
+BACKOFF_SECONDS = float(os.getenv("MLFLOW_TAG_BACKOFF_SECONDS", "5"))
 
+def build_tags():
+    """汇总基础设施和 recipe 相关的 tags，返回 (tags, run_name)"""
     infra_info = {
             "instance_type": os.getenv("MLFLOW_TAG_INSTANCETYPE"),
             "replica_count": os.getenv("MLFLOW_TAG_REPLICAS"),
             "proc_per_node": os.getenv("MLFLOW_TAG_NPROCPERNODE"),
         }
-
-
-    # if Path('lmf_conf_tags.json').exists():
-    #     with open('lmf_conf_tags.json', 'r') as f:
-    #         mlflow_lmf_tag_envs = json.load(f)
-        
-    #     run_name = mlflow_lmf_tag_envs['MLFLOW_RUN']
-
-    #     print(f"Setting up MLflow tags for experiment: {experiment_name}, run: {run_name}")
-
-    #     # 基础设施信息
-    #     lfm_info = {
-    #         "model": mlflow_lmf_tag_envs['LMF_MODEL'],
-    #         "dataset": mlflow_lmf_tag_envs['LMF_DATASET'],
-    #         "cutoff_len": mlflow_lmf_tag_envs['LMF_CUTOFF'],
-    #         "deepspeed_conf": mlflow_lmf_tag_envs['LMF_DSCONF'],
-    #         # "micro_batchsize": mlflow_lmf_tag_envs['LMF_MBS'],
-    #         "batch_size": mlflow_lmf_tag_envs['LMF_MBS'] * int(os.getenv("MLFLOW_TAG_REPLICAS")) * int(os.getenv("MLFLOW_TAG_NPROCPERNODE"))
-    #     }
-    #     infra_info.update(lfm_info)
+    run_name = None
     
     if Path('mlflow-tags.json').exists():
         with open('mlflow-tags.json', 'r') as f:
@@ -63,42 +42,71 @@ def set_infrastructure_tags():
         }
         
         infra_info.update(gen_info)
-    else:
-        pass
+        
+        # trainer_gpt_ddp.py --plan_batch 探测得到的 micro-batch / 累积步数已写回 MBS / ACCUM
+        if mlflow_metric_tags.get('BATCH_PLANNED'):
+            infra_info["micro_batch_size"] = mlflow_metric_tags['MBS']
+            infra_info["gradient_accumulation_steps"] = mlflow_metric_tags['ACCUM']
+            infra_info["batch_planned"] = True
+        
+        # 并行 / 精度配置（FSDP 分片策略、CPU offload、激活重算等）
+        for key, value in mlflow_metric_tags.get('PARALLEL', {}).items():
+            infra_info[f"parallel.{key}"] = value
     
-    # 通过experiment_name和run_name查找已存在的run
-    client = mlflow.tracking.MlflowClient()
-    experiment = mlflow.get_experiment_by_name(experiment_name)
+    # 未设置的环境变量不写成 "None"
+    return {key: str(value) for key, value in infra_info.items() if value is not None}, run_name
+
+def resolve_run_id(client, experiment_name, run_name):
+    """优先读取训练脚本写入的 run ID 文件；没有时按 run 名称只查询一条（一次请求）"""
+    if Path(RUN_ID_FILE).exists():
+        with open(RUN_ID_FILE, 'r') as f:
+            run_info = json.load(f)
+        if run_name and run_info.get('run_name') not in (None, run_name):
+            print(f"Run ID file belongs to run '{run_info.get('run_name')}', expected '{run_name}', ignoring it")
+        else:
+            return run_info['run_id']
     
+    if not experiment_name or not run_name:
+        return None
+    experiment = client.get_experiment_by_name(experiment_name)
     if not experiment:
-        print(f"Experiment '{experiment_name}' not found!")
-        return
-    
-    # 搜索指定experiment中的runs
+        return None
     runs = client.search_runs(
         experiment_ids=[experiment.experiment_id],
-        filter_string=f"tags.mlflow.runName = '{run_name}'"
+        filter_string=f"tags.mlflow.runName = '{run_name}'",
+        max_results=1
     )
+    return runs[0].info.run_id if runs else None
+
+def set_infrastructure_tags():
+    """设置基础设施相关的MLflow tags：定位 run 后用一次 log_batch 写入全部 tags"""
     
-    if runs:
-        existing_run = runs[0]  # 取第一个匹配的run
-        print(f"Found existing run: {existing_run.info.run_id} with name: {run_name}")
-        
-        # 在已存在的run上设置tags
-        with mlflow.start_run(run_id=existing_run.info.run_id):
-            for key, value in infra_info.items():
-                mlflow.set_tag(key, value)
-                print(f"Set tag: {key} = {value}")
-    else:
-        print(f"No existing run found with name: {run_name} in experiment: {experiment_name}")
-        print("Available runs in this experiment:")
-        all_runs = client.search_runs(experiment_ids=[experiment.experiment_id])
-        for run in all_runs:
-            run_name_tag = run.data.tags.get("mlflow.runName", "No name")
-            print(f"  Run ID: {run.info.run_id}, Name: {run_name_tag}")
-        return
+    # 设置tracking URI
+    tracking_uri = os.getenv("MLFLOW_TRACKING_URI", "arn:aws:sagemaker:us-west-2:633205212955:mlflow-tracking-server/pdx-mlflow")
+    mlflow.set_tracking_uri(tracking_uri)
+    client = mlflow.tracking.MlflowClient()
+    
+    experiment_name = os.getenv("MLFLOW_EXPERIMENT_NAME")
+    tags, run_name = build_tags()
+    
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            run_id = resolve_run_id(client, experiment_name, run_name)
+            if run_id is None:
+                raise LookupError(f"run '{run_name}' not visible yet in experiment '{experiment_name}'")
+            client.log_batch(run_id, tags=[RunTag(key, value) for key, value in tags.items()])
+            break
+        except Exception as e:
+            if attempt == MAX_RETRIES:
+                print(f"Giving up after {attempt + 1} attempts: {e}")
+                return
+            delay = BACKOFF_SECONDS * (2 ** attempt)
+            print(f"Attempt {attempt + 1} failed ({e}), retrying in {delay:.0f}s...")
+            time.sleep(delay)
     
-    print("Infrastructure tags set successfully on existing run!")
+    for key, value in tags.items():
+        print(f"Set tag: {key} = {value}")
+    print(f"Infrastructure tags set successfully on run {run_id}!")
 
 
 
@@ -42,16 +42,56 @@ def parse_args_string(args_string):
     
     return config
 
+def resolve_mixed_precision(sharding, mixed_precision):
+    """与 trainer_gpt_ddp.py 的 resolve_mixed_precision 一致，按本机 GPU 解析实际使用的精度
+
+    本机无法导入 torch 时原样返回，训练脚本启动后会把实际精度写回 mlflow-tags.json。
+    """
+    try:
+        import torch
+    except ImportError:
+        return mixed_precision
+    if not torch.cuda.is_available():
+        return 'no'
+    if mixed_precision != 'auto':
+        return mixed_precision
+    if sharding == 'fsdp' and torch.cuda.is_bf16_supported():
+        return 'bf16'
+    return 'fp16'
+
+def sharding_config(config):
+    """按 trainer_gpt_ddp.py 的默认值解析实际生效的并行配置"""
+    sharding = config.get('sharding', 'ddp')
+    mixed_precision = resolve_mixed_precision(sharding, config.get('mixed_precision', 'auto'))
+    effective = {
+        "sharding": sharding,
+        "mixed_precision": mixed_precision,
+        "activation_checkpointing": bool(config.get('activation_checkpointing', False)),
+    }
+    if sharding == 'fsdp':
+        effective.update({
+            "sharding_strategy": config.get('fsdp_sharding_strategy', 'full_shard'),
+            "cpu_offload": bool(config.get('fsdp_cpu_offload', False)),
+            "auto_wrap": config.get('fsdp_wrap_cls', '_no_split_modules'),
+        })
+    return effective
+
 def save_to_json(config, filename='config.json'):
     """保存配置到JSON文件"""
+    parallel = sharding_config(config)
+    if 'deepspeed' in config:
+        zero_conf = config['deepspeed']
+    else:
+        zero_conf = 'FSDP' if parallel['sharding'] == 'fsdp' else 'DDP'
     metric_tags = {
         "MLFLOW_RUN": config['run_name'],
         "MODEL": config['model_type'] if 'model_name_or_path' not in config else config['model_name_or_path'],
         "DATASET": config['dataset_name'],
         "CUTOFF": config['max_context_width'],
-        "ZEROCONF": 'DDP' if 'deepspeed' not in config else config['deepspeed'],
+        "ZEROCONF": zero_conf,
         "MBS": config['per_device_train_batch_size'],
-        "ACCUM": config['gradient_accumulation_steps']
+        "ACCUM": config['gradient_accumulation_steps'],
+        "PARALLEL": parallel
     }
     with open(filename, 'w', encoding='utf-8') as f:
         json.dump(metric_tags, f, indent=2, ensure_ascii=False)
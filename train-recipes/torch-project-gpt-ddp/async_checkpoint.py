@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+异步 checkpoint 与自动恢复
+
+保存时训练循环只做一次设备到主机的拷贝（复用 pinned 内存缓冲区），序列化和写入共享存储在后台线程完成；
+文件格式与 HF Trainer 一致（model.safetensors / optimizer.pt / scheduler.pt / rng_state*.pth /
+trainer_state.json），可以直接用 resume_from_checkpoint 恢复。所有文件写完后最后写入
+checkpoint_complete.json（包含文件大小），启动时只会从带完整标记的 checkpoint 恢复。
+"""
+
+import os
+import re
+import copy
+import json
+import time
+import logging
+import threading
+
+import torch
+from transformers.trainer_callback import ExportableState
+from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
+
+from streaming_dataset import STREAM_STATE_PREFIX
+
+logger = logging.getLogger(__name__)
+
+COMPLETE_MARKER = "checkpoint_complete.json"
+
+# HF Trainer 同步保存的 checkpoint 中，存在其一即认为模型权重已写入
+_MODEL_FILES = ("model.safetensors", "model.safetensors.index.json", "pytorch_model.bin", "pytorch_model.bin.index.json")
+
+# FSDP 保存的模型（accelerate 的 FSDP_MODEL_NAME）：SHARDED_STATE_DICT 为 pytorch_model_fsdp_0/ 目录，
+# FULL_STATE_DICT 为 pytorch_model_fsdp.bin
+FSDP_MODEL_PREFIX = "pytorch_model_fsdp"
+# torch.distributed.checkpoint 在所有分片写完后才写入的元数据文件
+_DCP_METADATA = ".metadata"
+
+
+def is_fsdp_checkpoint(path):
+    """checkpoint 是否由 FSDP 保存（只能在 --sharding fsdp 下恢复）"""
+    return any(name.startswith(FSDP_MODEL_PREFIX) for name in os.listdir(path))
+
+
+def _fsdp_model_saved(path):
+    for name in os.listdir(path):
+        if not name.startswith(FSDP_MODEL_PREFIX):
+            continue
+        file_path = os.path.join(path, name)
+        if os.path.isfile(file_path) or os.path.exists(os.path.join(file_path, _DCP_METADATA)):
+            return True
+    return False
+
+
+def validate_checkpoint(path):
+    """返回 (是否完整, 原因)"""
+    marker = os.path.join(path, COMPLETE_MARKER)
+    if os.path.exists(marker):
+        with open(marker, "r") as f:
+            files = json.load(f)["files"]
+        for name, size in files.items():
+            file_path = os.path.join(path, name)
+            if not os.path.exists(file_path):
+                return False, f"缺少 {name}"
+            if os.path.getsize(file_path) != size:
+                return False, f"{name} 大小不一致"
+        return True, "complete"
+    # 兼容同步保存（包括 DeepSpeed / FSDP）的 checkpoint：trainer_state.json 在权重之后写入
+    if os.path.exists(os.path.join(path, "trainer_state.json")) and \
+            (any(os.path.exists(os.path.join(path, name)) for name in _MODEL_FILES) or _fsdp_model_saved(path)):
+        return True, "trainer_state.json present"
+    return False, "没有完成标记"
+
+
+def find_latest_checkpoint(output_dir):
+    """返回 output_dir 中 step 最大的完整 checkpoint，没有时返回 None"""
+    if not os.path.isdir(output_dir):
+        return None
+    pattern = re.compile(rf"^{PREFIX_CHECKPOINT_DIR}-(\d+)$")
+    candidates = sorted(
+        (int(m.group(1)), name) for name in os.listdir(output_dir) if (m := pattern.match(name))
+    )
+    for _, name in reversed(candidates):
+        path = os.path.join(output_dir, name)
+        ok, reason = validate_checkpoint(path)
+        if ok:
+            return path
+        logger.warning(f"跳过不完整的 checkpoint {path}: {reason}")
+    return None
+
+
+class AsyncCheckpointMixin:
+    """与 Trainer（或其子类）组合使用：class MyTrainer(AsyncCheckpointMixin, Trainer)
+
+    同一时间最多一个 checkpoint 在后台写入，下一次保存前等待上一次完成，pinned 缓冲区因此可以复用。
+    DeepSpeed / FSDP 的分片状态仍走 Trainer 原有的同步保存。
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._host_buffers = {}
+        self._checkpoint_thread = None
+
+    def _to_host(self, value, key, seen=None):
+        """递归把张量拷贝到复用的 pinned 缓冲区（异步拷贝，调用方负责同步）
+
+        共享存储的张量（例如 tie_word_embeddings 下的 wte / lm_head）只拷贝一次，
+        保存时 save_pretrained 仍能识别为共享权重。
+        """
+        seen = {} if seen is None else seen
+        if isinstance(value, torch.Tensor):
+            value = value.detach()
+            alias = (value.device, value.data_ptr(), value.shape, value.stride(), value.dtype)
+            if value.numel() and alias in seen:
+                return seen[alias]
+            if value.device.type == "cpu":
+                host = value.clone()
+            else:
+                host = self._host_buffers.get(key)
+                if host is None or host.shape != value.shape or host.dtype != value.dtype:
+                    host = torch.empty(value.shape, dtype=value.dtype, pin_memory=True)
+                    self._host_buffers[key] = host
+                host.copy_(value, non_blocking=True)
+            seen[alias] = host
+            return host
+        if isinstance(value, dict):
+            return {k: self._to_host(v, f"{key}.{k}", seen) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return type(value)(self._to_host(v, f"{key}.{i}", seen) for i, v in enumerate(value))
+        return copy.deepcopy(value)
+
+    def wait_for_checkpoint(self):
+        if self._checkpoint_thread is not None:
+            start = time.perf_counter()
+            self._checkpoint_thread.join()
+            self._checkpoint_thread = None
+            waited = time.perf_counter() - start
+            if waited > 0.1:
+                logger.info(f"等待上一个 checkpoint 写入完成 {waited:.1f}s")
+
+    def _save_checkpoint(self, model, trial, *args, **kwargs):
+        if self.is_deepspeed_enabled or self.is_fsdp_enabled:
+            return super()._save_checkpoint(model, trial, *args, **kwargs)
+
+        self.wait_for_checkpoint()
+        run_dir = self._get_output_dir(trial=trial)
+        output_dir = os.path.join(run_dir, f"{PREFIX_CHECKPOINT_DIR}-{self.state.global_step}")
+        os.makedirs(output_dir, exist_ok=True)
+
+        start = time.perf_counter()
+        # 与 Trainer._save_checkpoint 相同：累计 FLOPs（需要所有 rank 参与）
+        if self.hp_search_backend is None and trial is None:
+            self.store_flos()
+        # 每个 rank 的 RNG 状态很小，同步写入
+        self._save_rng_state(output_dir)
+        if not self.args.should_save:
+            return
+
+        # 旧版 transformers 在这里传入 metrics 并判断最优 checkpoint
+        metrics = kwargs.get("metrics", args[0] if args else None)
+        self._update_best_checkpoint(metrics, run_dir, output_dir)
+        # 与 Trainer 相同：把 ExportableState 回调（例如 EarlyStopping）和 TrainerControl 的状态写入 trainer_state
+        for cb in self.callback_handler.callbacks + [self.control]:
+            if not isinstance(cb, ExportableState):
+                continue
+            cb_name = cb.__class__.__name__
+            if isinstance(self.state.stateful_callbacks.get(cb_name), list):
+                self.state.stateful_callbacks[cb_name].append(cb.state())
+            else:
+                self.state.stateful_callbacks[cb_name] = cb.state()
+
+        unwrapped = self.accelerator.unwrap_model(model)
+        snapshot = {
+            "model": self._to_host(unwrapped.state_dict(), "model"),
+            "optimizer": self._to_host(self.optimizer.state_dict(), "optimizer"),
+            "scheduler": copy.deepcopy(self.lr_scheduler.state_dict()),
+            "state": copy.deepcopy(self.state),
+        }
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        logger.info(f"checkpoint-{self.state.global_step}: 设备到主机拷贝 {time.perf_counter() - start:.2f}s，后台写入 {output_dir}")
+
+        self._checkpoint_thread = threading.Thread(
+            target=self._write_checkpoint, args=(unwrapped, snapshot, output_dir, run_dir),
+            name=f"checkpoint-{self.state.global_step}", daemon=False
+        )
+        self._checkpoint_thread.start()
+
+    def _update_best_checkpoint(self, metrics, run_dir, output_dir):
+        """维护 state.best_metric / best_model_checkpoint，兼容新旧两种 Trainer 实现"""
+        if metrics is not None and self.args.metric_for_best_model is not None:
+            metric_to_check = self.args.metric_for_best_model
+            if not metric_to_check.startswith("eval_"):
+                metric_to_check = f"eval_{metric_to_check}"
+            value = metrics[metric_to_check]
+            best = self.state.best_metric
+            if best is None or (value > best if self.args.greater_is_better else value < best):
+                self.state.best_metric = value
+                self.state.best_model_checkpoint = output_dir
+        # 新版 Trainer 在 _determine_best_metric 中只记录 best_global_step，由保存时转换为目录
+        best_step = getattr(self.state, "best_global_step", None)
+        if best_step:
+            best_dir = os.path.join(run_dir, f"{PREFIX_CHECKPOINT_DIR}-{best_step}")
+            if os.path.exists(best_dir):
+                self.state.best_model_checkpoint = best_dir
+
+    def _rotate(self, run_dir):
+        if hasattr(self, "_rotate_checkpoints"):
+            self._rotate_checkpoints(use_mtime=False, output_dir=run_dir)
+            return
+        from transformers.trainer_utils import rotate_checkpoints
+        rotate_checkpoints(output_dir=run_dir, save_total_limit=self.args.save_total_limit,
+                           best_model_checkpoint=self.state.best_model_checkpoint, use_mtime=False)
+
+    def _write_checkpoint(self, unwrapped, snapshot, output_dir, run_dir):
+        start = time.perf_counter()
+        try:
+            unwrapped.save_pretrained(output_dir, state_dict=snapshot["model"], safe_serialization=True)
+            processor = getattr(self, "processing_class", None) or getattr(self, "tokenizer", None)
+            if processor is not None:
+                processor.save_pretrained(output_dir)
+            torch.save(snapshot["optimizer"], os.path.join(output_dir, "optimizer.pt"))
+            torch.save(snapshot["scheduler"], os.path.join(output_dir, "scheduler.pt"))
+            torch.save(self.args, os.path.join(output_dir, "training_args.bin"))
+            snapshot["state"].save_to_json(os.path.join(output_dir, "trainer_state.json"))
+
+            # 其它 rank 的 RNG 状态和回调写入的文件不在本线程控制范围内，不计入完成标记
+            files = {name: os.path.getsize(os.path.join(output_dir, name))
+                     for name in os.listdir(output_dir)
+                     if name != COMPLETE_MARKER and not name.startswith(("rng_state", STREAM_STATE_PREFIX))}
+            with open(os.path.join(output_dir, COMPLETE_MARKER), "w") as f:
+                json.dump({"global_step": snapshot["state"].global_step, "files": files}, f, indent=2)
+            logger.info(f"{output_dir} 写入完成 {time.perf_counter() - start:.1f}s")
+
+            self._rotate(run_dir)
+        except Exception as e:
+            logger.error(f"异步写入 {output_dir} 失败: {e}")
+
+    def train(self, *args, **kwargs):
+        try:
+            return super().train(*args, **kwargs)
+        finally:
+            self.wait_for_checkpoint()
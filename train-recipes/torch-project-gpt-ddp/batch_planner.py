@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+micro-batch / 梯度累积规划
+
+在训练开始前用随机 token 做几次前向 + 反向试跑，找出当前模型、max_context_width 和精度下
+单卡能放下的最大 micro-batch（先倍增、OOM 后二分回退），再按 NNODES × NPROC_PER_NODE
+推出达到目标全局 batch 所需的梯度累积步数。
+
+试跑不做 optimizer.step（不改变权重），AdamW 的两份状态和 DDP 的梯度桶用等大的占位张量预留；
+各 rank 的结果取最小值，保证所有卡一致。规划结果写回 mlflow-tags.json 的 MBS / ACCUM，
+set_mlflow_tags.py 据此上报真实的 batch_size。
+"""
+
+import gc
+import json
+import math
+import time
+import logging
+from pathlib import Path
+
+import torch
+import torch.distributed as dist
+
+logger = logging.getLogger(__name__)
+
+AUTOCAST_DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def _trial(model, batch_size, seq_len, vocab_size, precision, device):
+    """用 batch_size 条随机序列跑一次前向 + 反向，返回峰值显存（字节）；OOM 时抛出异常"""
+    torch.cuda.reset_peak_memory_stats(device)
+    input_ids = torch.randint(0, vocab_size, (batch_size, seq_len), device=device)
+    try:
+        with torch.autocast("cuda", dtype=AUTOCAST_DTYPES.get(precision, torch.float32),
+                            enabled=precision in AUTOCAST_DTYPES):
+            loss = model(input_ids=input_ids, labels=input_ids).loss
+        loss.backward()
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device)
+    finally:
+        del input_ids
+        model.zero_grad(set_to_none=True)
+
+
+def probe_micro_batch(model, seq_len, precision, max_batch=256, memory_fraction=0.9, world_size=1):
+    """返回单卡能放下的最大 micro-batch；显存峰值超过 memory_fraction 的结果视为放不下"""
+    device = torch.device("cuda", torch.cuda.current_device())
+    model.to(device)
+    model.train()
+    vocab_size = model.config.vocab_size
+    total_memory = torch.cuda.get_device_properties(device).total_memory
+    n_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
+
+    # AdamW 的 exp_avg / exp_avg_sq（fp32），多卡时再加 DDP 的梯度桶
+    reserve_elems = n_params * (3 if world_size > 1 else 2)
+    reserve = torch.empty(reserve_elems, dtype=torch.float32, device=device)
+
+    def fits(batch_size):
+        start = time.perf_counter()
+        try:
+            peak = _trial(model, batch_size, seq_len, vocab_size, precision, device)
+            ok = peak + reserve.numel() * 4 <= total_memory * memory_fraction
+            logger.info(f"micro-batch {batch_size}: 峰值 {peak / 1024 ** 3:.1f} GiB "
+                        f"({'ok' if ok else '超过预留上限'}, {time.perf_counter() - start:.1f}s)")
+            return ok
+        except torch.cuda.OutOfMemoryError:
+            logger.info(f"micro-batch {batch_size}: OOM")
+            return False
+        finally:
+            gc.collect()
+            torch.cuda.empty_cache()
+
+    try:
+        best, failed = 0, None
+        batch_size = 1
+        # 倍增直到放不下
+        while batch_size <= max_batch:
+            if not fits(batch_size):
+                failed = batch_size
+                break
+            best = batch_size
+            batch_size *= 2
+        # 在 (best, failed) 之间二分
+        if failed is not None:
+            low, high = best, failed
+            while high - low > 1:
+                mid = (low + high) // 2
+                if fits(mid):
+                    low = mid
+                else:
+                    high = mid
+            best = low
+    finally:
+        del reserve
+        gc.collect()
+        torch.cuda.empty_cache()
+
+    if best == 0:
+        raise RuntimeError(f"max_context_width={seq_len} 下 micro-batch 1 也放不下，请开启激活重算或 FSDP")
+    return best
+
+
+def plan_accumulation(micro_batch, world_size, global_batch_size=None, accumulation=1):
+    """返回 (micro_batch, accumulation, 实际全局 batch)
+
+    指定 global_batch_size 时取能达到它的最小累积步数，再把 micro-batch 缩小到恰好够用，
+    避免在显存上限上多放样本；不指定时保持原有的累积步数。
+    """
+    if not global_batch_size:
+        return micro_batch, accumulation, micro_batch * accumulation * world_size
+    accumulation = max(1, math.ceil(global_batch_size / (micro_batch * world_size)))
+    micro_batch = max(1, math.ceil(global_batch_size / (accumulation * world_size)))
+    return micro_batch, accumulation, micro_batch * accumulation * world_size
+
+
+def _min_across_ranks(value):
+    if not (dist.is_available() and dist.is_initialized()):
+        return value
+    device = "cuda" if dist.get_backend() == "nccl" else "cpu"
+    tensor = torch.tensor([value], dtype=torch.int64, device=device)
+    dist.all_reduce(tensor, op=dist.ReduceOp.MIN)
+    return int(tensor.item())
+
+
+def update_mlflow_tags(path, micro_batch, accumulation, global_batch):
+    """把规划结果写回 torch_process_train_args.py 生成的 mlflow-tags.json"""
+    path = Path(path)
+    if not path.exists():
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        tags = json.load(f)
+    tags.update({"MBS": micro_batch, "ACCUM": accumulation, "GLOBAL_BATCH": global_batch, "BATCH_PLANNED": True})
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(tags, f, indent=2, ensure_ascii=False)
+    logger.info(f"规划结果已写入 {path}")
+
+
+def plan_batch(model, seq_len, precision, world_size, is_main_process, global_batch_size=None,
+               accumulation=1, max_batch=256, memory_fraction=0.9, tags_file="mlflow-tags.json"):
+    """探测 micro-batch 并推出梯度累积，返回 (micro_batch, accumulation, 全局 batch)"""
+    if not torch.cuda.is_available():
+        raise RuntimeError("batch 规划需要 GPU")
+    micro_batch = probe_micro_batch(model, seq_len, precision, max_batch=max_batch,
+                                    memory_fraction=memory_fraction, world_size=world_size)
+    micro_batch = _min_across_ranks(micro_batch)
+    micro_batch, accumulation, global_batch = plan_accumulation(micro_batch, world_size, global_batch_size, accumulation)
+    logger.info(f"batch 规划: micro-batch {micro_batch} × 累积 {accumulation} × {world_size} 卡 = 全局 batch {global_batch}")
+    if is_main_process:
+        update_mlflow_tags(tags_file, micro_batch, accumulation, global_batch)
+    return micro_batch, accumulation, global_batch
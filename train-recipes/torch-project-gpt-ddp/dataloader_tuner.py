@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+DataLoader / 输入管线自动调优
+
+训练开始前在真实的训练集和 collator 上测量不同 num_workers × prefetch_factor 组合的 batch 产出速率，
+并用几个真实 batch 测量模型单个 micro-step（前向 + 反向）的耗时，按开销从小到大选出第一个
+产出速率 ≥ headroom / micro-step 时间的组合（worker 数少的优先，其次 prefetch 小的）。
+
+- 每个 rank 可用的 CPU 数 = 进程可用核数 / LOCAL_WORLD_SIZE，候选 worker 数不超过它；
+- 同一节点的各 rank 同时测量，测到的速率已经包含 CPU 争用；各 rank 采用开销最大的那个 rank 选出的组合
+  （按 worker 数、prefetch 排序，组合本身是实测过的），保证配置一致；
+- 无法测量模型步时（例如 FSDP 下模型尚未分片）时，选取速率达到最优值 90% 的最便宜组合；
+- worker 启动耗时超过一个 epoch 训练时间的 1% 时开启 persistent_workers。
+
+训练过程中 ThroughputCallback 持续记录 perf/data_wait_frac，超过阈值时给出警告。
+"""
+
+import os
+import json
+import time
+import logging
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import DataLoader, RandomSampler
+
+from batch_planner import AUTOCAST_DTYPES
+
+logger = logging.getLogger(__name__)
+
+PREFETCH_FACTORS = (2, 4)
+
+# 没有目标速率时，达到最优速率的这个比例即视为够用
+NEAR_BEST_RATIO = 0.9
+
+# worker 启动耗时超过 epoch 时间的这个比例时保持 worker 常驻
+PERSISTENT_STARTUP_RATIO = 0.01
+
+REPORT_FILE = "dataloader_tuning.json"
+
+
+def cpus_per_rank():
+    """本进程可用的 CPU 核数按节点内 rank 数均分"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+    return max(1, cpus // local_world_size)
+
+
+def candidate_settings(max_workers):
+    """按开销从小到大排列的 (num_workers, prefetch_factor)"""
+    workers = [0]
+    n = 1
+    while n < max_workers:
+        workers.append(n)
+        n *= 2
+    if max_workers not in workers:
+        workers.append(max_workers)
+    settings = []
+    for num_workers in workers:
+        if num_workers == 0:
+            settings.append((0, None))
+        else:
+            settings.extend((num_workers, prefetch) for prefetch in PREFETCH_FACTORS)
+    return settings
+
+
+def benchmark_loader(dataset, collate_fn, batch_size, num_workers, prefetch_factor,
+                     pin_memory=True, num_batches=50, seed=42):
+    """返回 {'startup_s', 'batches_per_sec', 'batches'}
+
+    startup_s 为创建迭代器到拿到第一个 batch 的耗时（worker 启动）；之后先丢弃
+    num_workers × prefetch_factor 个已预取的 batch，再计时测量稳态产出速率。
+    """
+    loader = DataLoader(
+        dataset,
+        batch_size=batch_size,
+        sampler=RandomSampler(dataset, generator=torch.Generator().manual_seed(seed)),
+        collate_fn=collate_fn,
+        num_workers=num_workers,
+        prefetch_factor=prefetch_factor,
+        pin_memory=pin_memory and torch.cuda.is_available(),
+        drop_last=True,
+    )
+    start = time.perf_counter()
+    iterator = iter(loader)
+    try:
+        next(iterator)
+        startup = time.perf_counter() - start
+
+        for _ in range(num_workers * (prefetch_factor or 0)):
+            next(iterator, None)
+
+        start = time.perf_counter()
+        count = 0
+        for _ in iterator:
+            count += 1
+            if count >= num_batches:
+                break
+        elapsed = time.perf_counter() - start
+    finally:
+        # 关闭 worker 进程
+        del iterator
+    return {
+        "startup_s": startup,
+        "batches_per_sec": count / elapsed if count and elapsed > 0 else 0.0,
+        "batches": count,
+    }
+
+
+def measure_step_time(model, batches, precision):
+    """在给定 batch 上测量 micro-step（前向 + 反向）耗时的中位数，第一个 batch 用于预热"""
+    device = torch.device("cuda", torch.cuda.current_device())
+    model.to(device)
+    model.train()
+    times = []
+    for batch in batches:
+        batch = {k: v.to(device) for k, v in batch.items() if isinstance(v, torch.Tensor)}
+        torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        with torch.autocast("cuda", dtype=AUTOCAST_DTYPES.get(precision, torch.float32),
+                            enabled=precision in AUTOCAST_DTYPES):
+            loss = model(**batch).loss
+        loss.backward()
+        torch.cuda.synchronize(device)
+        times.append(time.perf_counter() - start)
+        model.zero_grad(set_to_none=True)
+    times = sorted(times[1:] or times)
+    return times[len(times) // 2]
+
+
+def _sample_batches(dataset, collate_fn, batch_size, count):
+    loader = DataLoader(dataset, batch_size=batch_size, collate_fn=collate_fn, drop_last=True)
+    batches = []
+    for batch in loader:
+        batches.append(batch)
+        if len(batches) >= count:
+            break
+    return batches
+
+
+def _max_across_ranks(values):
+    if not (dist.is_available() and dist.is_initialized()):
+        return values
+    device = "cuda" if dist.get_backend() == "nccl" else "cpu"
+    tensor = torch.tensor(values, dtype=torch.int64, device=device)
+    dist.all_reduce(tensor, op=dist.ReduceOp.MAX)
+    return tensor.tolist()
+
+
+def _most_demanding_setting(num_workers, prefetch, persistent):
+    """在各 rank 选出的 (num_workers, prefetch_factor) 中取开销最大的一组
+
+    两个值编码成一个数再取最大值，保证结果是某个 rank 实际选中的组合，而不是分别取最大值拼出来的组合。
+    """
+    rank_key = num_workers * (max(PREFETCH_FACTORS) + 1) + prefetch
+    rank_key, persistent = _max_across_ranks([rank_key, persistent])
+    num_workers, prefetch = divmod(rank_key, max(PREFETCH_FACTORS) + 1)
+    return num_workers, prefetch, persistent
+
+
+def tune_dataloader(dataset, collate_fn, batch_size, model=None, precision="no", world_size=1,
+                    num_batches=50, headroom=1.2, max_workers=None, pin_memory=True, report_dir=None,
+                    is_main_process=True):
+    """返回 {'num_workers', 'prefetch_factor', 'persistent_workers'}，同时写出测量报告
+
+    model 为 None 或没有 GPU 时不测量模型步时，按 NEAR_BEST_RATIO 选择。
+    """
+    max_workers = max_workers or cpus_per_rank()
+    step_time = None
+    if model is not None and torch.cuda.is_available():
+        step_time = measure_step_time(model, _sample_batches(dataset, collate_fn, batch_size, 6), precision)
+        logger.info(f"micro-step 耗时 {step_time * 1000:.1f} ms，"
+                    f"需要每秒 {headroom / step_time:.1f} 个 batch（headroom {headroom}）")
+    target = headroom / step_time if step_time else None
+
+    results = []
+    chosen = None
+    for num_workers, prefetch in candidate_settings(max_workers):
+        result = benchmark_loader(dataset, collate_fn, batch_size, num_workers, prefetch,
+                                  pin_memory=pin_memory, num_batches=num_batches)
+        result.update(num_workers=num_workers, prefetch_factor=prefetch)
+        results.append(result)
+        logger.info(f"num_workers={num_workers} prefetch={prefetch}: {result['batches_per_sec']:.1f} batch/s，"
+                    f"启动 {result['startup_s']:.2f}s")
+        if target and result["batches_per_sec"] >= target:
+            # 按开销排序，第一个达标的即最便宜的
+            chosen = result
+            break
+
+    best = max(results, key=lambda r: r["batches_per_sec"])
+    if chosen is None:
+        if target:
+            logger.warning(f"没有组合能达到每秒 {target:.1f} 个 batch（最高 {best['batches_per_sec']:.1f}），"
+                           f"训练将受输入管线限制，考虑预分词（--dataset_cache_dir / --token_shards_dir）")
+            chosen = best
+        else:
+            chosen = next(r for r in results if r["batches_per_sec"] >= best["batches_per_sec"] * NEAR_BEST_RATIO)
+
+    # 每个 epoch 都要重新启动 worker，启动开销相对 epoch 时间不可忽略时保持常驻
+    persistent = False
+    if chosen["num_workers"] > 0:
+        epoch_batches = len(dataset) // (batch_size * world_size)
+        epoch_time = epoch_batches * (step_time or 1.0 / max(chosen["batches_per_sec"], 1e-6))
+        persistent = chosen["startup_s"] > epoch_time * PERSISTENT_STARTUP_RATIO
+
+    num_workers, prefetch, persistent = _most_demanding_setting(
+        chosen["num_workers"], chosen["prefetch_factor"] or 0, int(persistent))
+    setting = {
+        "num_workers": num_workers,
+        "prefetch_factor": prefetch or None,
+        "persistent_workers": bool(num_workers and persistent),
+    }
+    logger.info(f"DataLoader 调优结果: {setting}")
+
+    if is_main_process and report_dir:
+        os.makedirs(report_dir, exist_ok=True)
+        with open(os.path.join(report_dir, REPORT_FILE), "w") as f:
+            json.dump({
+                "batch_size": batch_size,
+                "cpus_per_rank": max_workers,
+                "micro_step_time_s": step_time,
+                "target_batches_per_sec": target,
+                "results": results,
+                "selected": setting,
+            }, f, indent=2)
+    return setting
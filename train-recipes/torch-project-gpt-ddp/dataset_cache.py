@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+按内容寻址的预处理数据集缓存（共享存储，跨 rank / 跨任务复用）
+
+缓存目录结构：
+    <cache_root>/<key>/<build_id>/            datasets.save_to_disk 的输出（arrow 文件）
+    <cache_root>/<key>/<build_id>.complete    写完数据后最后创建的完成标记
+
+key 是数据集、tokenizer、上下文长度和预处理选项的 sha256。/s3 (Mountpoint for S3) 不支持
+rename 和覆盖写，因此每次构建写入新的 build_id 目录，读取方只认带完成标记的构建，
+中途失败的构建不会被读到。load_from_disk 以内存映射方式打开 arrow 文件，不会复制到内存。
+"""
+
+import os
+import json
+import time
+import uuid
+import hashlib
+import logging
+
+from datasets import load_from_disk
+from datasets.fingerprint import Hasher
+
+logger = logging.getLogger(__name__)
+
+# 预处理逻辑变化时递增，使旧缓存失效（2：打包不再受 num_proc 影响）
+PREPROCESS_VERSION = 2
+
+DEFAULT_CACHE_ROOT = os.getenv("DATASET_CACHE_DIR", "/s3/tokenized-datasets" if os.path.isdir("/s3") else "")
+
+
+def tokenizer_fingerprint(tokenizer):
+    """tokenizer 的内容指纹（词表、特殊 token 和配置），与加载路径无关"""
+    return Hasher.hash(tokenizer)
+
+
+def cache_key(**fields):
+    """把预处理选项序列化为稳定的 JSON 后取 sha256"""
+    fields["preprocess_version"] = PREPROCESS_VERSION
+    payload = json.dumps(fields, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+
+def find_complete_build(cache_dir):
+    """返回最新一个带完成标记的构建目录，没有时返回 None"""
+    if not os.path.isdir(cache_dir):
+        return None
+    markers = [name for name in os.listdir(cache_dir) if name.endswith(".complete")]
+    if not markers:
+        return None
+    latest = max(markers, key=lambda name: os.path.getmtime(os.path.join(cache_dir, name)))
+    return os.path.join(cache_dir, latest[:-len(".complete")])
+
+
+def load_or_build(cache_root, key, build_fn, description=None):
+    """命中缓存时内存映射加载，否则调用 build_fn() 构建并写入缓存
+
+    多进程场景由调用方保证只有一个进程先执行（例如 TrainingArguments.main_process_first(local=True)），
+    其余进程在 barrier 之后进入时会直接命中缓存。
+    """
+    cache_dir = os.path.join(cache_root, key)
+    build_dir = find_complete_build(cache_dir)
+    if build_dir is not None:
+        start = time.time()
+        dataset = load_from_disk(build_dir)
+        logger.info(f"数据集缓存命中: {build_dir} ({len(dataset)} 条, {time.time() - start:.1f}s)")
+        return dataset
+
+    start = time.time()
+    dataset = build_fn()
+    logger.info(f"数据集预处理完成 ({len(dataset)} 条, {time.time() - start:.1f}s)，写入缓存 {cache_dir}")
+
+    build_id = f"{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    build_dir = os.path.join(cache_dir, build_id)
+    try:
+        dataset.save_to_disk(build_dir)
+        with open(f"{build_dir}.complete", "w") as f:
+            json.dump({"description": description, "num_rows": len(dataset), "built_at": build_id}, f)
+    except OSError as e:
+        # 缓存写入失败不影响本次训练
+        logger.warning(f"写入数据集缓存失败: {e}")
+        return dataset
+    # 重新以内存映射方式打开，与其它 rank 读取的是同一份文件
+    return load_from_disk(build_dir)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+流式数据集模式：不预先物化数据集，DataLoader worker 边读边分词
+
+- 数据流按 (rank, worker) 切分：共 world_size × num_workers 个互不重叠的子流；
+- 可选 shuffle buffer；数据流读完后自动进入下一轮（换 shuffle 种子），训练长度由 max_steps 决定；
+- 文档以 EOS 拼接后切成 seq_len 定长块（与 --sequence_mode pack 相同）；
+- 每批分词前用 datasets 的 IterableDataset.state_dict() 记录数据流位置，随 batch 带回主进程；
+  保存 checkpoint 时每个 rank 记录各 worker 最后一个已训练 batch 对应的位置，恢复时 load_state_dict
+  直接定位，只需重新分词一批文档，恢复耗时与训练进度无关。datasets 恢复时会清空 shuffle buffer。
+"""
+
+import os
+import json
+import logging
+
+import torch
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
+from transformers import Trainer, TrainerCallback
+
+logger = logging.getLogger(__name__)
+
+STREAM_STATE_PREFIX = "stream_state"
+
+# 样本中携带数据流位置的键，在主进程取出后从 batch 中删除
+STATE_KEY = "_stream_state"
+
+# 每次批量分词的文档数
+TOKENIZE_BATCH = 64
+
+
+def stream_state_file(rank):
+    return f"{STREAM_STATE_PREFIX}_rank{rank}.json"
+
+
+class StreamingTextDataset(IterableDataset):
+    """按 rank / worker 切分的流式文本数据集，产出 {'input_ids', 'labels'} 定长块"""
+
+    def __init__(self, dataset_name, dataset_config_name, tokenizer, seq_len, split="train",
+                 data_files=None, text_key="text", rank=0, world_size=1, batch_size=1,
+                 shuffle_buffer=0, seed=42):
+        self.dataset_name = dataset_name
+        self.dataset_config_name = dataset_config_name
+        self.tokenizer = tokenizer
+        self.seq_len = seq_len
+        self.split = split
+        self.data_files = data_files
+        self.text_key = text_key
+        self.rank = rank
+        self.world_size = world_size
+        self.batch_size = batch_size
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        # worker id -> {'snapshot', 'skip'}（从 checkpoint 恢复时设置）
+        self.resume_states = {}
+
+    def _open_stream(self, shard_index, num_shards):
+        from datasets import load_dataset
+        from datasets.distributed import split_dataset_by_node
+
+        stream = load_dataset(self.dataset_name, self.dataset_config_name, split=self.split,
+                              data_files=self.data_files, streaming=True)
+        # 数据文件数能被子流数整除时按文件分配，否则每个子流按样本间隔读取
+        stream = split_dataset_by_node(stream, rank=shard_index, world_size=num_shards)
+        if self.shuffle_buffer:
+            stream = stream.shuffle(seed=self.seed, buffer_size=self.shuffle_buffer)
+        return stream
+
+    def _iter_blocks(self, worker_id, num_workers, resume=None):
+        """产出 (块, 快照, 快照之后的块序号)
+
+        快照在每批文档读取之前记录：{'epoch', 'stream': 数据流位置（轮次开始时为 None）, 'buffer': 不足一块的剩余 token}。
+        """
+        shard_index, num_shards = self.rank * num_workers + worker_id, self.world_size * num_workers
+        eos = self.tokenizer.eos_token_id
+        snapshot = resume["snapshot"] if resume else {"epoch": 0, "stream": None, "buffer": []}
+        to_skip = resume["skip"] if resume else 0
+        epoch, buffer = snapshot["epoch"], list(snapshot["buffer"])
+        since = 0
+
+        while True:
+            # 每轮重新打开数据流：load_state_dict 恢复的位置在 datasets 中会对之后的每一轮都生效
+            stream = self._open_stream(shard_index, num_shards)
+            stream.set_epoch(epoch)
+            resumed = snapshot["stream"] is not None
+            if resumed:
+                stream.load_state_dict(snapshot["stream"])
+
+            read = 0
+            # iter() 不会在 DataLoader worker 中再按 worker 切分 shard，子流只由上面的 (rank, worker) 决定
+            for examples in stream.iter(batch_size=TOKENIZE_BATCH):
+                texts = [text for text in examples[self.text_key] if text and text.strip()]
+                read += len(texts)
+                for ids in self.tokenizer(texts, add_special_tokens=False)["input_ids"] if texts else []:
+                    buffer.extend(ids)
+                    buffer.append(eos)
+                while len(buffer) >= self.seq_len:
+                    block = buffer[:self.seq_len]
+                    del buffer[:self.seq_len]
+                    since += 1
+                    if to_skip:
+                        to_skip -= 1
+                        continue
+                    yield block, snapshot, since
+                snapshot, since = {"epoch": epoch, "stream": stream.state_dict(), "buffer": list(buffer)}, 0
+
+            if read == 0 and not resumed:
+                # 子流中没有非空文档时继续下一轮只会空转
+                raise ValueError(f"rank {self.rank} worker {worker_id} 的数据子流为空（共 {num_shards} 个子流），"
+                                 f"请减少 --dataloader_num_workers 或增加数据")
+            epoch += 1
+            snapshot, since = {"epoch": epoch, "stream": None, "buffer": list(buffer)}, 0
+
+    def __iter__(self):
+        info = get_worker_info()
+        worker_id, num_workers = (info.id, info.num_workers) if info is not None else (0, 1)
+        resume = self.resume_states.get(worker_id)
+        if resume:
+            logger.info(f"rank {self.rank} worker {worker_id}: 从 epoch {resume['snapshot']['epoch']} 的记录位置恢复，"
+                        f"跳过 {resume['skip']} 个块")
+        for block, snapshot, since in self._iter_blocks(worker_id, num_workers, resume):
+            tokens = torch.tensor(block, dtype=torch.long)
+            yield {"input_ids": tokens, "labels": tokens,
+                   STATE_KEY: {"worker": worker_id, "snapshot": snapshot, "skip": since}}
+
+
+class StreamStateDataLoader(DataLoader):
+    """在主进程中取出 batch 携带的数据流位置，记录每个 worker 最后交给训练循环的 batch"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.worker_states = {}
+
+    def __iter__(self):
+        for batch in super().__iter__():
+            state = batch.pop(STATE_KEY, None)
+            if state is not None:
+                self.worker_states[state["worker"]] = {"snapshot": state["snapshot"], "skip": state["skip"]}
+            yield batch
+
+
+class StreamingTrainer(Trainer):
+    """数据集已按 rank 切分，DataLoader 不再经过 accelerate 的分发 / 二次切分"""
+
+    def get_train_dataloader(self):
+        num_workers = self.args.dataloader_num_workers
+        data_collator = self.data_collator
+
+        def _collate(samples):
+            # 同一个 batch 来自同一个 worker，最后一个样本的位置覆盖整个 batch
+            state = samples[-1].get(STATE_KEY)
+            batch = data_collator([{k: v for k, v in s.items() if k != STATE_KEY} for s in samples])
+            if state is not None:
+                batch[STATE_KEY] = state
+            return batch
+
+        return StreamStateDataLoader(
+            self.train_dataset,
+            batch_size=self._train_batch_size,
+            collate_fn=_collate,
+            num_workers=num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+            prefetch_factor=self.args.dataloader_prefetch_factor if num_workers > 0 else None,
+            persistent_workers=self.args.dataloader_persistent_workers and num_workers > 0,
+        )
+
+
+class StreamPositionCallback(TrainerCallback):
+    """在每个 checkpoint 目录中记录每个 rank 的数据流位置"""
+
+    def __init__(self, dataset, num_workers):
+        self.dataset = dataset
+        self.num_workers = num_workers
+
+    def on_save(self, args, state, control, train_dataloader=None, **kwargs):
+        checkpoint_dir = os.path.join(args.output_dir, f"checkpoint-{state.global_step}")
+        if not os.path.isdir(checkpoint_dir) or not isinstance(train_dataloader, StreamStateDataLoader):
+            return
+        stream_state = {
+            "global_step": state.global_step,
+            "rank": self.dataset.rank,
+            "world_size": self.dataset.world_size,
+            "num_workers": self.num_workers,
+            "seed": self.dataset.seed,
+            "shuffle_buffer": self.dataset.shuffle_buffer,
+            "workers": {str(k): v for k, v in train_dataloader.worker_states.items()},
+        }
+        with open(os.path.join(checkpoint_dir, stream_state_file(self.dataset.rank)), "w") as f:
+            json.dump(stream_state, f)
+
+
+def restore_stream_position(dataset, checkpoint_dir, num_workers):
+    """从 checkpoint 恢复本 rank 的数据流位置；切分方式变化时无法精确定位，给出警告并从头读取"""
+    path = os.path.join(checkpoint_dir, stream_state_file(dataset.rank))
+    if not os.path.exists(path):
+        logger.warning(f"{path} 不存在，数据流从头开始")
+        return False
+    with open(path, "r") as f:
+        stream_state = json.load(f)
+    expected = {
+        "world_size": dataset.world_size,
+        "num_workers": num_workers,
+        "seed": dataset.seed,
+        "shuffle_buffer": dataset.shuffle_buffer,
+    }
+    changed = {k: (stream_state.get(k), v) for k, v in expected.items() if stream_state.get(k) != v}
+    if changed:
+        logger.warning(f"数据流切分配置已变化 {changed}，无法恢复数据流位置，从头开始")
+        return False
+    dataset.resume_states = {int(k): v for k, v in stream_state["workers"].items()}
+    logger.info(f"恢复数据流位置: step {stream_state['global_step']}, {len(dataset.resume_states)} 个 worker")
+    return True
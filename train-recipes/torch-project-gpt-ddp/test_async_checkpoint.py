@@ -0,0 +1,44 @@
+import os
+import types
+
+from async_checkpoint import AsyncCheckpointMixin
+
+
+class _Base:
+    def __init__(self, save_total_limit=1):
+        self.args = types.SimpleNamespace(save_total_limit=save_total_limit)
+        self.state = types.SimpleNamespace(best_model_checkpoint=None)
+
+
+class _LegacyTrainer(_Base):
+    """带 Trainer._rotate_checkpoints 的 transformers 版本"""
+
+    def __init__(self):
+        super().__init__()
+        self.rotated = []
+
+    def _rotate_checkpoints(self, use_mtime=False, output_dir=None):
+        self.rotated.append((use_mtime, output_dir))
+
+
+class LegacyTrainer(AsyncCheckpointMixin, _LegacyTrainer):
+    pass
+
+
+class CurrentTrainer(AsyncCheckpointMixin, _Base):
+    pass
+
+
+def test_rotate_uses_trainer_method_when_available(tmp_path):
+    trainer = LegacyTrainer()
+    trainer._rotate(str(tmp_path))
+    assert trainer.rotated == [(False, str(tmp_path))]
+
+
+def test_rotate_falls_back_to_trainer_utils(tmp_path):
+    for step in (2, 4, 6):
+        os.makedirs(tmp_path / f"checkpoint-{step}")
+    trainer = CurrentTrainer()
+    assert not hasattr(trainer, "_rotate_checkpoints")
+    trainer._rotate(str(tmp_path))
+    assert sorted(os.listdir(tmp_path)) == ["checkpoint-6"]
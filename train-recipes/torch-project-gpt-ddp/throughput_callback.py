@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+训练吞吐 / 效率指标回调：每个 logging 周期汇总一次，在 rank 0 上用一次 log_batch 写入 MLflow
+
+记录的指标（前缀 perf/）：
+- step_time_p50/p90/p99/mean：优化步（含梯度累积）的墙钟时间，秒
+- data_wait_frac：上一步结束到下一步开始的间隔占比（取 batch、日志等主机侧开销；
+  transformers >= 4.46 中一个优化步的全部 micro-batch 都在 on_step_begin 之前取出）
+- samples_per_sec / tokens_per_sec：全局吞吐，*_per_rank 为单卡吞吐
+- straggler_ratio：各 rank 平均步时的最大值 / 平均值
+- peak_mem_allocated_gb / peak_mem_reserved_gb：周期内 GPU 显存峰值（CPU 上为进程 RSS 峰值）
+- mfu：按 6N + 12·L·H·S FLOPs/token 估算的模型 FLOPs 利用率（仅 GPU）
+- padding_ratio / useful_tokens_per_sec：传入数据的 padding 占比时记录，以及扣除 padding 后的吞吐
+
+data_wait_frac 超过 stall_threshold 时在日志中给出输入管线瓶颈警告。
+"""
+
+import time
+import logging
+import resource
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from transformers import TrainerCallback
+
+logger = logging.getLogger(__name__)
+
+# 常见 GPU 的 fp16/bf16 dense 峰值 TFLOPS，按设备名子串匹配
+PEAK_TFLOPS = {
+    'H200': 989.0,
+    'H100': 989.0,
+    'A100': 312.0,
+    'L40S': 362.0,
+    'A10G': 125.0,
+    'L4': 121.0,
+    'V100': 125.0,
+    'T4': 65.0,
+}
+
+
+def detect_peak_tflops():
+    """根据当前 GPU 型号返回峰值 TFLOPS，未知型号或 CPU 返回 None"""
+    if not torch.cuda.is_available():
+        return None
+    name = torch.cuda.get_device_name()
+    for key, tflops in PEAK_TFLOPS.items():
+        if key in name:
+            return tflops
+    return None
+
+
+def flops_per_token(model, seq_len, n_params=None):
+    """训练每个 token 的 FLOPs：6N（前向 + 反向的矩阵乘）加注意力项 12·L·H·S
+
+    FSDP 包装后 parameters() 只包含本 rank 的分片，此时需要传入包装前统计的 n_params。
+    """
+    if n_params is None:
+        n_params = sum(p.numel() for p in model.parameters())
+    config = getattr(model, 'config', None)
+    n_layer = getattr(config, 'num_hidden_layers', None) or getattr(config, 'n_layer', 0)
+    hidden = getattr(config, 'hidden_size', None) or getattr(config, 'n_embd', 0)
+    return 6 * n_params + 12 * n_layer * hidden * seq_len
+
+
+class ThroughputCallback(TrainerCallback):
+    """测量步时、吞吐、数据等待、显存峰值和 MFU"""
+
+    def __init__(self, seq_len, peak_tflops=None, padding_ratio=None, num_params=None, metric_prefix='perf/',
+                 stall_threshold=None):
+        self.seq_len = seq_len
+        self.stall_threshold = stall_threshold
+        self.num_params = num_params
+        self.padding_ratio = padding_ratio
+        self.peak_tflops = peak_tflops or detect_peak_tflops()
+        self.metric_prefix = metric_prefix
+        self.flops_per_token = None
+        self._reset_window()
+        self._step_start = None
+        self._last_step_end = None
+        self._tokens_seen = 0
+
+    def _reset_window(self):
+        self.step_times = []
+        self.wait_times = []
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+
+    def _sync(self):
+        # 步时需要包含异步 kernel 的执行时间
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    def on_train_begin(self, args, state, control, model=None, **kwargs):
+        if model is not None:
+            self.flops_per_token = flops_per_token(model, self.seq_len, self.num_params)
+        self._tokens_seen = state.num_input_tokens_seen or 0
+        if state.is_world_process_zero:
+            logger.info(f"ThroughputCallback: {self.flops_per_token or 0:.3e} FLOPs/token, "
+                        f"peak {self.peak_tflops or 'n/a'} TFLOPS/GPU")
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        self._sync()
+        now = time.perf_counter()
+        if self._last_step_end is not None:
+            self.wait_times.append(now - self._last_step_end)
+        self._step_start = now
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if self._step_start is None:
+            return
+        self._sync()
+        now = time.perf_counter()
+        self.step_times.append(now - self._step_start)
+        self._last_step_end = now
+
+    def _all_ranks(self, value, op):
+        """跨 rank 归约一个标量；nccl 需要 GPU 张量，gloo / 单进程在 CPU 上完成"""
+        if not (dist.is_available() and dist.is_initialized()):
+            return value
+        device = 'cuda' if dist.get_backend() == 'nccl' else 'cpu'
+        tensor = torch.tensor([value], dtype=torch.float64, device=device)
+        dist.all_reduce(tensor, op=op)
+        return tensor.item()
+
+    def _peak_memory_gb(self):
+        if torch.cuda.is_available():
+            return (torch.cuda.max_memory_allocated() / 1024 ** 3,
+                    torch.cuda.max_memory_reserved() / 1024 ** 3)
+        # Linux 上 ru_maxrss 单位为 KB
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 ** 2
+        return rss, rss
+
+    def compute_metrics(self, args, state):
+        """汇总当前窗口，返回 {指标名: 值}；所有 rank 都要调用（内部有集合通信）"""
+        world_size = args.world_size
+        times = np.array(self.step_times or [0.0])
+        mean_step = float(times.mean())
+        wait_total = float(np.sum(self.wait_times))
+        elapsed = float(times.sum()) + wait_total
+
+        samples_per_step = args.per_device_train_batch_size * args.gradient_accumulation_steps * world_size
+        steps = len(self.step_times)
+        # include_num_input_tokens_seen 打开时使用真实 token 数（已跨 rank 汇总），否则按序列长度估算
+        tokens_seen = state.num_input_tokens_seen or 0
+        if tokens_seen > self._tokens_seen:
+            tokens = tokens_seen - self._tokens_seen
+        else:
+            tokens = steps * samples_per_step * self.seq_len
+        self._tokens_seen = tokens_seen
+
+        max_step = self._all_ranks(mean_step, dist.ReduceOp.MAX)
+        avg_step = self._all_ranks(mean_step, dist.ReduceOp.SUM) / world_size
+        allocated, reserved = self._peak_memory_gb()
+        allocated = self._all_ranks(allocated, dist.ReduceOp.MAX)
+        reserved = self._all_ranks(reserved, dist.ReduceOp.MAX)
+
+        tokens_per_sec = tokens / elapsed if elapsed > 0 else 0.0
+        samples_per_sec = steps * samples_per_step / elapsed if elapsed > 0 else 0.0
+        metrics = {
+            'step_time_mean': mean_step,
+            'step_time_p50': float(np.percentile(times, 50)),
+            'step_time_p90': float(np.percentile(times, 90)),
+            'step_time_p99': float(np.percentile(times, 99)),
+            'data_wait_frac': wait_total / elapsed if elapsed > 0 else 0.0,
+            'samples_per_sec': samples_per_sec,
+            'samples_per_sec_per_rank': samples_per_sec / world_size,
+            'tokens_per_sec': tokens_per_sec,
+            'tokens_per_sec_per_rank': tokens_per_sec / world_size,
+            'straggler_ratio': max_step / avg_step if avg_step > 0 else 1.0,
+            'peak_mem_allocated_gb': allocated,
+            'peak_mem_reserved_gb': reserved,
+        }
+        if self.padding_ratio is not None:
+            metrics['padding_ratio'] = self.padding_ratio
+            metrics['useful_tokens_per_sec'] = tokens_per_sec * (1.0 - self.padding_ratio)
+        if self.peak_tflops and self.flops_per_token:
+            achieved = tokens_per_sec * self.flops_per_token / world_size
+            metrics['mfu'] = achieved / (self.peak_tflops * 1e12)
+        return {self.metric_prefix + key: value for key, value in metrics.items()}
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        if not self.step_times:
+            return
+        metrics = self.compute_metrics(args, state)
+        self._reset_window()
+        if not state.is_world_process_zero:
+            return
+
+        logger.info("perf @ step %d: %s", state.global_step,
+                    ", ".join(f"{k[len(self.metric_prefix):]}={v:.4g}" for k, v in metrics.items()))
+        self._log_to_mlflow(metrics, state.global_step)
+
+        wait_frac = metrics[self.metric_prefix + 'data_wait_frac']
+        if self.stall_threshold is not None and wait_frac > self.stall_threshold:
+            logger.warning(f"step {state.global_step}: {wait_frac:.1%} 的时间在等待数据（阈值 "
+                           f"{self.stall_threshold:.0%}），训练受输入管线限制，可用 --tune_dataloader 重新调优")
+
+    def _log_to_mlflow(self, metrics, step):
+        """一次 log_batch 写入整组指标；未安装 mlflow 或没有 active run 时只打日志"""
+        try:
+            import mlflow
+            from mlflow.entities import Metric
+        except ImportError:
+            return
+        run = mlflow.active_run()
+        if run is None:
+            return
+        timestamp = int(time.time() * 1000)
+        try:
+            mlflow.tracking.MlflowClient().log_batch(
+                run.info.run_id,
+                metrics=[Metric(key, value, timestamp, step) for key, value in metrics.items()]
+            )
+        except Exception as e:
+            logger.warning(f"Failed to log throughput metrics to MLflow: {e}")
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+二进制 token shard 格式：转换工具 + 内存映射 Dataset
+
+目录结构：
+    <output_dir>/shard_00000.bin ...   扁平的 token 数组（uint16，词表 >= 65536 时为 uint32）
+    <output_dir>/index.json            dtype、tokenizer、EOS、每个 shard 的 token 数
+
+文档按输入顺序以 EOS 分隔首尾相接（与 --sequence_mode pack 相同），训练时按 seq_len 切成不重叠的定长窗口。
+转换过程流式读取输入并在多进程中分词，读取时通过 numpy.memmap 按需换页，内存占用与语料大小无关。
+
+Usage:
+    python token_shards.py --input corpus/*.jsonl --tokenizer gpt2 --output_dir /s3/token-shards/corpus-gpt2
+    python trainer_gpt_ddp.py --token_shards_dir /s3/token-shards/corpus-gpt2 ...
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+INDEX_FILE = "index.json"
+
+# 单个 shard 的 token 数上限（uint16 下约 1 GiB）
+DEFAULT_SHARD_TOKENS = 512 * 1024 * 1024
+
+
+def iter_documents(paths, text_key="text"):
+    """逐行读取 .jsonl（取 text_key 字段）或纯文本（每个非空行一个文档）"""
+    for path in paths:
+        is_jsonl = path.endswith((".jsonl", ".json"))
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if is_jsonl:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    text = json.loads(line).get(text_key) or ""
+                else:
+                    text = line
+                if text.strip():
+                    yield text
+
+
+def iter_chunks(documents, chunk_size):
+    chunk = []
+    for doc in documents:
+        chunk.append(doc)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+_tokenizer = None
+
+
+def _init_worker(tokenizer_name):
+    global _tokenizer
+    # 每个进程单线程分词，并行度由进程数决定
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    from transformers import AutoTokenizer
+    _tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+
+
+def _tokenize_chunk(args):
+    texts, dtype = args
+    ids = _tokenizer(texts, add_special_tokens=False)["input_ids"]
+    eos = _tokenizer.eos_token_id
+    flat = np.fromiter((t for doc in ids for t in (*doc, eos)), dtype=dtype)
+    return flat, len(texts)
+
+
+def convert(paths, tokenizer_name, output_dir, text_key="text", num_proc=None,
+            chunk_size=1000, shard_tokens=DEFAULT_SHARD_TOKENS):
+    """把输入文件转换为 token shard，返回写入的 index"""
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+    dtype = np.uint16 if len(tokenizer) < 2 ** 16 else np.uint32
+    os.makedirs(output_dir, exist_ok=True)
+
+    shards = []
+    current, current_tokens = None, 0
+    total_tokens = total_docs = 0
+    start = time.time()
+
+    def _open_shard():
+        name = f"shard_{len(shards):05d}.bin"
+        shards.append({"path": name, "num_tokens": 0})
+        return open(os.path.join(output_dir, name), "wb")
+
+    # imap 保持输入顺序，转换结果可复现
+    with Pool(num_proc or os.cpu_count(), initializer=_init_worker, initargs=(tokenizer_name,)) as pool:
+        chunks = ((texts, dtype) for texts in iter_chunks(iter_documents(paths, text_key), chunk_size))
+        for n_chunks, (flat, n_docs) in enumerate(pool.imap(_tokenize_chunk, chunks), 1):
+            total_docs += n_docs
+            while len(flat):
+                if current is None:
+                    current, current_tokens = _open_shard(), 0
+                take = min(len(flat), shard_tokens - current_tokens)
+                current.write(flat[:take].tobytes())
+                current_tokens += take
+                shards[-1]["num_tokens"] = current_tokens
+                total_tokens += take
+                flat = flat[take:]
+                if current_tokens >= shard_tokens:
+                    current.close()
+                    current = None
+            if n_chunks % 100 == 0:
+                print(f"📊 {total_docs} docs, {total_tokens} tokens "
+                      f"({total_tokens / max(time.time() - start, 1e-6):.0f} tokens/s)", file=sys.stderr)
+    if current is not None:
+        current.close()
+
+    index = {
+        "dtype": np.dtype(dtype).name,
+        "tokenizer": tokenizer_name,
+        "vocab_size": len(tokenizer),
+        "eos_token_id": tokenizer.eos_token_id,
+        "num_documents": total_docs,
+        "num_tokens": total_tokens,
+        "shards": shards,
+    }
+    # index 最后写入，存在即表示转换完整
+    with open(os.path.join(output_dir, INDEX_FILE), "w") as f:
+        json.dump(index, f, indent=2)
+    print(f"✅ {total_docs} docs, {total_tokens} tokens, {len(shards)} shards -> {output_dir} "
+          f"({time.time() - start:.1f}s)", file=sys.stderr)
+    return index
+
+
+class TokenShardDataset(Dataset):
+    """从 token shard 读取 seq_len 定长窗口（窗口不跨 shard），返回 input_ids / labels
+
+    shard 文件在每个进程（包括 DataLoader worker）内首次访问时才 memmap 打开，不会随 Dataset 被 pickle。
+    world_size > 1 时按 seed 确定性打乱全部窗口后交错切分，各 rank 得到互不重叠、等长的子集；
+    由 Trainer / DistributedSampler 负责分片时保持默认的 world_size=1。
+    """
+
+    def __init__(self, data_dir, seq_len, rank=0, world_size=1, seed=0, shuffle=False):
+        with open(os.path.join(data_dir, INDEX_FILE), "r") as f:
+            self.index = json.load(f)
+        self.data_dir = data_dir
+        self.seq_len = seq_len
+        self.dtype = np.dtype(self.index["dtype"])
+        self._memmaps = {}
+
+        windows = np.array([s["num_tokens"] // seq_len for s in self.index["shards"]], dtype=np.int64)
+        self._window_offsets = np.concatenate([[0], np.cumsum(windows)])
+        num_windows = int(self._window_offsets[-1])
+
+        # 只保存本 rank 的窗口编号（int64，每个窗口 8 字节）
+        order = np.random.default_rng(seed).permutation(num_windows) if shuffle else np.arange(num_windows)
+        per_rank = num_windows // world_size
+        self.windows = order[rank:per_rank * world_size:world_size]
+
+    def __len__(self):
+        return len(self.windows)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_memmaps"] = {}
+        return state
+
+    def _shard(self, shard_idx):
+        if shard_idx not in self._memmaps:
+            shard = self.index["shards"][shard_idx]
+            self._memmaps[shard_idx] = np.memmap(os.path.join(self.data_dir, shard["path"]),
+                                                 dtype=self.dtype, mode="r", shape=(shard["num_tokens"],))
+        return self._memmaps[shard_idx]
+
+    def __getitem__(self, idx):
+        window = int(self.windows[idx])
+        shard_idx = int(np.searchsorted(self._window_offsets, window, side="right")) - 1
+        start = (window - int(self._window_offsets[shard_idx])) * self.seq_len
+        tokens = torch.from_numpy(self._shard(shard_idx)[start:start + self.seq_len].astype(np.int64))
+        return {"input_ids": tokens, "labels": tokens}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Tokenize text / JSONL into memory-mapped token shards")
+    parser.add_argument("--input", nargs="+", required=True, help="输入文件（.jsonl / .json 每行一个 JSON，其它按行读取）")
+    parser.add_argument("--tokenizer", required=True, help="tokenizer 名称或路径")
+    parser.add_argument("--output_dir", required=True)
+    parser.add_argument("--text_key", default="text", help="JSONL 中文本所在的字段")
+    parser.add_argument("--num_proc", type=int, default=None, help="分词进程数，默认为 CPU 核数")
+    parser.add_argument("--chunk_size", type=int, default=1000, help="每个任务包含的文档数")
+    parser.add_argument("--shard_tokens", type=int, default=DEFAULT_SHARD_TOKENS)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    convert(args.input, args.tokenizer, args.output_dir, text_key=args.text_key,
+            num_proc=args.num_proc, chunk_size=args.chunk_size, shard_tokens=args.shard_tokens)
@@ -5,8 +5,12 @@
 """
 
 import os
+import json
+import math
 import torch
 import argparse
+import numpy as np
+from itertools import chain
 from datasets import load_dataset
 from transformers import (
     AutoModelForCausalLM,
@@ -14,6 +18,7 @@ from transformers import (
     TrainingArguments,
     Trainer,
     DataCollatorForLanguageModeling,
+    default_data_collator,
     set_seed
 )
 import logging
@@ -22,6 +27,22 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+try:
+    # 训练镜像中由 docker-build-training-op 提供，用于把 run ID 交给 set_mlflow_tags.py
+    from mlflow_run_id_callback import MlflowRunIdCallback
+except ImportError:
+    MlflowRunIdCallback = None
+
+from throughput_callback import ThroughputCallback
+from dataset_cache import DEFAULT_CACHE_ROOT, cache_key, load_or_build, tokenizer_fingerprint
+from token_shards import TokenShardDataset
+from batch_planner import plan_batch
+from dataloader_tuner import cpus_per_rank, tune_dataloader
+from async_checkpoint import AsyncCheckpointMixin, find_latest_checkpoint, is_fsdp_checkpoint
+from streaming_dataset import (
+    StreamingTextDataset, StreamingTrainer, StreamPositionCallback, restore_stream_position
+)
+
 def parse_args():
     """解析命令行参数"""
     parser = argparse.ArgumentParser()
@@ -32,6 +53,45 @@ def parse_args():
     parser.add_argument("--dataset_config_name", type=str, default="wikitext-2-raw-v1")
     parser.add_argument("--max_context_width", type=int, default=2048)
     parser.add_argument("--train_samples", type=int, default=1000)
+    parser.add_argument("--dataset_cache_dir", type=str, default=DEFAULT_CACHE_ROOT,
+                        help="预处理数据集缓存目录（共享存储），空字符串表示不使用缓存")
+    parser.add_argument("--token_shards_dir", type=str, default="",
+                        help="token_shards.py 生成的 shard 目录；设置后代替 dataset_name 按定长窗口读取全部语料")
+    parser.add_argument("--streaming", action="store_true",
+                        help="流式读取数据集，在 DataLoader worker 中分词打包（需要设置 --max_steps）")
+    parser.add_argument("--streaming_data_files", type=str, nargs="+", default=None,
+                        help="流式模式下的数据文件（例如 dataset_name=json 配合 s3:// 路径）")
+    parser.add_argument("--shuffle_buffer", type=int, default=10000, help="流式模式的 shuffle buffer 大小，0 表示不打乱")
+    parser.add_argument("--resume_from_checkpoint", type=str, default=None,
+                        help="指定恢复的 checkpoint；默认自动选择 output_dir 中最新的完整 checkpoint")
+    parser.add_argument("--no_auto_resume", action="store_true", help="不自动从 output_dir 中的 checkpoint 恢复")
+    parser.add_argument("--checkpoint_mode", type=str, default="async", choices=["async", "sync"],
+                        help="async: 只在训练循环中做设备到主机拷贝，后台线程写入; sync: Trainer 原有的同步保存")
+    parser.add_argument("--sequence_mode", type=str, default="pad", choices=["pad", "pack", "group_by_length"],
+                        help="pad: 按 map 批次补齐; pack: 以 EOS 拼接成 max_context_width 定长块; "
+                             "group_by_length: 不补齐，按长度分组组 batch 后动态补齐")
+    
+    # 并行 / 显存相关参数
+    parser.add_argument("--sharding", type=str, default="ddp", choices=["ddp", "fsdp"],
+                        help="ddp: 每卡完整副本; fsdp: 参数、梯度和优化器状态按卡分片")
+    parser.add_argument("--fsdp_sharding_strategy", type=str, default="full_shard",
+                        choices=["full_shard", "shard_grad_op", "hybrid_shard"])
+    parser.add_argument("--fsdp_cpu_offload", action="store_true", help="FSDP 参数和梯度卸载到 CPU")
+    parser.add_argument("--fsdp_wrap_cls", type=str, default=None,
+                        help="逗号分隔的 auto-wrap 层类名，默认取模型的 _no_split_modules（如 GPT2Block）")
+    parser.add_argument("--activation_checkpointing", action="store_true", help="重算激活以节省显存")
+    parser.add_argument("--mixed_precision", type=str, default="auto", choices=["auto", "fp16", "bf16", "no"],
+                        help="auto: fsdp 在支持时使用 bf16，ddp 使用 fp16（CPU 上不使用混合精度）")
+    
+    # batch 规划参数
+    parser.add_argument("--plan_batch", action="store_true",
+                        help="训练前试跑探测单卡最大 micro-batch，并推出梯度累积步数（覆盖下面两个 batch 参数）")
+    parser.add_argument("--global_batch_size", type=int, default=None,
+                        help="规划时的目标全局 batch（micro-batch × 累积 × 总卡数），不设置时保持 gradient_accumulation_steps")
+    parser.add_argument("--plan_max_batch", type=int, default=256, help="探测的 micro-batch 上限")
+    parser.add_argument("--plan_memory_fraction", type=float, default=0.9, help="探测时允许使用的显存比例")
+    parser.add_argument("--mlflow_tags_file", type=str, default="mlflow-tags.json",
+                        help="torch_process_train_args.py 生成的 tags 文件，规划结果写回其中的 MBS / ACCUM")
     
     # 训练参数
     parser.add_argument("--output_dir", type=str, default="./results")
@@ -45,11 +105,27 @@ def parse_args():
     parser.add_argument("--save_strategy", type=str, default="steps", choices=["no", "epoch", "steps"])
     parser.add_argument("--save_total_limit", type=int, default=2)
     parser.add_argument("--dataloader_num_workers", type=int, default=2)
+    parser.add_argument("--dataloader_prefetch_factor", type=int, default=None)
+    parser.add_argument("--dataloader_persistent_workers", action="store_true")
+    parser.add_argument("--preprocessing_num_workers", type=int, default=None,
+                        help="预处理（分词 / 打包）的进程数，默认为本节点可用 CPU 核数")
+    parser.add_argument("--tune_dataloader", action="store_true",
+                        help="训练前测量不同 worker / prefetch 组合，选出能喂饱 GPU 的最便宜配置（覆盖上面三个 dataloader 参数）")
+    parser.add_argument("--tune_batches", type=int, default=50, help="每个组合测量的 batch 数")
+    parser.add_argument("--tune_headroom", type=float, default=1.2,
+                        help="要求的数据产出速率相对模型消耗速率的余量")
+    parser.add_argument("--data_stall_threshold", type=float, default=0.05,
+                        help="perf/data_wait_frac 超过该值时警告训练受输入管线限制")
     parser.add_argument("--run_name", type=str, default="gpt2_wikitext_ddp_training")
     parser.add_argument("--report_to", type=str, default="mlflow")
+    parser.add_argument("--peak_tflops", type=float, default=None,
+                        help="单卡峰值 TFLOPS，用于计算 MFU（默认按 GPU 型号自动识别）")
     
     return parser.parse_args()
 
+# datasets.map 的默认 batch 大小
+PREPROCESS_ROWS_PER_PROC = 1000
+
 def preprocess_function(examples, tokenizer, max_context_width):
     """预处理数据集"""
     return tokenizer(
@@ -60,9 +136,153 @@ def preprocess_function(examples, tokenizer, max_context_width):
         return_tensors="pt"
     )
 
+def pack_sequences(examples, block_size, eos_token_id):
+    """把文档以 EOS 分隔拼接后切成 block_size 定长块，丢弃末尾不足一块的 token"""
+    concatenated = list(chain.from_iterable(ids + [eos_token_id] for ids in examples["input_ids"]))
+    total_length = len(concatenated) // block_size * block_size
+    blocks = [concatenated[i:i + block_size] for i in range(0, total_length, block_size)]
+    return {
+        "input_ids": blocks,
+        "attention_mask": [[1] * block_size for _ in blocks],
+        "labels": [list(block) for block in blocks],
+    }
+
+def estimate_padding_ratio(lengths, batch_size, widths=None, group_by_length=False, seed=42):
+    """估算训练时 batch 中 padding token 的占比
+
+    lengths 为每条样本的有效 token 数，widths 为样本自身已补齐到的长度（默认等于 lengths）；
+    每个 batch 再被 collator 补齐到 batch 内最长的 width。group_by_length 时模拟
+    LengthGroupedSampler：每 50 个 batch 组成一个 megabatch，在 megabatch 内按长度降序排列。
+    """
+    lengths = np.asarray(lengths)
+    widths = lengths if widths is None else np.asarray(widths)
+    indices = np.random.default_rng(seed).permutation(len(lengths))
+    if group_by_length:
+        megabatch = batch_size * 50
+        indices = np.concatenate([
+            chunk[np.argsort(-widths[chunk], kind="stable")]
+            for chunk in np.array_split(indices, max(1, -(-len(indices) // megabatch)))
+        ])
+    useful = padded = 0
+    for i in range(0, len(indices), batch_size):
+        batch = indices[i:i + batch_size]
+        useful += lengths[batch].sum()
+        padded += widths[batch].max() * len(batch)
+    return 1.0 - useful / padded if padded else 0.0
+
+def without_length_column(collator):
+    """length 列只给 LengthGroupedSampler 使用，送入模型前去掉"""
+    def collate(features):
+        return collator([{k: v for k, v in feature.items() if k != "length"} for feature in features])
+    return collate
+
+def resolve_mixed_precision(args):
+    """把 --mixed_precision auto 解析为实际使用的精度"""
+    if not torch.cuda.is_available():
+        return "no"
+    if args.mixed_precision != "auto":
+        return args.mixed_precision
+    if args.sharding == "fsdp" and torch.cuda.is_bf16_supported():
+        return "bf16"
+    return "fp16"
+
+def record_mixed_precision(path, precision):
+    """把实际使用的精度写回 mlflow-tags.json 的 PARALLEL（生成 tags 文件的节点可能无法判断 GPU 是否支持 bf16）"""
+    if not os.path.exists(path):
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        tags = json.load(f)
+    tags.setdefault("PARALLEL", {})["mixed_precision"] = precision
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(tags, f, indent=2, ensure_ascii=False)
+
+def parallel_training_args(args):
+    """sharding / 精度 / 激活重算对应的 TrainingArguments 参数"""
+    precision = resolve_mixed_precision(args)
+    kwargs = {"fp16": precision == "fp16", "bf16": precision == "bf16"}
+    
+    if args.sharding == "ddp":
+        kwargs["ddp_find_unused_parameters"] = False
+        if args.activation_checkpointing:
+            kwargs["gradient_checkpointing"] = True
+            # 非 reentrant 实现与 DDP 的 find_unused_parameters=False 兼容
+            kwargs["gradient_checkpointing_kwargs"] = {"use_reentrant": False}
+        return kwargs
+    
+    fsdp = [args.fsdp_sharding_strategy, "auto_wrap"]
+    if args.fsdp_cpu_offload:
+        fsdp.append("offload")
+    kwargs["fsdp"] = " ".join(fsdp)
+    kwargs["fsdp_config"] = {
+        "backward_prefetch": "backward_pre",
+        "use_orig_params": True,
+        # rank 0 读取权重后广播，其余 rank 在 meta 设备上创建模型，避免每个进程各占一份 CPU 内存
+        "cpu_ram_efficient_loading": True,
+        "sync_module_states": True,
+        # FSDP 下由 fsdp_config 负责激活重算，不能同时打开 gradient_checkpointing
+        "activation_checkpointing": args.activation_checkpointing,
+        # 中间 checkpoint 按分片保存，最终模型另行汇总为完整权重
+        "state_dict_type": "SHARDED_STATE_DICT",
+    }
+    # 未指定时 accelerate 按模型的 _no_split_modules（如 GPT2Block）包装
+    if args.fsdp_wrap_cls:
+        kwargs["fsdp_config"]["transformer_layer_cls_to_wrap"] = args.fsdp_wrap_cls.split(",")
+    return kwargs
+
+def build_train_dataset(args, tokenizer):
+    """加载、过滤、分词（可选打包）并选取 train_samples 条训练样本，只处理 train split"""
+    logger.info("加载数据集...")
+    dataset = load_dataset(args.dataset_name, args.dataset_config_name, split="train")
+    
+    # 过滤空文本
+    dataset = dataset.filter(lambda example: len(example["text"].strip()) > 0)
+    
+    # 预处理数据集
+    if args.sequence_mode == "pad":
+        def tokenize_function(examples):
+            return preprocess_function(examples, tokenizer, args.max_context_width)
+    elif args.sequence_mode == "pack":
+        # 不截断，完整文档参与拼接
+        def tokenize_function(examples):
+            return tokenizer(examples["text"])
+    else:
+        # 逐条截断、不补齐，先选样再分词结果相同，只处理需要的样本
+        dataset = dataset.select(range(min(args.train_samples, len(dataset))))
+        def tokenize_function(examples):
+            tokenized = tokenizer(examples["text"], truncation=True, max_length=args.max_context_width)
+            tokenized["length"] = [len(ids) for ids in tokenized["input_ids"]]
+            return tokenized
+    
+    # 预处理只在 local rank 0 上执行，可以使用本节点的全部 CPU；每个进程至少分到一个 map batch
+    num_proc = args.preprocessing_num_workers or cpus_per_rank() * int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+    num_proc = min(num_proc, math.ceil(len(dataset) / PREPROCESS_ROWS_PER_PROC))
+    num_proc = num_proc if num_proc > 1 else None
+    tokenized_dataset = dataset.map(
+        tokenize_function,
+        batched=True,
+        num_proc=num_proc,
+        remove_columns=dataset.column_names,
+    )
+    
+    if args.sequence_mode == "pack":
+        # 每个 batch 丢弃各自末尾不足一块的 token，多进程分片会改变 batch 边界，
+        # 因此打包固定单进程执行，结果与 num_proc 无关（打包只是列表拼接，远比分词便宜）
+        tokenized_dataset = tokenized_dataset.map(
+            pack_sequences,
+            batched=True,
+            batch_size=PREPROCESS_ROWS_PER_PROC,
+            fn_kwargs={"block_size": args.max_context_width, "eos_token_id": tokenizer.eos_token_id},
+            remove_columns=tokenized_dataset.column_names,
+        )
+    
+    # 选择指定数量的样本
+    return tokenized_dataset.select(range(min(args.train_samples, len(tokenized_dataset))))
+
 def main():
     # 解析参数
     args = parse_args()
+    if args.streaming and args.max_steps <= 0:
+        raise ValueError("--streaming 模式的数据集没有长度，必须设置 --max_steps")
     
     # 设置随机种子
     set_seed(42)
@@ -75,42 +295,12 @@ def main():
     logger.info(f"使用模型: {args.model_name_or_path}")
     logger.info(f"使用数据集: {args.dataset_name}/{args.dataset_config_name}")
     
-    # 加载模型和分词器
+    # 加载分词器
     tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path)
-    model = AutoModelForCausalLM.from_pretrained(args.model_name_or_path)
     
     # 设置pad token
     if tokenizer.pad_token is None:
         tokenizer.pad_token = tokenizer.eos_token
-        model.config.pad_token_id = tokenizer.pad_token_id
-    
-    # 加载数据集
-    logger.info("加载数据集...")
-    dataset = load_dataset(args.dataset_name, args.dataset_config_name)
-    
-    # 过滤空文本
-    dataset = dataset.filter(lambda example: len(example["text"].strip()) > 0)
-    
-    # 预处理数据集
-    def tokenize_function(examples):
-        return preprocess_function(examples, tokenizer, args.max_context_width)
-    
-    tokenized_dataset = dataset.map(
-        tokenize_function,
-        batched=True,
-        remove_columns=dataset["train"].column_names,
-    )
-    
-    # 选择指定数量的样本
-    train_dataset = tokenized_dataset["train"].select(range(min(args.train_samples, len(tokenized_dataset["train"]))))
-    
-    logger.info(f"训练样本数: {len(train_dataset)}")
-    
-    # 数据整理器
-    data_collator = DataCollatorForLanguageModeling(
-        tokenizer=tokenizer,
-        mlm=False,
-    )
     
     # TrainingArguments配置
     training_args = TrainingArguments(
@@ -140,28 +330,170 @@ def main():
         logging_dir="./logs",
         logging_steps=10,
         ddp_backend="nccl" if torch.cuda.is_available() else "gloo",
-        ddp_find_unused_parameters=False,
         dataloader_pin_memory=True,
-        fp16=torch.cuda.is_available(),
+        dataloader_prefetch_factor=args.dataloader_prefetch_factor,
+        dataloader_persistent_workers=args.dataloader_persistent_workers,
+        **parallel_training_args(args),
         seed=42,
         remove_unused_columns=False,
+        include_num_input_tokens_seen=True,
+        group_by_length=args.sequence_mode == "group_by_length" and not (args.token_shards_dir or args.streaming),
+        length_column_name="length",
+        # 流式数据集自己跳过已训练的数据，不让 Trainer 通过重新迭代来跳过
+        ignore_data_skip=args.streaming,
         push_to_hub=False,
     )
     
+    # 加载模型：FSDP 的 TrainingArguments 会设置低内存加载所需的环境变量，因此在其之后加载
+    model = AutoModelForCausalLM.from_pretrained(args.model_name_or_path)
+    model.config.pad_token_id = tokenizer.pad_token_id
+    if training_args.local_process_index == 0:
+        record_mixed_precision(args.mlflow_tags_file, resolve_mixed_precision(args))
+    logger.info(f"并行方式: {args.sharding}, 精度: {resolve_mixed_precision(args)}, "
+                f"激活重算: {args.activation_checkpointing}, auto-wrap: "
+                f"{args.fsdp_wrap_cls or getattr(model, '_no_split_modules', None)}")
+    
+    if args.plan_batch:
+        if args.sharding == "fsdp":
+            # 分片后的显存占用取决于包装结果，需要在 Trainer 内才能准确试跑，这里保持用户指定的值
+            logger.warning("--plan_batch 目前只支持 ddp，FSDP 模式使用指定的 batch 参数")
+        else:
+            if args.activation_checkpointing:
+                model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+            micro_batch, accumulation, _ = plan_batch(
+                model, args.max_context_width, resolve_mixed_precision(args),
+                world_size=training_args.world_size,
+                # 每个节点的 post_train 读取本节点的 mlflow-tags.json，由各节点 local rank 0 写入
+                is_main_process=training_args.local_process_index == 0,
+                global_batch_size=args.global_batch_size,
+                accumulation=args.gradient_accumulation_steps,
+                max_batch=args.plan_max_batch,
+                memory_fraction=args.plan_memory_fraction,
+                tags_file=args.mlflow_tags_file,
+            )
+            args.per_device_train_batch_size = training_args.per_device_train_batch_size = micro_batch
+            args.gradient_accumulation_steps = training_args.gradient_accumulation_steps = accumulation
+    
+    # 节点替换后重新拉起时从最新的完整 checkpoint 继续
+    resume_checkpoint = args.resume_from_checkpoint
+    if resume_checkpoint is None and not args.no_auto_resume:
+        resume_checkpoint = find_latest_checkpoint(args.output_dir)
+    if resume_checkpoint:
+        # FSDP 分片保存的 checkpoint 只能在 FSDP 下加载，反之亦然；不一致时 Trainer 加载失败，这里提前给出原因
+        saved_sharding = "fsdp" if is_fsdp_checkpoint(resume_checkpoint) else "ddp"
+        if saved_sharding != args.sharding:
+            raise ValueError(f"checkpoint {resume_checkpoint} 由 --sharding {saved_sharding} 保存，"
+                             f"当前为 --sharding {args.sharding}，无法恢复；请保持 --sharding 一致或使用 --no_auto_resume")
+        logger.info(f"从 checkpoint 恢复: {resume_checkpoint}")
+    
+    # 已过滤、分词、选样的训练集；配置了缓存目录时按内容寻址复用
+    # local rank 0 先执行（构建或加载缓存），其余 rank 在 barrier 之后直接内存映射缓存
+    with training_args.main_process_first(local=True, desc="train dataset preprocessing"):
+        if args.streaming:
+            # 只创建数据流的描述，真正的读取和分词发生在训练开始后的 DataLoader worker 中
+            train_dataset = StreamingTextDataset(
+                args.dataset_name, args.dataset_config_name, tokenizer, args.max_context_width,
+                data_files=args.streaming_data_files,
+                rank=training_args.process_index,
+                world_size=training_args.world_size,
+                batch_size=args.per_device_train_batch_size,
+                shuffle_buffer=args.shuffle_buffer,
+                seed=training_args.seed,
+            )
+            if resume_checkpoint:
+                restore_stream_position(train_dataset, resume_checkpoint, args.dataloader_num_workers)
+        elif args.token_shards_dir:
+            # 窗口的打乱和跨 rank 分配由 Trainer 的 sampler 完成（按 seed 确定），Dataset 保持完整视图
+            train_dataset = TokenShardDataset(args.token_shards_dir, args.max_context_width)
+        elif args.dataset_cache_dir:
+            key = cache_key(
+                dataset_name=args.dataset_name,
+                dataset_config_name=args.dataset_config_name,
+                tokenizer=tokenizer_fingerprint(tokenizer),
+                max_context_width=args.max_context_width,
+                sequence_mode=args.sequence_mode,
+                train_samples=args.train_samples,
+            )
+            train_dataset = load_or_build(
+                args.dataset_cache_dir, key, lambda: build_train_dataset(args, tokenizer),
+                description=f"{args.dataset_name}/{args.dataset_config_name} {args.model_name_or_path} "
+                            f"{args.sequence_mode} {args.max_context_width}"
+            )
+        else:
+            train_dataset = build_train_dataset(args, tokenizer)
+    
+    if not args.streaming:
+        logger.info(f"训练样本数: {len(train_dataset)} (sequence_mode={args.sequence_mode})")
+    
+    # 数据整理器
+    if args.streaming or args.token_shards_dir or args.sequence_mode == "pack":
+        # 定长块无需补齐；pad_token 与 EOS 相同，DataCollatorForLanguageModeling 会把 EOS 分隔符的 label 屏蔽掉
+        data_collator = default_data_collator
+        padding_ratio = 0.0
+    else:
+        data_collator = DataCollatorForLanguageModeling(
+            tokenizer=tokenizer,
+            mlm=False,
+        )
+        if args.sequence_mode == "pad":
+            masks = train_dataset["attention_mask"]
+            padding_ratio = estimate_padding_ratio([sum(m) for m in masks], args.per_device_train_batch_size,
+                                                   widths=[len(m) for m in masks])
+        else:
+            data_collator = without_length_column(data_collator)
+            padding_ratio = estimate_padding_ratio(train_dataset["length"], args.per_device_train_batch_size,
+                                                   group_by_length=True)
+    logger.info(f"预计 padding 占比: {padding_ratio:.1%}")
+    
+    if args.tune_dataloader:
+        if args.streaming:
+            # 流式数据集按 worker 切分数据流，worker 数变化后无法恢复数据流位置
+            logger.warning("--tune_dataloader 不支持 --streaming，使用指定的 dataloader 参数")
+        else:
+            setting = tune_dataloader(
+                train_dataset, data_collator, args.per_device_train_batch_size,
+                # FSDP 下模型在 Trainer 内才分片，不在这里试跑
+                model=model if args.sharding == "ddp" else None,
+                precision=resolve_mixed_precision(args),
+                world_size=training_args.world_size,
+                num_batches=args.tune_batches,
+                headroom=args.tune_headroom,
+                report_dir=args.output_dir,
+                is_main_process=training_args.should_save,
+            )
+            training_args.dataloader_num_workers = setting["num_workers"]
+            training_args.dataloader_prefetch_factor = setting["prefetch_factor"]
+            training_args.dataloader_persistent_workers = setting["persistent_workers"]
+    
+    callbacks = [ThroughputCallback(seq_len=args.max_context_width, peak_tflops=args.peak_tflops,
+                                    padding_ratio=padding_ratio, stall_threshold=args.data_stall_threshold,
+                                    num_params=sum(p.numel() for p in model.parameters()))]
+    if MlflowRunIdCallback is not None and "mlflow" in args.report_to:
+        callbacks.append(MlflowRunIdCallback())
+    if args.streaming:
+        callbacks.append(StreamPositionCallback(train_dataset, args.dataloader_num_workers))
+    
     # 创建Trainer
-    trainer = Trainer(
+    trainer_cls = StreamingTrainer if args.streaming else Trainer
+    if args.checkpoint_mode == "async":
+        trainer_cls = type(f"Async{trainer_cls.__name__}", (AsyncCheckpointMixin, trainer_cls), {})
+    trainer = trainer_cls(
         model=model,
         args=training_args,
         train_dataset=train_dataset,
         data_collator=data_collator,
         tokenizer=tokenizer,
+        callbacks=callbacks,
     )
     
     # 开始训练
     logger.info("开始训练...")
-    train_result = trainer.train()
+    train_result = trainer.train(resume_from_checkpoint=resume_checkpoint)
     
     # 保存最终模型
+    if trainer.is_fsdp_enabled:
+        # 汇总为完整权重，最终模型可以直接用 from_pretrained 加载
+        trainer.accelerator.state.fsdp_plugin.set_state_dict_type("FULL_STATE_DICT")
     trainer.save_model(f"{args.output_dir}/final_model")
     tokenizer.save_pretrained(f"{args.output_dir}/final_model")
 
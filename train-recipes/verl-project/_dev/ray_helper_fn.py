@@ -7,12 +7,16 @@ import json
 import sys
 
 class RayHelper():
-    def __init__(self, ray_port:str="6379", redis_pass:str="redis_password"):
+    def __init__(self, ray_port:str="6379", redis_pass:str="redis_password",
+                 head_timeout:int=600, join_timeout:int=600, expected_gpus:int=None):
         self.ray_port = ray_port
         self.redis_pass = redis_pass
+        self.head_timeout = head_timeout
+        self.join_timeout = join_timeout
         self.resource_config = self.get_resource_config()
         self.master_host = self.get_gpu_host()
         self.n_hosts = len(self.resource_config["hosts"])
+        self.expected_gpus = expected_gpus if expected_gpus is not None else self.get_expected_gpus()
         
     @staticmethod
     def get_gpu_host():
@@ -31,6 +35,21 @@ class RayHelper():
         return master_host
         
         
+    @staticmethod
+    def get_expected_gpus():
+        """gpu_group 的主机数 × 每台 GPU 数（SM_NUM_GPUS），可用 RAY_EXPECTED_GPUS 覆盖"""
+        if os.environ.get("RAY_EXPECTED_GPUS"):
+            return int(os.environ["RAY_EXPECTED_GPUS"])
+        if not os.environ.get("SM_NUM_GPUS"):
+            print("WARNING: neither RAY_EXPECTED_GPUS nor SM_NUM_GPUS is set, "
+                  "only the node count is checked when waiting for workers")
+            return 0
+        gpus_per_host = int(os.environ["SM_NUM_GPUS"])
+        config = json.loads(os.environ.get("SM_RESOURCE_CONFIG"))
+        gpu_hosts = sum(len(group['hosts']) for group in config['instance_groups']
+                        if group['instance_group_name'] == 'gpu_group')
+        return gpu_hosts * gpus_per_host
+    
     @staticmethod
     def get_resource_config():
         return dict(current_host = os.environ.get("SM_CURRENT_HOST"),
@@ -70,24 +89,120 @@ class RayHelper():
                 
             print('--- ...start the head node')
             output = subprocess.run(['ray', 'start', '--head',  '--port', self.ray_port, '--redis-password', self.redis_pass, '--dashboard-host', '0.0.0.0', '--dashboard-port', '8265'], stdout=subprocess.PIPE)
-            time.sleep(120) # wait all worker nodes to join the cluster
+            if output.returncode != 0:
+                raise Exception(f"ray start --head failed with exit code {output.returncode}")
+            # 以 driver 身份连接，确认所有节点加入后断开，训练脚本再自行 ray.init
+            ray.init(address=f"{self.master_ip}:{self.ray_port}")
+            try:
+                self._wait_for_workers(timeout=self.join_timeout)
+            finally:
+                ray.shutdown()
            
         else:
-            time.sleep(20) # wait for the master node be ready
+            self._wait_for_head(timeout=self.head_timeout)
             print('--- ...add worker node')
-            output = subprocess.run(['ray', 'start', f'--address={self.master_ip}:{self.ray_port}', '--redis-password', self.redis_pass, '--block'], stdout=subprocess.PIPE)
+            self._join_cluster(timeout=self.head_timeout)
+            self._block_until_head_exits()
             sys.exit(0)  
-            
     
-    def _wait_for_workers(self, timeout=120):
-        print(f"Waiting {timeout} seconds for {self.n_hosts} nodes to join")
-        while len(ray.nodes()) < self.n_hosts:
-            print(f"{len(ray.nodes())} nodes connected to cluster")
-            time.sleep(5)
-            timeout-=5
-            if timeout==0:
-                raise Exception("Max timeout for nodes to join exceeded")
-        time.sleep(5)
-        print(f"{len(ray.nodes())} nodes connected to cluster")
+    def _wait_for_head(self, timeout=600):
+        """轮询 head 的 GCS 端口，可连接后立即返回；退避间隔从 0.5s 倍增到 10s
+
+        端口可连接只说明 head 进程已监听，GCS 不一定已能处理注册请求，因此 _join_cluster 失败时会重试。
+        """
+        deadline = time.monotonic() + timeout
+        start = time.monotonic()
+        delay = 0.5
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                with socket.create_connection((self.master_ip, int(self.ray_port)), timeout=2):
+                    print(f"--- head GCS {self.master_ip}:{self.ray_port} reachable after {time.monotonic() - start:.1f}s")
+                    return
+            except OSError as e:
+                error = e
+            if time.monotonic() + delay > deadline:
+                raise Exception(
+                    f"Head GCS {self.master_ip}:{self.ray_port} not reachable within {timeout}s "
+                    f"({attempts} attempts, last error: {error})"
+                )
+            time.sleep(delay)
+            delay = min(delay * 2, 10)
+    
+    def _join_cluster(self, timeout=600):
+        """ray start --address 失败时清理本机残留的 ray 进程后退避重试，间隔从 2s 倍增到 30s"""
+        deadline = time.monotonic() + timeout
+        delay = 2
+        attempts = 0
+        while True:
+            attempts += 1
+            output = subprocess.run(['ray', 'start', f'--address={self.master_ip}:{self.ray_port}', '--redis-password', self.redis_pass], stdout=subprocess.PIPE)
+            if output.returncode == 0:
+                print(f"--- joined cluster at {self.master_ip}:{self.ray_port} after {attempts} attempts")
+                return
+            if time.monotonic() + delay > deadline:
+                raise Exception(
+                    f"ray start --address={self.master_ip}:{self.ray_port} failed with exit code "
+                    f"{output.returncode} ({attempts} attempts within {timeout}s)"
+                )
+            print(f"--- ray start --address failed with exit code {output.returncode}, retrying in {delay}s")
+            subprocess.run(['ray', 'stop', '--force'], stdout=subprocess.PIPE)
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
+    
+    def _block_until_head_exits(self, poll_interval=30, max_failures=3):
+        """代替 ray start --block：head 的 GCS 端口连续 max_failures 次不可连接时认为训练已结束"""
+        failures = 0
+        while failures < max_failures:
+            time.sleep(poll_interval)
+            try:
+                with socket.create_connection((self.master_ip, int(self.ray_port)), timeout=5):
+                    failures = 0
+            except OSError:
+                failures += 1
+        print(f"--- head {self.master_ip}:{self.ray_port} is gone, worker exiting")
+    
+    def _cluster_report(self):
+        nodes = ray.nodes()
+        alive = [n for n in nodes if n["Alive"]]
+        gpus = sum(n["Resources"].get("GPU", 0) for n in alive)
+        return nodes, alive, int(gpus)
+    
+    def _missing_hosts(self, alive):
+        """按 IP 找出尚未加入集群的主机"""
+        alive_ips = {n["NodeManagerAddress"] for n in alive}
+        missing = []
+        for host in self.resource_config["hosts"]:
+            try:
+                ip = socket.gethostbyname(host)
+            except OSError:
+                ip = None
+            if ip not in alive_ips:
+                missing.append(f"{host}({ip or 'unresolved'})")
+        return missing
+    
+    def _wait_for_workers(self, timeout=600, poll_interval=2):
+        """等待 ray.nodes() 报告预期数量的存活节点和 GPU，超时则报告缺少的主机并抛出异常"""
+        print(f"Waiting up to {timeout}s for {self.n_hosts} nodes / {self.expected_gpus} GPUs to join")
+        start = time.monotonic()
+        deadline = start + timeout
+        last = None
+        while True:
+            nodes, alive, gpus = self._cluster_report()
+            if len(alive) >= self.n_hosts and gpus >= self.expected_gpus:
+                print(f"{len(alive)} nodes / {gpus} GPUs connected to cluster after {time.monotonic() - start:.1f}s")
+                return
+            if (len(alive), gpus) != last:
+                print(f"{len(alive)}/{self.n_hosts} nodes, {gpus}/{self.expected_gpus} GPUs connected to cluster")
+                last = (len(alive), gpus)
+            if time.monotonic() >= deadline:
+                dead = [n["NodeManagerAddress"] for n in nodes if not n["Alive"]]
+                raise Exception(
+                    f"Max timeout for nodes to join exceeded ({timeout}s): "
+                    f"{len(alive)}/{self.n_hosts} nodes alive, {gpus}/{self.expected_gpus} GPUs; "
+                    f"missing hosts: {self._missing_hosts(alive) or 'none'}; dead nodes: {dead or 'none'}"
+                )
+            time.sleep(poll_interval)
 
         
\ No newline at end of file
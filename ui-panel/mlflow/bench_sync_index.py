@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+跨账户同步重复检测 Benchmark：每个 run 单独 search_runs vs 一次性加载 source_run_id 索引
+
+Usage:
+    python bench_sync_index.py --root /tmp/mlflow-sync-bench --runs 10000 --sample 200
+
+在本地 file-store 替身中创建一个包含 --runs 个已同步 run（带 source_run_id tag）的目标实验，
+然后分别测量两种重复检测方式。逐个查询的方式只在 --sample 个 run 上测量并按比例外推。
+"""
+
+import sys
+import time
+import uuid
+import argparse
+
+from mlflow.tracking import MlflowClient
+
+from cross_account_sync import load_synced_index
+from local_mlflow_standin import populate_standin
+
+
+def prepare_target(client, experiment_name, n_runs):
+    """创建（或复用）包含 n_runs 个已同步 run 的目标实验，返回 (experiment_id, source_run_ids)"""
+    experiment = client.get_experiment_by_name(experiment_name)
+    experiment_id = experiment.experiment_id if experiment else client.create_experiment(experiment_name)
+
+    source_ids = list(load_synced_index(client, experiment_id))
+    for _ in range(n_runs - len(source_ids)):
+        source_id = uuid.uuid4().hex
+        run = client.create_run(experiment_id, tags={'source_run_id': source_id})
+        client.set_terminated(run.info.run_id)
+        source_ids.append(source_id)
+    return experiment_id, source_ids[:n_runs]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark duplicate detection for cross-account sync')
+    parser.add_argument('--root', default='/tmp/mlflow-sync-bench')
+    parser.add_argument('--runs', type=int, default=10000)
+    parser.add_argument('--sample', type=int, default=200, help='逐个查询方式测量的 run 数')
+    args = parser.parse_args()
+
+    tracking_uri = populate_standin(args.root, experiments=0)
+    client = MlflowClient(tracking_uri=tracking_uri)
+
+    start = time.perf_counter()
+    experiment_id, source_ids = prepare_target(client, 'sync-index-bench', args.runs)
+    print(f"📊 目标实验准备完成: {len(source_ids)} runs ({time.perf_counter() - start:.1f}s)", file=sys.stderr)
+
+    # 方式一：原实现，每个 source run 一次 search_runs
+    sample = source_ids[:args.sample]
+    start = time.perf_counter()
+    for source_id in sample:
+        client.search_runs(experiment_ids=[experiment_id], filter_string=f"tags.source_run_id = '{source_id}'")
+    per_run = time.perf_counter() - start
+    projected = per_run * len(source_ids) / max(len(sample), 1)
+    print(f"per-run search: {per_run:.2f}s for {len(sample)} runs, projected {projected:.1f}s for {len(source_ids)} runs")
+
+    # 方式二：一次性加载索引，所有判断在内存中完成
+    start = time.perf_counter()
+    index = load_synced_index(client, experiment_id)
+    hits = sum(1 for source_id in source_ids if source_id in index)
+    indexed = time.perf_counter() - start
+    print(f"index load:     {indexed:.2f}s for {len(source_ids)} runs ({hits} hits)")
+    print(f"speedup:        {projected / max(indexed, 1e-9):.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+run 记录转换 Benchmark：列式实现 vs 原 iterrows 实现
+
+Usage:
+    python bench_transform_runs.py --rows 100000 --columns 300 --legacy-rows 2000
+
+原实现在 10 万行上要跑很久，默认只在 --legacy-rows 行上测量并按行数线性外推。
+"""
+
+import sys
+import time
+import argparse
+import tracemalloc
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+from get_training_history import _runs_to_records
+
+
+def legacy_runs_to_records(exp, runs):
+    """原 get_training_history() 中的逐行转换逻辑，仅用于对比"""
+    records = []
+    metric_columns = [col for col in runs.columns if col.startswith('metrics.')]
+    param_columns = [col for col in runs.columns if col.startswith('params.')]
+
+    for _, run in runs.iterrows():
+        run_data = {
+            'experiment_name': exp.name,
+            'experiment_id': exp.experiment_id,
+            'run_id': run['run_id'],
+            'run_name': run.get('tags.mlflow.runName', 'N/A'),
+            'status': run['status'],
+            'start_time': run['start_time'].isoformat() if pd.notna(run['start_time']) else None,
+            'end_time': run['end_time'].isoformat() if pd.notna(run['end_time']) else None,
+            'duration': None,
+            'metrics': {},
+            'params': {},
+            'tags': {}
+        }
+        if pd.notna(run['start_time']) and pd.notna(run['end_time']):
+            run_data['duration'] = str(run['end_time'] - run['start_time'])
+        for metric_col in metric_columns:
+            metric_value = run[metric_col]
+            if pd.notna(metric_value):
+                run_data['metrics'][metric_col.replace('metrics.', '')] = float(metric_value)
+        for param_col in param_columns:
+            param_value = run[param_col]
+            if pd.notna(param_value):
+                run_data['params'][param_col.replace('params.', '')] = str(param_value)
+        tag_columns = [col for col in runs.columns if col.startswith('tags.')]
+        for tag_col in tag_columns:
+            tag_value = run[tag_col]
+            if pd.notna(tag_value):
+                run_data['tags'][tag_col.replace('tags.', '')] = str(tag_value)
+        records.append(run_data)
+    return records
+
+
+def make_frame(n_rows, n_columns, density, seed=0):
+    """生成与 mlflow.search_runs 结构一致的稀疏 DataFrame，metrics/params/tags 各占三分之一列"""
+    rng = np.random.default_rng(seed)
+    per_group = max(n_columns // 3, 1)
+
+    start_ms = 1_700_000_000_000 + rng.integers(0, 10 ** 9, n_rows)
+    # 部分时间落在整秒上，覆盖 isoformat() 省略小数部分的情况
+    start_ms[::7] -= start_ms[::7] % 1000
+    end_ms = start_ms + rng.integers(60_000, 36_000_000, n_rows)
+    data = {
+        'run_id': [f'{i:032x}' for i in range(n_rows)],
+        'experiment_id': '1',
+        'status': rng.choice(['FINISHED', 'RUNNING', 'FAILED'], n_rows),
+        'start_time': pd.to_datetime(start_ms, unit='ms', utc=True),
+        'end_time': pd.to_datetime(end_ms, unit='ms', utc=True),
+    }
+
+    for j in range(per_group):
+        values = rng.random(n_rows)
+        values[rng.random(n_rows) > density] = np.nan
+        data[f'metrics.metric_{j}'] = values
+
+    vocabulary = np.array([f'value_{k}' for k in range(64)], dtype=object)
+    for group in ('params', 'tags'):
+        for j in range(per_group):
+            values = vocabulary[rng.integers(0, len(vocabulary), n_rows)].copy()
+            values[rng.random(n_rows) > density] = None
+            data[f'{group}.{group[:-1]}_{j}'] = values
+    data['tags.mlflow.runName'] = [f'run-{i}' for i in range(n_rows)]
+
+    return pd.DataFrame(data)
+
+
+def measure(fn, *args):
+    """返回 (结果, 耗时秒, 峰值 Python 内存 MB)"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn(*args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak / (1024 * 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark run record transformation')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--columns', type=int, default=300)
+    parser.add_argument('--density', type=float, default=0.5, help='非空单元比例')
+    parser.add_argument('--legacy-rows', type=int, default=2000, help='原实现测量的行数，0 表示跳过')
+    args = parser.parse_args()
+
+    exp = SimpleNamespace(name='bench', experiment_id='1')
+    frame = make_frame(args.rows, args.columns, args.density)
+    print(f"📊 合成数据: {frame.shape[0]} rows × {frame.shape[1]} columns, "
+          f"{frame.memory_usage(deep=True).sum() / 1024 / 1024:.1f} MB", file=sys.stderr)
+
+    records, elapsed, peak = measure(_runs_to_records, exp, frame)
+    print(f"columnar: {elapsed:.2f}s, peak {peak:.1f} MB, {len(records) / elapsed:,.0f} runs/s")
+
+    if args.legacy_rows > 0:
+        sample = frame.iloc[:args.legacy_rows]
+        legacy, legacy_elapsed, legacy_peak = measure(legacy_runs_to_records, exp, sample)
+        projected = legacy_elapsed * len(frame) / len(sample)
+        print(f"legacy:   {legacy_elapsed:.2f}s on {len(sample)} rows, peak {legacy_peak:.1f} MB, "
+              f"projected {projected:.1f}s for {len(frame)} rows")
+        print(f"speedup:  {projected / elapsed:.1f}x")
+
+        # 校验两种实现对时间 / metrics / params / tags 的结果一致
+        fields = ('start_time', 'end_time', 'duration', 'metrics', 'params', 'tags')
+        for new, old in zip(records, legacy):
+            if any(new[field] != old[field] for field in fields):
+                print(f"❌ 结果不一致: run {new['run_id']}", file=sys.stderr)
+                sys.exit(1)
+        print("✅ 列式实现与原实现结果一致", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
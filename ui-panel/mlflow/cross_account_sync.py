@@ -5,160 +5,779 @@ MLflow Cross-Account Experiment Sync Tool
 
 Usage:
     python cross_account_sync.py --config-file config.json --experiment-name hz-torchrecipe-1
+    python cross_account_sync.py --config-file config.json --experiment-name exp-a exp-b --max-workers 4
+    python cross_account_sync.py --config-file config.json --experiment-pattern 'team-*'
+    python cross_account_sync.py --config-file config.json --all-experiments
+    python cross_account_sync.py --config-file config.json --experiment-pattern 'team-*' --watch --interval 60
 """
 
-import mlflow
-import mlflow.tracking
 import boto3
 import argparse
 import os
 import sys
 import json
+import time
+import signal
+import fnmatch
+import threading
+import hashlib
+import tempfile
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from mlflow.entities import Metric, Param, RunTag
+from mlflow.tracking import MlflowClient
+
+from history_store import changed_since_filters
+from run_fetcher import latest_metrics, search_all_experiments, search_all_runs
 
 def load_config(config_file):
     """加载配置文件"""
     with open(config_file, 'r') as f:
         return json.load(f)
 
+class RoleCredentials:
+    """跨账户角色凭证，在过期前自动重新 assume role
+
+    sagemaker-mlflow 的 SigV4 签名和 S3 artifact 访问都从默认凭证链（环境变量）读取凭证，
+    因此刷新后写回 os.environ。STS client 在修改环境变量之前创建，始终用原始凭证续期，
+    不会变成角色链式调用。
+    """
+
+    def __init__(self, role_arn, duration_seconds=3600, refresh_margin_seconds=600):
+        self.role_arn = role_arn
+        self.duration_seconds = duration_seconds
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self.expiration = None
+        self._sts = boto3.Session().client('sts')
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._refresher = None
+
+    def refresh(self):
+        """assume role 并把临时凭证写入环境变量"""
+        with self._lock:
+            response = self._sts.assume_role(
+                RoleArn=self.role_arn,
+                RoleSessionName=f'cross-acct-mlflow-sync-{datetime.now().strftime("%Y%m%d%H%M%S")}',
+                DurationSeconds=self.duration_seconds
+            )
+            
+            creds = response['Credentials']
+            os.environ['AWS_ACCESS_KEY_ID'] = creds['AccessKeyId']
+            os.environ['AWS_SECRET_ACCESS_KEY'] = creds['SecretAccessKey']
+            os.environ['AWS_SESSION_TOKEN'] = creds['SessionToken']
+            self.expiration = creds['Expiration'].timestamp()
+            print(f"🔑 Assumed role {self.role_arn}, credentials valid until {creds['Expiration'].isoformat()}")
+
+    def seconds_left(self):
+        return float('-inf') if self.expiration is None else self.expiration - time.time()
+
+    def ensure_fresh(self):
+        """剩余有效期不足 refresh_margin_seconds 时立即刷新"""
+        if self.seconds_left() < self.refresh_margin_seconds:
+            self.refresh()
+
+    def start_auto_refresh(self):
+        """首次 assume role，并启动后台线程在过期前续期"""
+        self.ensure_fresh()
+
+        def _loop():
+            while not self._stop.wait(max(self.seconds_left() - self.refresh_margin_seconds, 30)):
+                try:
+                    self.ensure_fresh()
+                except Exception as e:
+                    print(f"⚠️ Failed to refresh assumed-role credentials: {e}")
+
+        self._refresher = threading.Thread(target=_loop, name='role-credentials-refresher', daemon=True)
+        self._refresher.start()
+
+    def stop(self):
+        self._stop.set()
+
 def assume_role(role_arn):
-    """假设跨账户角色"""
-    sts = boto3.client('sts')
-    response = sts.assume_role(
-        RoleArn=role_arn,
-        RoleSessionName=f'cross-acct-mlflow-sync-{datetime.now().strftime("%Y%m%d%H%M%S")}',
-        DurationSeconds=3600
-    )
-    
-    creds = response['Credentials']
-    os.environ['AWS_ACCESS_KEY_ID'] = creds['AccessKeyId']
-    os.environ['AWS_SECRET_ACCESS_KEY'] = creds['SecretAccessKey']
-    os.environ['AWS_SESSION_TOKEN'] = creds['SessionToken']
+    """假设跨账户角色（一次性，不自动续期）"""
+    RoleCredentials(role_arn).refresh()
 
 def get_experiment_by_name_or_id(client, experiment_identifier):
     """通过名称或ID获取实验"""
+    # 首先尝试作为名称获取
+    try:
+        experiment = client.get_experiment_by_name(experiment_identifier)
+    except Exception:
+        experiment = None
+    if experiment is not None:
+        return experiment
     try:
-        # 首先尝试作为名称获取
-        return client.get_experiment_by_name(experiment_identifier)
-    except:
+        # 如果失败，尝试作为ID获取
+        return client.get_experiment(experiment_identifier)
+    except Exception:
+        raise Exception(f"Experiment '{experiment_identifier}' not found (tried both name and ID)")
+
+# 同步工具在目标 run 中使用的内部 artifact 目录，清单记录已复制文件的大小和 sha256
+SYNC_ARTIFACT_DIR = '.mlflow_sync'
+ARTIFACT_MANIFEST = f'{SYNC_ARTIFACT_DIR}/manifest.json'
+DEFAULT_ARTIFACT_WORKERS = 4
+
+# 并行同步的实验数
+DEFAULT_EXPERIMENT_WORKERS = 4
+
+# --watch 模式的轮询间隔（秒）和 watermark 检查点文件
+DEFAULT_WATCH_INTERVAL = 60
+DEFAULT_CHECKPOINT_FILE = os.environ.get(
+    'CROSS_ACCOUNT_SYNC_CHECKPOINT',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'temp', 'cross_account_sync_checkpoint.json')
+)
+
+# 复制未完成的目标 run 带有该 tag，复制的最后一步才删除；带该 tag 的 run 不算已同步。
+# 值为 ARTIFACTS_PENDING 时 run 的数据已写完，但有 artifact 复制失败，下次同步时补传
+SYNC_INCOMPLETE_TAG = 'sync_incomplete'
+ARTIFACTS_PENDING = 'artifacts'
+SYNC_IN_PROGRESS = 'true'
+
+# 复制中的 run 创建时记录的 sync_timestamp 超过该时长（秒）才视为中断的复制并删除，
+# 避免删掉其它同步进程正在写入的 run
+INCOMPLETE_GRACE_SECONDS = 6 * 3600
+
+# 同步过程自己写入的 tag，增量更新时不与源 run 比较
+SYNC_ONLY_TAGS = {'source_run_id', 'contributor_tag', 'sync_timestamp', SYNC_INCOMPLETE_TAG}
+
+# MLflow log_batch 单次请求上限
+MAX_METRICS_PER_BATCH = 1000
+MAX_PARAMS_TAGS_PER_BATCH = 100
+MAX_ENTITIES_PER_BATCH = 1000
+
+class ArtifactSyncError(Exception):
+    """部分 artifact 复制失败；对应的目标 run 保留 sync_incomplete 标记，下次同步时重试"""
+
+    def __init__(self, failures):
+        # [(source_run_id, artifact 路径, 异常)]
+        self.failures = failures
+        shown = ", ".join(f"{run_id}/{path}" for run_id, path, _ in failures[:10])
+        super().__init__(f"{len(failures)} artifact(s) failed to copy: {shown}{' ...' if len(failures) > 10 else ''}")
+
+def log_batch_chunked(client, run_id, metrics=(), params=(), tags=()):
+    """按 MLflow 的单次请求上限把 metrics / params / tags 拆成若干次 log_batch"""
+    metrics, params, tags = list(metrics), list(params), list(tags)
+    requests = 0
+    while metrics or params or tags:
+        batch_params = params[:MAX_PARAMS_TAGS_PER_BATCH]
+        batch_tags = tags[:MAX_PARAMS_TAGS_PER_BATCH - len(batch_params)]
+        room = min(MAX_METRICS_PER_BATCH, MAX_ENTITIES_PER_BATCH - len(batch_params) - len(batch_tags))
+        batch_metrics = metrics[:room]
+        
+        client.log_batch(run_id, metrics=batch_metrics, params=batch_params, tags=batch_tags)
+        requests += 1
+        
+        params = params[len(batch_params):]
+        tags = tags[len(batch_tags):]
+        metrics = metrics[len(batch_metrics):]
+    return requests
+
+def _sync_age_seconds(target_run):
+    """目标 run 的 sync_timestamp 距今的秒数，没有或无法解析时返回 None"""
+    try:
+        return (datetime.now() - datetime.fromisoformat(target_run.data.tags['sync_timestamp'])).total_seconds()
+    except (KeyError, ValueError):
+        return None
+
+def synced_run_state(target_client, target_run, grace_seconds=INCOMPLETE_GRACE_SECONDS):
+    """返回 (目标 run 对应的 source_run_id, sync_incomplete 的值)，已完整同步的 run 第二项为 None
+
+    复制中（SYNC_IN_PROGRESS）的 run 在 sync_timestamp 超过 grace_seconds（或没有该 tag）时视为上次复制中断，
+    删除后返回 (None, None)；未超过时可能有其它进程正在写入，原样返回，由调用方跳过。
+    artifacts 待补传的 run 照常返回。
+    """
+    source_run_id = target_run.data.tags.get('source_run_id')
+    state = target_run.data.tags.get(SYNC_INCOMPLETE_TAG)
+    if source_run_id and state is not None and state != ARTIFACTS_PENDING:
+        age = _sync_age_seconds(target_run)
+        if age is not None and age < grace_seconds:
+            print(f"  Run {source_run_id} is being copied to {target_run.info.run_id} by another sync "
+                  f"({age:.0f}s ago), skipping")
+            return source_run_id, state
+        print(f"  Deleting incomplete copy {target_run.info.run_id} of run {source_run_id} (interrupted sync)")
+        target_client.delete_run(target_run.info.run_id)
+        return None, None
+    return source_run_id, state
+
+def load_synced_index(target_client, target_exp_id, states=None):
+    """分页读取目标实验的全部 run，返回 {source_run_id: target_run_id}
+
+    传入 states 时把未完整同步（其它进程复制中 / artifacts 待补传）的 run 记录为 {source_run_id: sync_incomplete 的值}。
+    """
+    index = {}
+    for target_run in search_all_runs(target_client, target_exp_id):
+        source_run_id, state = synced_run_state(target_client, target_run)
+        if source_run_id:
+            index[source_run_id] = target_run.info.run_id
+            if state is not None and states is not None:
+                states[source_run_id] = state
+    return index
+
+def iter_metric_history(source_client, run):
+    """逐个 metric 拉取完整历史（原始 step 和时间戳），以 log_batch 大小的块产出"""
+    for key in run.data.metrics:
+        history = source_client.get_metric_history(run.info.run_id, key)
+        for i in range(0, len(history), MAX_METRICS_PER_BATCH):
+            yield [Metric(m.key, m.value, m.timestamp, m.step) for m in history[i:i + MAX_METRICS_PER_BATCH]]
+
+def list_artifact_files(client, run_id, path=None):
+    """递归列出 run 的全部 artifact 文件，返回 {相对路径: 字节数}"""
+    files = {}
+    for info in client.list_artifacts(run_id, path):
+        if info.is_dir:
+            files.update(list_artifact_files(client, run_id, info.path))
+        else:
+            files[info.path] = info.file_size
+    return files
+
+def _sha256(local_path, chunk_size=8 * 1024 * 1024):
+    """分块计算文件的 sha256，不把整个文件读入内存"""
+    digest = hashlib.sha256()
+    with open(local_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _load_manifest(target_client, target_run_id):
+    """读取目标 run 上记录的已复制文件清单 {path: {'size': ..., 'sha256': ...}}"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        try:
+            local_path = target_client.download_artifacts(target_run_id, ARTIFACT_MANIFEST, tmp_dir)
+        except Exception:
+            return {}
+        with open(local_path, 'r') as f:
+            return json.load(f)
+
+def _copy_artifact(source_client, target_client, source_run_id, target_run_id, path, expected=None):
+    """经由本地临时文件复制单个 artifact：下载和上传都是流式的，文件不会整体进入内存
+
+    expected 为目标上已有副本的清单记录，下载后的源文件 sha256 与之相同时不再上传。
+    返回 (清单记录, 是否上传)。
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        local_path = source_client.download_artifacts(source_run_id, path, tmp_dir)
+        entry = {'size': os.path.getsize(local_path), 'sha256': _sha256(local_path)}
+        if expected == entry:
+            return entry, False
+        artifact_dir = os.path.dirname(path) or None
+        target_client.log_artifact(target_run_id, local_path, artifact_dir)
+        return entry, True
+
+def copy_artifacts(source_client, target_client, source_run_id, target_run_id, max_workers=DEFAULT_ARTIFACT_WORKERS,
+                   verify_checksums=False):
+    """以有界并发复制 artifacts，返回 (上传数, 跳过数, 失败的 {路径: 异常})
+
+    目标 run 的 .mlflow_sync/manifest.json 记录每个文件复制时计算的大小和 sha256。MLflow 的
+    list_artifacts 只提供源文件大小，因此默认只要目标文件和清单记录的大小都与源一致就跳过，
+    中断后重新同步时只补传缺失或大小变化的文件。verify_checksums=True 时下载每个源文件计算 sha256，
+    与清单不一致（包括大小相同但内容被修改）才重新上传。
+    """
+    source_files = {path: size for path, size in list_artifact_files(source_client, source_run_id).items()
+                    if not path.startswith(f'{SYNC_ARTIFACT_DIR}/')}
+    if not source_files:
+        return 0, 0, {}
+    target_files = list_artifact_files(target_client, target_run_id)
+    manifest = _load_manifest(target_client, target_run_id) if ARTIFACT_MANIFEST in target_files else {}
+
+    def _unchanged(path, size):
+        return target_files.get(path) == size and manifest.get(path, {}).get('size') == size
+
+    if verify_checksums:
+        pending = list(source_files)
+    else:
+        pending = [path for path, size in source_files.items() if not _unchanged(path, size)]
+
+    copied = 0
+    failed = {}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        futures = {
+            pool.submit(_copy_artifact, source_client, target_client, source_run_id, target_run_id, path,
+                        manifest.get(path) if _unchanged(path, source_files[path]) else None): path
+            for path in pending
+        }
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                manifest[path], uploaded = future.result()
+                copied += uploaded
+            except Exception as e:
+                failed[path] = e
+                print(f"    ⚠️ Failed to copy artifact {path}: {e}")
+
+    if copied:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            manifest_path = os.path.join(tmp_dir, os.path.basename(ARTIFACT_MANIFEST))
+            with open(manifest_path, 'w') as f:
+                json.dump(manifest, f, indent=2)
+            target_client.log_artifact(target_run_id, manifest_path, SYNC_ARTIFACT_DIR)
+
+    return copied, len(source_files) - copied - len(failed), failed
+
+def replicate_run(source_client, target_client, target_exp_id, run, contributor_tag,
+                  sync_artifacts=True, artifact_workers=DEFAULT_ARTIFACT_WORKERS):
+    """在目标实验中复制一个 run：create_run 保留原始开始时间，log_batch 批量写入完整 metric 历史，
+    复制 artifacts，设置原始状态和结束时间，最后删除 sync_incomplete 标记。返回 (目标 run ID, 失败的 artifacts)
+
+    有 artifact 复制失败时 sync_incomplete 改为 ARTIFACTS_PENDING 而不删除，下次同步时补传。
+    中途失败时删除目标 run 后抛出异常；进程被杀留下的不完整 run 由 synced_run_state 清理。
+    """
+    tags = run.data.tags.copy() if run.data.tags else {}
+    tags.update({
+        'source_run_id': run.info.run_id,  # 保留用于重复检测
+        'contributor_tag': contributor_tag,
+        'sync_timestamp': datetime.now().isoformat()
+    })
+    run_name = tags.get('mlflow.runName') or run.info.run_name
+    
+    # 创建时只带上重复检测需要的 tag，其余 tag 通过 log_batch 写入，避免超过单次请求上限
+    target_run = target_client.create_run(
+        experiment_id=target_exp_id,
+        start_time=run.info.start_time,
+        tags={'source_run_id': run.info.run_id, SYNC_INCOMPLETE_TAG: SYNC_IN_PROGRESS,
+              'sync_timestamp': tags['sync_timestamp']},
+        run_name=run_name
+    )
+    target_run_id = target_run.info.run_id
+    try:
+        metric_points, failed = _replicate_run_data(source_client, target_client, run, target_run_id, tags,
+                                                    sync_artifacts, artifact_workers)
+        if failed:
+            target_client.set_tag(target_run_id, SYNC_INCOMPLETE_TAG, ARTIFACTS_PENDING)
+        else:
+            target_client.delete_tag(target_run_id, SYNC_INCOMPLETE_TAG)
+    except Exception:
         try:
-            # 如果失败，尝试作为ID获取
-            return client.get_experiment(experiment_identifier)
-        except:
-            raise Exception(f"Experiment '{experiment_identifier}' not found (tried both name and ID)")
-
-def sync_experiment(config, experiment_identifier):
-    """同步实验"""
-    # 直接使用配置中的ARNs
-    source_arn = config['source_mlflow_arn']
-    target_arn = config['shared_mlflow_arn']
-    contributor_tag = config['contributor_name']
+            target_client.delete_run(target_run_id)
+        except Exception as e:
+            print(f"    ⚠️ Failed to delete partial target run {target_run_id}: {e}")
+        raise
     
-    print(f"Source MLflow: {source_arn}")
-    print(f"Target MLflow: {target_arn}")
-    print(f"Experiment identifier: {experiment_identifier}")
+    print(f"    {metric_points} metric points")
+    return target_run_id, failed
+
+def _replicate_run_data(source_client, target_client, run, target_run_id, tags, sync_artifacts, artifact_workers):
+    """写入 params / tags / metric 历史 / artifacts 和最终状态，返回 (metric 点数, 失败的 artifacts)"""
+    log_batch_chunked(
+        target_client,
+        target_run_id,
+        params=[Param(key, str(value)) for key, value in run.data.params.items()],
+        tags=[RunTag(key, str(value)) for key, value in tags.items() if key != 'source_run_id']
+    )
     
-    # 创建客户端 - 使用环境变量方式避免 ARN 解析问题
-    import os
+    # 完整 metric 历史按块流式写入，每次只持有一个 metric 的历史
+    metric_points = 0
+    for chunk in iter_metric_history(source_client, run):
+        target_client.log_batch(target_run_id, metrics=chunk)
+        metric_points += len(chunk)
     
-    # 保存当前环境变量
-    original_uri = os.environ.get('MLFLOW_TRACKING_URI', '')
+    failed = {}
+    if sync_artifacts:
+        copied, skipped, failed = copy_artifacts(source_client, target_client, run.info.run_id, target_run_id,
+                                                 artifact_workers)
+        if copied or skipped or failed:
+            print(f"    artifacts: {copied} copied, {skipped} unchanged, {len(failed)} failed")
     
-    try:
-        # 设置源 MLflow URI 并创建客户端
-        os.environ['MLFLOW_TRACKING_URI'] = source_arn
-        source_client = mlflow.tracking.MlflowClient()
-        
-        # 获取源实验（支持名称或ID）
-        source_exp = get_experiment_by_name_or_id(source_client, experiment_identifier)
-        print(f"Found source experiment: {source_exp.name} (ID: {source_exp.experiment_id})")
+    # 仍在运行的 run 保持 RUNNING 状态
+    if run.info.status != 'RUNNING':
+        target_client.set_terminated(target_run_id, status=run.info.status, end_time=run.info.end_time)
+    return metric_points, failed
+
+def update_run(source_client, target_client, run, target_run):
+    """把源 run 的后续变化追加到已同步的目标 run，返回写入的 metric 点数；没有任何变化时返回 None
+
+    - params 只能新增（MLflow 中 param 不可修改），tags 写入有变化的键；
+    - 每个 metric 只在源的最新记录 (step, timestamp, value) 与目标不同时才拉取历史，只追加
+      (step, timestamp) 严格晚于目标最新记录的点。同一 step 反复记录（不传 step 时默认为 0）也能同步；
+      与目标最新记录 (step, timestamp) 相同的点按值的多重集合比较，只补目标还没有的值；
+    - 源 run 已结束而目标仍是旧状态时设置最终状态和结束时间。
+    artifacts 由调用方通过 SyncEngine.sync_run_artifacts 补传，失败时维护 sync_incomplete 标记。
+    """
+    target_run_id = target_run.info.run_id
+    params = [Param(key, str(value)) for key, value in run.data.params.items()
+              if key not in target_run.data.params]
+    tags = [RunTag(key, str(value)) for key, value in run.data.tags.items()
+            if key not in SYNC_ONLY_TAGS and target_run.data.tags.get(key) != str(value)]
+    
+    # latest metric 是每个 key 按 (step, timestamp, value) 排序的最大记录，用它判断哪些 metric 有新数据
+    target_latest = {m.key: (m.step, m.timestamp, m.value) for m in latest_metrics(target_run)}
+    stale_keys = [m.key for m in latest_metrics(run)
+                  if target_latest.get(m.key) != (m.step, m.timestamp, m.value)]
+    finalize = run.info.status != 'RUNNING' and target_run.info.status != run.info.status
+    if not (params or tags or stale_keys or finalize):
+        return None
+    
+    log_batch_chunked(target_client, target_run_id, params=params, tags=tags)
+    
+    metric_points = 0
+    for key in stale_keys:
+        last = target_latest.get(key)
+        history = source_client.get_metric_history(run.info.run_id, key)
+        new_points = [Metric(m.key, m.value, m.timestamp, m.step) for m in history
+                      if last is None or (m.step, m.timestamp) > last[:2]]
+        if last is not None:
+            # 同一 (step, timestamp) 有多个值时，目标的 latest metric 只反映其中一个，需要读取目标历史比较
+            at_last = Counter(m.value for m in history if (m.step, m.timestamp) == last[:2])
+            if at_last and at_last != Counter([last[2]]):
+                held = Counter(m.value for m in target_client.get_metric_history(target_run_id, key)
+                               if (m.step, m.timestamp) == last[:2])
+                new_points += [Metric(key, value, last[1], last[0]) for value in (at_last - held).elements()]
+        log_batch_chunked(target_client, target_run_id, metrics=new_points)
+        metric_points += len(new_points)
+    
+    if finalize:
+        target_client.set_terminated(target_run_id, status=run.info.status, end_time=run.info.end_time)
+    return metric_points
+
+def runs_watermark(runs, watermark=None):
+    """取 run 开始 / 结束时间的最大值（毫秒）作为下一次增量拉取的起点"""
+    for run in runs:
+        latest = max(run.info.start_time or 0, run.info.end_time or 0)
+        watermark = latest if watermark is None else max(watermark, latest)
+    return watermark
+
+class SyncCheckpoint:
+    """--watch 模式的 watermark 检查点文件
+
+    格式为 {同步键: {源实验 ID: {'watermark': 毫秒, 'experiment_name': ..., 'updated_at': ...}}}，
+    同步键由源、目标 tracking URI 和 contributor 组成，同一个源同步到多个目标时互不影响。
+    每次更新都先写临时文件再 rename，进程被杀时不会留下半个文件。
+    """
+
+    def __init__(self, path, source_arn, target_arn, contributor_tag):
+        self.path = os.path.abspath(path or DEFAULT_CHECKPOINT_FILE)
+        self.sync_key = f"{source_arn} -> {target_arn} ({contributor_tag})"
+        self._lock = threading.Lock()
+        self._state = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                self._state = json.load(f)
+
+    def get(self, experiment_id):
+        entry = self._state.get(self.sync_key, {}).get(experiment_id)
+        return entry['watermark'] if entry else None
+
+    def set(self, experiment_id, experiment_name, watermark):
+        with self._lock:
+            self._state.setdefault(self.sync_key, {})[experiment_id] = {
+                'watermark': watermark,
+                'experiment_name': experiment_name,
+                'updated_at': datetime.now().isoformat()
+            }
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self._state, f, indent=2)
+            os.replace(tmp_path, self.path)
+
+class SyncEngine:
+    """把源 MLflow 的实验同步到共享 MLflow
+
+    源和目标各自持有显式绑定 tracking URI 的 MlflowClient，不再通过改写 MLFLOW_TRACKING_URI 切换，
+    因此多个实验可以在线程池中并行同步。
+    """
+
+    def __init__(self, config, credentials=None, max_workers=DEFAULT_EXPERIMENT_WORKERS,
+                 sync_artifacts=True, artifact_workers=DEFAULT_ARTIFACT_WORKERS, verify_artifacts=False):
+        self.source_arn = config['source_mlflow_arn']
+        self.target_arn = config['shared_mlflow_arn']
+        self.contributor_tag = config['contributor_name']
+        self.credentials = credentials
+        self.max_workers = max_workers
+        self.sync_artifacts = sync_artifacts
+        self.artifact_workers = artifact_workers
+        self.verify_artifacts = verify_artifacts
         
-        # 设置目标 MLflow URI 并创建客户端
-        os.environ['MLFLOW_TRACKING_URI'] = target_arn
-        target_client = mlflow.tracking.MlflowClient()
+        print(f"Source MLflow: {self.source_arn}")
+        print(f"Target MLflow: {self.target_arn}")
+        self.source_client = MlflowClient(tracking_uri=self.source_arn)
+        self.target_client = MlflowClient(tracking_uri=self.target_arn)
         
-        target_exp_name = f"{source_exp.name}_{contributor_tag}"
+        # --watch 模式下跨轮次复用：源实验 ID -> 目标实验，目标实验 ID -> {source_run_id: target_run_id}，
+        # 目标实验 ID -> {source_run_id: sync_incomplete 的值}（artifacts 待补传的 run）
+        self._target_experiments = {}
+        self._synced_indexes = {}
+        self._sync_states = {}
+
+    def resolve_experiments(self, identifiers=None, pattern=None):
+        """按名称/ID 列表或名称通配符（fnmatch）解析源实验；都为空时返回全部实验"""
+        if identifiers:
+            return [get_experiment_by_name_or_id(self.source_client, i) for i in identifiers]
+        experiments = search_all_experiments(self.source_client)
+        if pattern:
+            experiments = [exp for exp in experiments if fnmatch.fnmatch(exp.name, pattern)]
+        return experiments
+
+    def get_or_create_target_experiment(self, source_exp):
+        """创建或获取目标实验（已删除的会被恢复），返回 (target_exp_name, target_exp_id)"""
+        target_exp_name = f"{source_exp.name}_{self.contributor_tag}"
+        target_exp = self.target_client.get_experiment_by_name(target_exp_name)
         
-        # 创建或获取目标实验
-        try:
-            target_exp = target_client.get_experiment_by_name(target_exp_name)
-            # 检查实验是否被删除
-            if target_exp.lifecycle_stage == 'deleted':
-                print(f"Target experiment {target_exp_name} was deleted, restoring it...")
-                # 恢复已删除的实验
-                target_client.restore_experiment(target_exp.experiment_id)
-                target_exp_id = target_exp.experiment_id
-                print(f"Restored target experiment: {target_exp_name} (ID: {target_exp_id})")
-            else:
-                target_exp_id = target_exp.experiment_id
-                print(f"Target experiment already exists: {target_exp_name} (ID: {target_exp_id})")
-        except:
-            target_exp_id = target_client.create_experiment(
+        if target_exp is None:
+            target_exp_id = self.target_client.create_experiment(
                 name=target_exp_name,
                 tags={
                     'source_experiment_id': source_exp.experiment_id,
                     'source_experiment_name': source_exp.name,
-                    'contributor_tag': contributor_tag,
+                    'contributor_tag': self.contributor_tag,
                     'sync_timestamp': datetime.now().isoformat()
                 }
             )
             print(f"Created target experiment: {target_exp_name} (ID: {target_exp_id})")
-        
-        # 切换回源 MLflow 来获取 runs
-        os.environ['MLFLOW_TRACKING_URI'] = source_arn
-        source_client = mlflow.tracking.MlflowClient()
+        elif target_exp.lifecycle_stage == 'deleted':
+            # 恢复已删除的实验
+            print(f"Target experiment {target_exp_name} was deleted, restoring it...")
+            self.target_client.restore_experiment(target_exp.experiment_id)
+            target_exp_id = target_exp.experiment_id
+            print(f"Restored target experiment: {target_exp_name} (ID: {target_exp_id})")
+        else:
+            target_exp_id = target_exp.experiment_id
+            print(f"Target experiment already exists: {target_exp_name} (ID: {target_exp_id})")
+        return target_exp_name, target_exp_id
+
+    def _ensure_credentials(self):
+        if self.credentials is not None:
+            self.credentials.ensure_fresh()
+
+    def sync_run_artifacts(self, source_run_id, target_run_id, pending=False, verify=False):
+        """补传已同步 run 缺失的 artifacts（verify 时按 sha256 校验），返回失败的 {路径: 异常}
+
+        有失败时给目标 run 打上 ARTIFACTS_PENDING 标记，之前待补传的 run 全部成功后去掉标记。
+        """
+        copied, _, failed = copy_artifacts(self.source_client, self.target_client, source_run_id, target_run_id,
+                                           self.artifact_workers, verify_checksums=verify)
+        if copied:
+            print(f"    artifacts: {copied} copied")
+        if failed and not pending:
+            self.target_client.set_tag(target_run_id, SYNC_INCOMPLETE_TAG, ARTIFACTS_PENDING)
+        elif not failed and pending:
+            self.target_client.delete_tag(target_run_id, SYNC_INCOMPLETE_TAG)
+            print(f"    artifacts of run {source_run_id} complete")
+        return failed
+
+    def sync_experiment(self, source_exp):
+        """同步单个实验，返回新同步的 run 数；有 artifact 复制失败时在处理完全部 run 后抛出 ArtifactSyncError"""
+        self._ensure_credentials()
+        print(f"Found source experiment: {source_exp.name} (ID: {source_exp.experiment_id})")
+        target_exp_name, target_exp_id = self.get_or_create_target_experiment(source_exp)
         
         # 同步runs
-        runs = source_client.search_runs(experiment_ids=[source_exp.experiment_id])
-        print(f"Syncing {len(runs)} runs...")
+        runs = search_all_runs(self.source_client, source_exp.experiment_id)
+        print(f"[{source_exp.name}] Syncing {len(runs)} runs...")
         
-        # 切换到目标 MLflow 进行同步
-        os.environ['MLFLOW_TRACKING_URI'] = target_arn
-        target_client = mlflow.tracking.MlflowClient()
+        # 一次性分页加载目标实验中已同步的 source_run_id，后续判断都在内存中完成
+        states = {}
+        synced_index = load_synced_index(self.target_client, target_exp_id, states)
+        print(f"[{source_exp.name}] Loaded {len(synced_index)} already-synced runs from target experiment")
         
         synced_count = 0
+        failures = []
+        sync_start = time.time()
         for run in runs:
+            self._ensure_credentials()
             # 检查是否已经同步过这个run
-            existing_runs = target_client.search_runs(
-                experiment_ids=[target_exp_id],
-                filter_string=f"tags.source_run_id = '{run.info.run_id}'"
-            )
-            
-            if existing_runs:
-                print(f"  Skipping run {run.info.run_id} (already synced)")
+            if run.info.run_id in synced_index:
+                if states.get(run.info.run_id) == SYNC_IN_PROGRESS:
+                    # 其它进程正在复制，不重复写入
+                    continue
+                pending = states.get(run.info.run_id) == ARTIFACTS_PENDING
+                if self.sync_artifacts and (pending or self.verify_artifacts):
+                    # 补传之前失败 / 中断时缺失的 artifacts；--verify-artifacts 时按 sha256 重新上传内容变化的文件
+                    print(f"  Run {run.info.run_id} already synced, {'retrying' if pending else 'verifying'} artifacts")
+                    failed = self.sync_run_artifacts(run.info.run_id, synced_index[run.info.run_id],
+                                                     pending=pending, verify=self.verify_artifacts)
+                    failures.extend((run.info.run_id, path, e) for path, e in failed.items())
+                else:
+                    print(f"  Skipping run {run.info.run_id} (already synced)")
                 continue
-                
-            with mlflow.start_run(experiment_id=target_exp_id) as target_run:
-                # 同步参数
-                for key, value in run.data.params.items():
-                    target_client.log_param(target_run.info.run_id, key, value)
-                
-                # 同步指标
-                for key, value in run.data.metrics.items():
-                    target_client.log_metric(target_run.info.run_id, key, value)
-                
-                # 同步标签
-                tags = run.data.tags.copy() if run.data.tags else {}
-                tags.update({
-                    'source_run_id': run.info.run_id,  # 保留用于重复检测
-                    'contributor_tag': contributor_tag,
-                    'sync_timestamp': datetime.now().isoformat()
-                })
-                
-                for key, value in tags.items():
-                    target_client.set_tag(target_run.info.run_id, key, value)
-                
-                synced_count += 1
-                print(f"  ✓ Synced run {run.info.run_id}")
+            
+            synced_index[run.info.run_id], failed = replicate_run(
+                self.source_client, self.target_client, target_exp_id, run, self.contributor_tag,
+                sync_artifacts=self.sync_artifacts, artifact_workers=self.artifact_workers
+            )
+            failures.extend((run.info.run_id, path, e) for path, e in failed.items())
+            synced_count += 1
+            print(f"  ✓ [{source_exp.name}] Synced run {run.info.run_id}")
         
+        elapsed = time.time() - sync_start
+        if synced_count:
+            print(f"⏱️ [{source_exp.name}] Synced {synced_count} runs in {elapsed:.1f}s "
+                  f"({synced_count / max(elapsed, 1e-6):.2f} runs/s)")
+        
+        if failures:
+            print(f"⚠️ [{source_exp.name}] {len(failures)} artifact(s) failed to copy, "
+                  f"affected runs keep '{SYNC_INCOMPLETE_TAG}' and are retried on the next sync")
+            raise ArtifactSyncError(failures)
         print(f"✅ Synced experiment '{source_exp.name}' -> '{target_exp_name}' ({synced_count} new runs)")
+        return synced_count
+
+    def sync_changes(self, source_exp, watermark=None):
+        """增量同步单个实验，返回 (新建 run 数, 更新 run 数, 新 watermark)
+
+        watermark 为空时拉取全部 run，否则只拉取 watermark 之后新建 / 结束的 run 和仍在运行的 run。
+        新 run 完整复制；已同步的 run 追加新 metric step 并更新最终状态，不会停留在同步时的中间状态。
+        artifacts 待补传的 run 每一轮都会重试，不依赖源 run 是否变化。
+        """
+        self._ensure_credentials()
+        if source_exp.experiment_id not in self._target_experiments:
+            self._target_experiments[source_exp.experiment_id] = self.get_or_create_target_experiment(source_exp)
+        target_exp_name, target_exp_id = self._target_experiments[source_exp.experiment_id]
         
-    finally:
-        # 恢复原始环境变量
-        if original_uri:
-            os.environ['MLFLOW_TRACKING_URI'] = original_uri
-        elif 'MLFLOW_TRACKING_URI' in os.environ:
-            del os.environ['MLFLOW_TRACKING_URI']
+        # 首轮从目标实验分页加载完整 run（包含状态和最新 metric），之后只维护 run ID 索引
+        target_runs = {}
+        if target_exp_id not in self._synced_indexes:
+            states = {}
+            for target_run in search_all_runs(self.target_client, target_exp_id):
+                source_run_id, state = synced_run_state(self.target_client, target_run)
+                if source_run_id:
+                    target_runs[source_run_id] = target_run
+                    if state is not None:
+                        states[source_run_id] = state
+            self._synced_indexes[target_exp_id] = {k: r.info.run_id for k, r in target_runs.items()}
+            self._sync_states[target_exp_id] = states
+        synced_index = self._synced_indexes[target_exp_id]
+        states = self._sync_states[target_exp_id]
+        
+        # 之前轮次看到的其它进程复制中的 run 每轮重新检查：已完成的照常增量更新，超时被删除的重新复制
+        recopy = []
+        for source_run_id in [k for k, state in states.items()
+                              if state == SYNC_IN_PROGRESS and k not in target_runs]:
+            target_run = self.target_client.get_run(synced_index[source_run_id])
+            found, state = synced_run_state(self.target_client, target_run)
+            if found is None:
+                del synced_index[source_run_id], states[source_run_id]
+                recopy.append(source_run_id)
+                continue
+            target_runs[source_run_id] = target_run
+            if state is None:
+                del states[source_run_id]
+            else:
+                states[source_run_id] = state
+        
+        if watermark is None:
+            runs = search_all_runs(self.source_client, source_exp.experiment_id)
+        else:
+            changed = {}
+            for filter_string in changed_since_filters(watermark):
+                for run in search_all_runs(self.source_client, source_exp.experiment_id, filter_string):
+                    changed[run.info.run_id] = run
+            runs = list(changed.values())
+        fetched = {run.info.run_id for run in runs}
+        runs.extend(self.source_client.get_run(k) for k in recopy if k not in fetched)
+        
+        created = updated = 0
+        attempted = set()
+        for run in runs:
+            self._ensure_credentials()
+            source_run_id = run.info.run_id
+            if states.get(source_run_id) == SYNC_IN_PROGRESS:
+                # 其它进程正在复制，不重复写入
+                continue
+            if source_run_id not in synced_index:
+                synced_index[source_run_id], failed = replicate_run(
+                    self.source_client, self.target_client, target_exp_id, run, self.contributor_tag,
+                    sync_artifacts=self.sync_artifacts, artifact_workers=self.artifact_workers
+                )
+                if failed:
+                    states[source_run_id] = ARTIFACTS_PENDING
+                    attempted.add(source_run_id)
+                created += 1
+                print(f"  ✓ [{source_exp.name}] Synced run {source_run_id}")
+                continue
+            
+            target_run = target_runs.get(source_run_id) or self.target_client.get_run(synced_index[source_run_id])
+            metric_points = update_run(self.source_client, self.target_client, run, target_run)
+            if metric_points is not None:
+                updated += 1
+                print(f"  ↻ [{source_exp.name}] Updated run {source_run_id} "
+                      f"({metric_points} new metric points, status {run.info.status})")
+                if self.sync_artifacts and source_run_id not in states:
+                    attempted.add(source_run_id)
+                    if self.sync_run_artifacts(source_run_id, synced_index[source_run_id]):
+                        states[source_run_id] = ARTIFACTS_PENDING
+        
+        # 之前失败的 artifacts 每轮重试（本轮刚尝试过的除外），直到全部复制成功
+        if self.sync_artifacts:
+            for source_run_id in [k for k, state in states.items()
+                                  if state == ARTIFACTS_PENDING and k not in attempted]:
+                self._ensure_credentials()
+                if not self.sync_run_artifacts(source_run_id, synced_index[source_run_id], pending=True):
+                    del states[source_run_id]
+        
+        return created, updated, runs_watermark(runs, watermark)
+
+    def pending_artifact_runs(self):
+        """--watch 模式下 artifacts 仍待补传的 run 数"""
+        return sum(1 for states in self._sync_states.values()
+                   for state in states.values() if state == ARTIFACTS_PENDING)
+
+    def watch(self, resolve_experiments, checkpoint, interval=DEFAULT_WATCH_INTERVAL, stop_event=None):
+        """持续增量同步，直到 stop_event 被设置
+
+        每一轮重新解析实验列表（按通配符 / 全部实验同步时可以发现新实验），并行调用 sync_changes，
+        每个实验成功后立即把新 watermark 写入检查点文件；单个实验失败只记录，下一轮从旧 watermark 重试。
+        """
+        stop_event = stop_event or threading.Event()
+        cycle = 0
+        while not stop_event.is_set():
+            cycle += 1
+            cycle_start = time.time()
+            created = updated = 0
+            failed = {}
+            try:
+                experiments = resolve_experiments()
+            except Exception as e:
+                print(f"❌ Failed to list source experiments: {e}")
+                experiments = []
+            
+            def _sync(exp):
+                result = self.sync_changes(exp, checkpoint.get(exp.experiment_id))
+                if result[2] is not None:
+                    checkpoint.set(exp.experiment_id, exp.name, result[2])
+                return result
+            
+            with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as pool:
+                futures = {pool.submit(_sync, exp): exp.name for exp in experiments}
+                for future in as_completed(futures):
+                    try:
+                        exp_created, exp_updated, _ = future.result()
+                        created += exp_created
+                        updated += exp_updated
+                    except Exception as e:
+                        failed[futures[future]] = e
+                        print(f"❌ Failed to sync experiment '{futures[future]}': {e}")
+            
+            elapsed = time.time() - cycle_start
+            pending = self.pending_artifact_runs()
+            print(f"🔄 Cycle {cycle}: {len(experiments)} experiments, {created} new runs, {updated} updated runs, "
+                  f"{len(failed)} failed ({elapsed:.1f}s)"
+                  + (f", ⚠️ {pending} runs with artifacts pending retry" if pending else ""))
+            stop_event.wait(max(interval - elapsed, 0))
+        print("👋 Watch mode stopped")
+
+    def sync_all(self, experiments):
+        """在线程池中并行同步多个实验，返回 {实验名: 新同步 run 数或错误信息}"""
+        results = {}
+        with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as pool:
+            futures = {pool.submit(self.sync_experiment, exp): exp.name for exp in experiments}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    print(f"❌ Failed to sync experiment '{name}': {e}")
+                    results[name] = e
+        return results
+
+def sync_experiment(config, experiment_identifier, sync_artifacts=True, artifact_workers=DEFAULT_ARTIFACT_WORKERS,
+                    verify_artifacts=False):
+    """同步单个实验（兼容原接口）"""
+    print(f"Experiment identifier: {experiment_identifier}")
+    engine = SyncEngine(config, sync_artifacts=sync_artifacts, artifact_workers=artifact_workers,
+                        verify_artifacts=verify_artifacts)
+    source_exp = get_experiment_by_name_or_id(engine.source_client, experiment_identifier)
+    return engine.sync_experiment(source_exp)
 
 def main():
     parser = argparse.ArgumentParser(description='Sync MLflow experiment')
@@ -166,14 +785,30 @@ def main():
     
     # 支持两种参数格式以保持兼容性
     group = parser.add_mutually_exclusive_group(required=True)
-    group.add_argument('--experiment-id', help='Experiment ID to sync (for backward compatibility)')
-    group.add_argument('--experiment-name', help='Experiment name to sync')
+    group.add_argument('--experiment-id', nargs='+', help='Experiment ID(s) to sync (for backward compatibility)')
+    group.add_argument('--experiment-name', nargs='+', help='Experiment name(s) to sync')
+    group.add_argument('--experiment-pattern', help="Sync every source experiment whose name matches this glob, e.g. 'team-*'")
+    group.add_argument('--all-experiments', action='store_true', help='Mirror every experiment on the source server')
+    parser.add_argument('--max-workers', type=int, default=DEFAULT_EXPERIMENT_WORKERS,
+                        help='Experiments synced in parallel')
+    parser.add_argument('--no-artifacts', action='store_true', help='Do not copy run artifacts')
+    parser.add_argument('--artifact-workers', type=int, default=DEFAULT_ARTIFACT_WORKERS,
+                        help='Concurrent artifact copies')
+    parser.add_argument('--verify-artifacts', action='store_true',
+                        help='Also re-check artifacts of already-synced runs by sha256 and copy missing or changed files')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep running and incrementally sync runs changed since the last watermark')
+    parser.add_argument('--interval', type=int, default=DEFAULT_WATCH_INTERVAL,
+                        help='Seconds between polls in --watch mode')
+    parser.add_argument('--checkpoint-file', default=DEFAULT_CHECKPOINT_FILE,
+                        help='Per-experiment watermark checkpoint used by --watch')
     
     args = parser.parse_args()
     
     # 确定使用哪个标识符
-    experiment_identifier = args.experiment_name if args.experiment_name else args.experiment_id
+    experiment_identifiers = args.experiment_name or args.experiment_id
     
+    credentials = None
     try:
         # 加载配置
         config = load_config(args.config_file)
@@ -182,19 +817,57 @@ def main():
         # 检查是否需要跨账户访问
         # 注意：即使在同一账户内，也可能需要 assume role 来获得特定权限
         if 'cross_account_role_arn' in config and config['cross_account_role_arn']:
-            print("Assuming cross-account role for permissions...")
-            assume_role(config['cross_account_role_arn'])
+            print("Assuming cross-account role for permissions (auto-refreshed before expiry)...")
+            credentials = RoleCredentials(config['cross_account_role_arn'])
+            credentials.start_auto_refresh()
         else:
             print("No cross-account role specified, using current credentials")
         
+        engine = SyncEngine(
+            config,
+            credentials=credentials,
+            max_workers=args.max_workers,
+            sync_artifacts=not args.no_artifacts,
+            artifact_workers=args.artifact_workers,
+            verify_artifacts=args.verify_artifacts
+        )
+        
+        if args.watch:
+            checkpoint = SyncCheckpoint(args.checkpoint_file, engine.source_arn, engine.target_arn,
+                                        engine.contributor_tag)
+            print(f"👀 Watching for changes every {args.interval}s (checkpoint: {checkpoint.path})")
+            stop_event = threading.Event()
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(sig, lambda *_: stop_event.set())
+            engine.watch(
+                lambda: engine.resolve_experiments(experiment_identifiers, args.experiment_pattern),
+                checkpoint,
+                interval=args.interval,
+                stop_event=stop_event
+            )
+            return
+        
+        experiments = engine.resolve_experiments(experiment_identifiers, args.experiment_pattern)
+        print(f"Syncing {len(experiments)} experiment(s) with {args.max_workers} worker(s)...")
+        
         # 同步实验
-        sync_experiment(config, experiment_identifier)
+        results = engine.sync_all(experiments)
+        failed = {name: error for name, error in results.items() if isinstance(error, Exception)}
+        synced = sum(count for count in results.values() if not isinstance(count, Exception))
+        print(f"📋 {len(results) - len(failed)}/{len(results)} experiments synced, {synced} new runs")
+        if failed:
+            for name, error in failed.items():
+                print(f"  ❌ {name}: {error}")
+            sys.exit(1)
         
     except Exception as e:
         print(f"❌ Error: {e}")
         import traceback
         traceback.print_exc()
         sys.exit(1)
+    finally:
+        if credentials is not None:
+            credentials.stop()
 
 if __name__ == "__main__":
     main()
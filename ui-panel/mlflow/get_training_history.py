@@ -7,99 +7,273 @@
 import os
 import sys
 import json
-import mlflow
+import numpy as np
 import pandas as pd
 from datetime import datetime
+import argparse
 import traceback
 
-def get_training_history(tracking_uri=None):
-    """获取训练历史数据"""
+from mlflow.tracking import MlflowClient
+
+from history_query import HistoryQuery
+from history_store import HistoryStore, changed_since_filters
+from run_fetcher import fetch_runs, search_all_experiments, DEFAULT_MAX_WORKERS, DEFAULT_MAX_RETRIES
+
+# 列式转换时每批处理的行数，限制中间 object 矩阵的内存占用
+TRANSFORM_CHUNK_ROWS = 10000
+
+
+def _prefixed_maps(runs, prefix, as_float=False):
+    """把 prefix 开头的列整体转换为每个 run 一个 {key: value} 字典
+
+    缺失值掩码、非空单元定位都在 NumPy 中完成，只在输出边界用 dict(zip()) 组装字典。
+    """
+    columns = [col for col in runs.columns if col.startswith(prefix)]
+    n_rows = len(runs)
+    if not columns:
+        return [{} for _ in range(n_rows)]
+
+    names = np.array([col[len(prefix):] for col in columns], dtype=object)
+    maps = []
+    for start in range(0, n_rows, TRANSFORM_CHUNK_ROWS):
+        block = runs[columns].iloc[start:start + TRANSFORM_CHUNK_ROWS]
+        if as_float:
+            values = block.to_numpy(dtype=np.float64, na_value=np.nan)
+            mask = ~np.isnan(values)
+        else:
+            values = block.to_numpy(dtype=object)
+            mask = pd.notna(values)
+
+        # 行优先顺序取非空单元，rows 单调递增，可按行号切分
+        rows, cols = np.nonzero(mask)
+        keys = names[cols].tolist()
+        cells = values[rows, cols]
+        cells = cells.tolist() if as_float else [str(v) for v in cells]
+        bounds = np.searchsorted(rows, np.arange(len(block) + 1)).tolist()
+        maps.extend(
+            dict(zip(keys[bounds[i]:bounds[i + 1]], cells[bounds[i]:bounds[i + 1]]))
+            for i in range(len(block))
+        )
+    return maps
+
+
+def _iso_strings(times):
+    """批量把 UTC 时间列格式化为 ISO 8601 字符串，缺失值为 None
+
+    与 Timestamp.isoformat() 输出一致：微秒为 0 时省略小数部分。
+    """
+    times = pd.to_datetime(times, utc=True)
+    formatted = times.dt.strftime('%Y-%m-%dT%H:%M:%S.%f+00:00').where(
+        times.dt.microsecond != 0, times.dt.strftime('%Y-%m-%dT%H:%M:%S+00:00'))
+    return formatted.where(times.notna(), None).tolist()
+
+
+def _runs_to_records(exp, runs):
+    """把 search_runs 返回的 DataFrame 转换为 run 记录列表（列式实现）"""
+    n_rows = len(runs)
+    if n_rows == 0:
+        return []
+
+    start_times = pd.to_datetime(runs['start_time'], utc=True)
+    end_times = pd.to_datetime(runs['end_time'], utc=True)
+
+    # 计算训练时长
+    durations = end_times - start_times
+    durations = durations.astype(str).where(durations.notna(), None).tolist()
+
+    if 'tags.mlflow.runName' in runs.columns:
+        run_names = runs['tags.mlflow.runName'].where(runs['tags.mlflow.runName'].notna(), 'N/A').tolist()
+    else:
+        run_names = ['N/A'] * n_rows
+
+    columns = zip(
+        runs['run_id'].tolist(),
+        run_names,
+        runs['status'].tolist(),
+        _iso_strings(start_times),
+        _iso_strings(end_times),
+        durations,
+        _prefixed_maps(runs, 'metrics.', as_float=True),
+        _prefixed_maps(runs, 'params.'),
+        _prefixed_maps(runs, 'tags.'),
+    )
+
+    return [
+        {
+            'experiment_name': exp.name,
+            'experiment_id': exp.experiment_id,
+            'run_id': run_id,
+            'run_name': run_name,
+            'status': status,
+            'start_time': start_time,
+            'end_time': end_time,
+            'duration': duration,
+            'metrics': metrics,
+            'params': params,
+            'tags': tags
+        }
+        for run_id, run_name, status, start_time, end_time, duration, metrics, params, tags in columns
+    ]
+
+
+def _frame_watermark(runs):
+    """取 DataFrame 中 start_time / end_time 的最大值（毫秒），作为下一次增量拉取的起点"""
+    watermark = None
+    for col in ('start_time', 'end_time'):
+        if col in runs.columns:
+            latest = runs[col].max()
+            if pd.notna(latest):
+                value = int(pd.Timestamp(latest).value // 1_000_000)
+                watermark = value if watermark is None else max(watermark, value)
+    return watermark
+
+
+def _runs_to_frame(runs):
+    """把 MlflowClient 返回的 Run 列表转换为与 mlflow.search_runs 相同结构的 DataFrame"""
+    rows = []
+    for run in runs:
+        row = {
+            'run_id': run.info.run_id,
+            'experiment_id': run.info.experiment_id,
+            'status': run.info.status,
+            'artifact_uri': run.info.artifact_uri,
+            'start_time': run.info.start_time,
+            'end_time': run.info.end_time,
+        }
+        row.update({f'metrics.{k}': v for k, v in run.data.metrics.items()})
+        row.update({f'params.{k}': v for k, v in run.data.params.items()})
+        row.update({f'tags.{k}': v for k, v in run.data.tags.items()})
+        rows.append(row)
+
+    frame = pd.DataFrame.from_records(rows)
+    if not frame.empty:
+        frame['start_time'] = pd.to_datetime(frame['start_time'], unit='ms', utc=True)
+        frame['end_time'] = pd.to_datetime(frame['end_time'], unit='ms', utc=True)
+    return frame
+
+
+def get_training_history(tracking_uri=None, store_path=None, full_refresh=False, use_cache=True,
+                         max_workers=DEFAULT_MAX_WORKERS, max_retries=DEFAULT_MAX_RETRIES,
+                         client=None, store=None, query=None):
+    """获取训练历史数据
+
+    use_cache=True 时使用本地增量缓存：首次（或 full_refresh）全量拉取，
+    之后每次只拉取 watermark 之后变化的 run，结果从本地缓存返回。
+    所有实验的查询在 max_workers 个线程中并发翻页执行，单个实验失败记录在 failed_experiments 中。
+    常驻进程（mlflow_worker.py）可传入已建好的 client / store 复用连接，此时不会关闭 store。
+    query（HistoryQuery）限定实验子集并做过滤、投影、排序和分页；不走缓存时过滤和排序下推给 MLflow。
+    """
+    owns_store = store is None
+    query = query or HistoryQuery()
     try:
         # MLflow tracking server URI - 从命令行参数获取，或使用默认值
         if tracking_uri is None:
             tracking_uri = "arn:aws:sagemaker:us-west-2:633205212955:mlflow-tracking-server/pdx-mlflow"
         
         print(f"🔍 连接到 MLflow: {tracking_uri}", file=sys.stderr)
-        mlflow.set_tracking_uri(tracking_uri)
+        if client is None:
+            client = MlflowClient(tracking_uri=tracking_uri)
         
         # 获取所有实验
-        experiments = mlflow.search_experiments()
+        experiments = search_all_experiments(client, max_retries=max_retries)
         print(f"📊 找到 {len(experiments)} 个实验", file=sys.stderr)
+        experiments = query.select_experiments(experiments)
+        
+        if not use_cache:
+            store = None
+        elif store is None:
+            store = HistoryStore(tracking_uri, store_path)
         
         # 收集所有训练历史数据
         training_history = []
+        fetched_count = 0
+        failed_experiments = []
         
+        # 为每个实验生成查询：全量或 watermark 之后的增量，然后统一并发翻页拉取
+        # 不走缓存时过滤、排序和每个实验的条数上限直接下推给 MLflow；缓存需要完整数据，只按实验子集拉取
+        full_refresh_ids = set()
+        queries = []
         for exp in experiments:
+            if store is None:
+                queries.append((exp.experiment_id, query.filter_string()))
+            elif full_refresh or store.needs_full_refresh(exp.experiment_id):
+                full_refresh_ids.add(exp.experiment_id)
+                queries.append((exp.experiment_id, ''))
+            else:
+                watermark = store.get_watermark(exp.experiment_id)[0]
+                queries.extend((exp.experiment_id, f) for f in changed_since_filters(watermark))
+        
+        max_runs = query.max_runs_per_experiment() if store is None else None
+        fetched = fetch_runs(
+            client, queries, max_workers=max_workers, max_retries=max_retries,
+            order_by=query.mlflow_order_by() if store is None else None,
+            max_runs=max_runs
+        )
+        # 有实验达到条数上限时，满足条件的总数只是下限
+        truncated = False
+        
+        for exp in experiments:
+            result = fetched.get(exp.experiment_id)
+            if result is None:
+                continue
+            if result['error'] is not None:
+                failed_experiments.append({
+                    'experiment_id': exp.experiment_id,
+                    'experiment_name': exp.name,
+                    'error': result['error']
+                })
+                continue
+            
+            if max_runs is not None and len(result['runs']) >= max_runs:
+                truncated = True
+            
             try:
-                # 获取实验的所有runs
-                runs = mlflow.search_runs(experiment_ids=[exp.experiment_id])
-                
-                if runs.empty:
-                    continue
-                
-                # 提取metrics列
-                metric_columns = [col for col in runs.columns if col.startswith('metrics.')]
-                param_columns = [col for col in runs.columns if col.startswith('params.')]
+                runs = _runs_to_frame(result['runs'])
+                records = [] if runs.empty else _runs_to_records(exp, runs)
+                fetched_count += len(records)
                 
-                # 处理每个run
-                for _, run in runs.iterrows():
-                    run_data = {
-                        'experiment_name': exp.name,
-                        'experiment_id': exp.experiment_id,
-                        'run_id': run['run_id'],
-                        'run_name': run.get('tags.mlflow.runName', 'N/A'),
-                        'status': run['status'],
-                        'start_time': run['start_time'].isoformat() if pd.notna(run['start_time']) else None,
-                        'end_time': run['end_time'].isoformat() if pd.notna(run['end_time']) else None,
-                        'duration': None,
-                        'metrics': {},
-                        'params': {},
-                        'tags': {}
-                    }
-                    
-                    # 计算训练时长
-                    if pd.notna(run['start_time']) and pd.notna(run['end_time']):
-                        duration = run['end_time'] - run['start_time']
-                        run_data['duration'] = str(duration)
-                    
-                    # 添加metrics
-                    for metric_col in metric_columns:
-                        metric_name = metric_col.replace('metrics.', '')
-                        metric_value = run[metric_col]
-                        if pd.notna(metric_value):
-                            run_data['metrics'][metric_name] = float(metric_value)
-                    
-                    # 添加params
-                    for param_col in param_columns:
-                        param_name = param_col.replace('params.', '')
-                        param_value = run[param_col]
-                        if pd.notna(param_value):
-                            run_data['params'][param_name] = str(param_value)
-                    
-                    # 添加tags
-                    tag_columns = [col for col in runs.columns if col.startswith('tags.')]
-                    for tag_col in tag_columns:
-                        tag_name = tag_col.replace('tags.', '')
-                        tag_value = run[tag_col]
-                        if pd.notna(tag_value):
-                            run_data['tags'][tag_name] = str(tag_value)
-                    
-                    training_history.append(run_data)
+                if store is None:
+                    training_history.extend(records)
+                else:
+                    store.save_runs(
+                        exp.experiment_id,
+                        records,
+                        _frame_watermark(runs) if not runs.empty else None,
+                        experiment_last_update=getattr(exp, 'last_update_time', None),
+                        full=exp.experiment_id in full_refresh_ids
+                    )
                     
             except Exception as e:
                 print(f"❌ 处理实验 {exp.name} 时出错: {str(e)}", file=sys.stderr)
+                failed_experiments.append({
+                    'experiment_id': exp.experiment_id,
+                    'experiment_name': exp.name,
+                    'error': str(e)
+                })
                 continue
         
-        # 按开始时间倒序排列
-        training_history.sort(key=lambda x: x['start_time'] or '', reverse=True)
+        if store is not None:
+            training_history = store.load_runs({exp.experiment_id: exp.name for exp in experiments})
+            print(f"🗄️ 本次从 MLflow 拉取 {fetched_count} 条变化记录，其余来自本地缓存", file=sys.stderr)
         
-        print(f"✅ 成功获取 {len(training_history)} 条训练记录", file=sys.stderr)
+        # 过滤、排序（默认按开始时间倒序）、分页，并只保留请求的字段
+        training_history, total = query.apply(training_history)
+        has_more = query.offset + len(training_history) < total
+        
+        print(f"✅ 成功获取 {len(training_history)} / {total} 条训练记录", file=sys.stderr)
+        if failed_experiments:
+            print(f"⚠️ {len(failed_experiments)} 个实验拉取失败，返回的是缓存数据或部分结果", file=sys.stderr)
         
         # 输出JSON格式的结果
         return {
             'success': True,
             'data': training_history,
-            'total': len(training_history)
+            'total': total,
+            'total_is_lower_bound': truncated,
+            'has_more': has_more,
+            'offset': query.offset,
+            'page_size': query.page_size,
+            'failed_experiments': failed_experiments
         }
         
     except Exception as e:
@@ -111,13 +285,33 @@ def get_training_history(tracking_uri=None):
             'error': error_msg,
             'data': []
         }
+    finally:
+        if owns_store and store is not None:
+            store.close()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fetch MLflow training history')
+    parser.add_argument('tracking_uri', nargs='?', default=None, help='MLflow tracking URI')
+    parser.add_argument('--store-path', default=None, help='本地缓存 SQLite 文件路径')
+    parser.add_argument('--full-refresh', action='store_true', help='忽略 watermark，全量刷新缓存')
+    parser.add_argument('--no-cache', action='store_true', help='不使用本地缓存，直接全量查询 MLflow')
+    parser.add_argument('--max-workers', type=int, default=DEFAULT_MAX_WORKERS, help='并发查询线程数')
+    parser.add_argument('--max-retries', type=int, default=DEFAULT_MAX_RETRIES, help='单次请求失败重试次数')
+    parser.add_argument('--query', default=None,
+                        help='JSON 格式的查询条件，例如 \'{"experiment_names": "exp-x", "page_size": 50}\'')
+    args = parser.parse_args()
+    
     # 从命令行参数获取tracking URI
-    tracking_uri = None
-    if len(sys.argv) > 1:
-        tracking_uri = sys.argv[1]
-        print(f"🔧 使用命令行参数指定的 MLflow URI: {tracking_uri}", file=sys.stderr)
+    if args.tracking_uri:
+        print(f"🔧 使用命令行参数指定的 MLflow URI: {args.tracking_uri}", file=sys.stderr)
     
-    result = get_training_history(tracking_uri)
+    result = get_training_history(
+        args.tracking_uri,
+        store_path=args.store_path,
+        full_refresh=args.full_refresh,
+        use_cache=not args.no_cache,
+        max_workers=args.max_workers,
+        max_retries=args.max_retries,
+        query=HistoryQuery.from_params(json.loads(args.query)) if args.query else None
+    )
     print(json.dumps(result, indent=2, ensure_ascii=False))
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Training History 查询条件：实验子集、状态、时间窗口、tag 条件、字段投影、排序和分页
+
+能由 MLflow 计算的条件（单个状态、开始时间窗口、tag 等值、排序）转换为 filter_string / order_by
+下推给 MLflow；其余条件以及走本地缓存时的全部条件在序列化之前本地执行。
+"""
+
+from datetime import datetime, timezone
+
+# 本地排序支持的顶层字段，其余需写成 metrics.xxx / params.xxx / tags.xxx
+_RECORD_SORT_FIELDS = {'start_time', 'end_time', 'run_name', 'status', 'experiment_name'}
+_MLFLOW_ATTRIBUTE_SORT_FIELDS = {'start_time', 'end_time', 'run_name', 'status'}
+
+
+def _as_list(value):
+    """兼容 list 和逗号分隔字符串两种传参方式"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, str):
+        return [v.strip() for v in value.split(',') if v.strip()]
+    return [str(v) for v in value]
+
+
+def _to_millis(value):
+    """把毫秒时间戳或 ISO 8601 字符串转换为毫秒时间戳"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)) or str(value).isdigit():
+        return int(value)
+    parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp() * 1000)
+
+
+def _quote(value):
+    return "'" + str(value).replace("'", "\\'") + "'"
+
+
+class HistoryQuery:
+    """一次 Training History 查询的全部条件"""
+
+    def __init__(self, experiment_ids=None, experiment_names=None, statuses=None,
+                 start_after=None, start_before=None, tags=None,
+                 metric_keys=None, param_keys=None, tag_keys=None,
+                 order_by=None, page_size=None, offset=0):
+        self.experiment_ids = _as_list(experiment_ids)
+        self.experiment_names = _as_list(experiment_names)
+        self.statuses = [s.upper() for s in _as_list(statuses) or []] or None
+        self.start_after = _to_millis(start_after)
+        self.start_before = _to_millis(start_before)
+        self.tags = dict(tags) if tags else None
+        self.metric_keys = _as_list(metric_keys)
+        self.param_keys = _as_list(param_keys)
+        self.tag_keys = _as_list(tag_keys)
+        self.order_by = order_by or 'start_time DESC'
+        self.page_size = int(page_size) if page_size not in (None, '') else None
+        self.offset = int(offset or 0)
+
+        self.sort_field, _, direction = self.order_by.strip().partition(' ')
+        self.sort_descending = direction.strip().upper() != 'ASC'
+
+    @classmethod
+    def from_params(cls, params):
+        """从 HTTP / RPC 参数构造，未识别的参数忽略"""
+        params = params or {}
+        return cls(
+            experiment_ids=params.get('experiment_ids'),
+            experiment_names=params.get('experiment_names'),
+            statuses=params.get('status'),
+            start_after=params.get('start_after'),
+            start_before=params.get('start_before'),
+            tags=params.get('tags'),
+            metric_keys=params.get('metric_keys'),
+            param_keys=params.get('param_keys'),
+            tag_keys=params.get('tag_keys'),
+            order_by=params.get('order_by'),
+            page_size=params.get('page_size'),
+            offset=params.get('offset'),
+        )
+
+    def select_experiments(self, experiments):
+        """只保留查询涉及的实验，未指定时返回全部"""
+        if not self.experiment_ids and not self.experiment_names:
+            return experiments
+        ids = set(self.experiment_ids or [])
+        names = set(self.experiment_names or [])
+        return [exp for exp in experiments if exp.experiment_id in ids or exp.name in names]
+
+    def filter_string(self):
+        """可下推给 MLflow 的过滤条件，多个条件以 AND 连接"""
+        clauses = []
+        if self.statuses and len(self.statuses) == 1:
+            clauses.append(f"attributes.status = {_quote(self.statuses[0])}")
+        if self.start_after is not None:
+            clauses.append(f"attributes.start_time >= {self.start_after}")
+        if self.start_before is not None:
+            clauses.append(f"attributes.start_time < {self.start_before}")
+        for key, value in (self.tags or {}).items():
+            clauses.append(f"tags.`{key}` = {_quote(value)}")
+        return ' AND '.join(clauses)
+
+    def mlflow_order_by(self):
+        """可下推给 MLflow 的排序条件；无法下推时返回 None"""
+        field = self.sort_field
+        if field in _MLFLOW_ATTRIBUTE_SORT_FIELDS:
+            field = f"attributes.{field}"
+        elif not field.startswith(('metrics.', 'params.', 'tags.')):
+            return None
+        return [f"{field} {'DESC' if self.sort_descending else 'ASC'}"]
+
+    def fully_pushed_down(self):
+        """全部过滤条件都已包含在 filter_string() 中（多个状态只能在本地过滤）"""
+        return not self.statuses or len(self.statuses) == 1
+
+    def max_runs_per_experiment(self):
+        """分页时单个实验最多需要的 run 数，多取一条用于判断是否还有下一页
+
+        只有排序和全部过滤条件都下推给 MLflow 时才能截断，否则本地过滤后会丢掉上限之外满足条件的 run。
+        """
+        if self.page_size is None or self.mlflow_order_by() is None or not self.fully_pushed_down():
+            return None
+        return self.offset + self.page_size + 1
+
+    def matches(self, record):
+        """在本地对单条记录执行全部过滤条件"""
+        if self.statuses and record.get('status') not in self.statuses:
+            return False
+        if self.start_after is not None or self.start_before is not None:
+            start = _to_millis(record.get('start_time'))
+            if start is None:
+                return False
+            if self.start_after is not None and start < self.start_after:
+                return False
+            if self.start_before is not None and start >= self.start_before:
+                return False
+        if self.tags:
+            record_tags = record.get('tags') or {}
+            if any(record_tags.get(k) != str(v) for k, v in self.tags.items()):
+                return False
+        return True
+
+    def _sort_value(self, record):
+        field = self.sort_field
+        if field in _RECORD_SORT_FIELDS:
+            return record.get(field)
+        group, _, key = field.partition('.')
+        return (record.get(group) or {}).get(key)
+
+    def project(self, record):
+        """只保留请求的 metrics / params / tags 键，未指定的分组保持原样"""
+        projected = dict(record)
+        for group, keys in (('metrics', self.metric_keys), ('params', self.param_keys), ('tags', self.tag_keys)):
+            if keys is not None:
+                values = record.get(group) or {}
+                projected[group] = {k: values[k] for k in keys if k in values}
+        return projected
+
+    def apply(self, records):
+        """过滤、排序、分页并投影，返回 (当前页记录, 满足条件的总数)"""
+        matched = [r for r in records if self.matches(r)]
+
+        # 缺失排序值的记录始终排在最后
+        present = [r for r in matched if self._sort_value(r) is not None]
+        missing = [r for r in matched if self._sort_value(r) is None]
+        present.sort(key=self._sort_value, reverse=self.sort_descending)
+        ordered = present + missing
+
+        end = None if self.page_size is None else self.offset + self.page_size
+        return [self.project(r) for r in ordered[self.offset:end]], len(matched)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Training History 本地增量缓存（SQLite）
+
+每个 tracking URI + experiment 记录一个 watermark（毫秒时间戳），
+后续刷新只向 MLflow 拉取 watermark 之后新建 / 结束的 run 以及仍在运行的 run，
+合并进本地库后直接从本地库返回结果。
+"""
+
+import os
+import json
+import time
+import sqlite3
+import threading
+
+DEFAULT_STORE_PATH = os.environ.get(
+    'TRAINING_HISTORY_STORE',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'temp', 'training_history.sqlite3')
+)
+
+# 与 watermark 比较时回退的时间窗口，避免刷新瞬间创建的 run 被漏掉（upsert 幂等，重叠无害）
+WATERMARK_OVERLAP_MS = 60 * 1000
+
+# 超过该时长强制做一次全量刷新，用于清理 MLflow 中已删除的 run
+FULL_REFRESH_INTERVAL_MS = 24 * 3600 * 1000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    tracking_uri TEXT NOT NULL,
+    run_id TEXT NOT NULL,
+    experiment_id TEXT NOT NULL,
+    start_time TEXT,
+    record TEXT NOT NULL,
+    PRIMARY KEY (tracking_uri, run_id)
+);
+CREATE INDEX IF NOT EXISTS idx_runs_experiment ON runs (tracking_uri, experiment_id);
+CREATE TABLE IF NOT EXISTS watermarks (
+    tracking_uri TEXT NOT NULL,
+    experiment_id TEXT NOT NULL,
+    watermark INTEGER,
+    experiment_last_update INTEGER,
+    full_synced_at INTEGER,
+    PRIMARY KEY (tracking_uri, experiment_id)
+);
+"""
+
+
+def changed_since_filters(watermark_ms):
+    """返回自 watermark 以来可能发生变化的 run 的 filter_string 列表
+
+    MLflow 的 search 语法不支持 OR，也不能按 run 的 last_update_time 过滤，
+    因此拆成三个查询：新建的 run、新结束的 run、仍在运行的 run。
+    """
+    since = max(int(watermark_ms) - WATERMARK_OVERLAP_MS, 0)
+    return [
+        f"attributes.start_time >= {since}",
+        f"attributes.end_time >= {since}",
+        "attributes.status = 'RUNNING'",
+    ]
+
+
+class HistoryStore:
+    """按 tracking URI 隔离的 run 记录缓存"""
+
+    def __init__(self, tracking_uri, path=None):
+        self.tracking_uri = tracking_uri
+        self.path = os.path.abspath(path or DEFAULT_STORE_PATH)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # 常驻进程中多个线程共享同一连接，用锁串行化访问
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(_SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def get_watermark(self, experiment_id):
+        """返回 (watermark, experiment_last_update, full_synced_at)，无记录时返回 None"""
+        with self._lock:
+            return self.conn.execute(
+                "SELECT watermark, experiment_last_update, full_synced_at FROM watermarks "
+                "WHERE tracking_uri = ? AND experiment_id = ?",
+                (self.tracking_uri, str(experiment_id))
+            ).fetchone()
+
+    def needs_full_refresh(self, experiment_id):
+        """没有 watermark 或距离上次全量刷新过久时需要全量拉取"""
+        row = self.get_watermark(experiment_id)
+        if row is None or row[0] is None or row[2] is None:
+            return True
+        return int(time.time() * 1000) - row[2] > FULL_REFRESH_INTERVAL_MS
+
+    def save_runs(self, experiment_id, records, watermark, experiment_last_update=None, full=False):
+        """合并 run 记录并推进 watermark；full=True 时先清空该实验的旧记录"""
+        experiment_id = str(experiment_id)
+        with self._lock:
+            self._save_runs(experiment_id, records, watermark, experiment_last_update, full)
+
+    def _save_runs(self, experiment_id, records, watermark, experiment_last_update, full):
+        previous = self.get_watermark(experiment_id)
+        full_synced_at = int(time.time() * 1000) if full else (previous[2] if previous else None)
+        if not full and previous and previous[0] is not None:
+            watermark = max(watermark or 0, previous[0])
+
+        with self.conn:
+            if full:
+                self.conn.execute(
+                    "DELETE FROM runs WHERE tracking_uri = ? AND experiment_id = ?",
+                    (self.tracking_uri, experiment_id)
+                )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO runs (tracking_uri, run_id, experiment_id, start_time, record) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [
+                    (self.tracking_uri, r['run_id'], experiment_id, r.get('start_time'),
+                     json.dumps(r, ensure_ascii=False))
+                    for r in records
+                ]
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO watermarks "
+                "(tracking_uri, experiment_id, watermark, experiment_last_update, full_synced_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (self.tracking_uri, experiment_id, watermark, experiment_last_update, full_synced_at)
+            )
+
+    def load_runs(self, experiment_names):
+        """读取指定实验的所有 run，按开始时间倒序；experiment_names 为 {experiment_id: name}"""
+        if not experiment_names:
+            return []
+        ids = [str(i) for i in experiment_names]
+        placeholders = ','.join('?' * len(ids))
+        with self._lock:
+            rows = self.conn.execute(
+                f"SELECT record FROM runs WHERE tracking_uri = ? AND experiment_id IN ({placeholders}) "
+                f"ORDER BY COALESCE(start_time, '') DESC",
+                [self.tracking_uri] + ids
+            ).fetchall()
+
+        records = []
+        for (record,) in rows:
+            run_data = json.loads(record)
+            # 实验可能被重命名，以当前名称为准
+            run_data['experiment_name'] = experiment_names.get(run_data['experiment_id'], run_data['experiment_name'])
+            records.append(run_data)
+        return records
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+本地 file-store MLflow 替身，用于离线测试 / benchmark
+
+Usage:
+    # 生成 3 个实验、每个 50 个 run 的本地 tracking store，并打印 tracking URI
+    python local_mlflow_standin.py --root /tmp/mlflow-standin --experiments 3 --runs 50
+
+    # 额外启动 mlflow_worker.py，对替身发送 ping / test_connection / history 请求并打印耗时
+    python local_mlflow_standin.py --root /tmp/mlflow-standin --smoke
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import subprocess
+
+from mlflow.entities import Metric, Param
+from mlflow.tracking import MlflowClient
+
+
+def populate_standin(root, experiments=3, runs_per_experiment=50, metrics=10, params=10,
+                     steps=1, seed=0, experiment_prefix='standin'):
+    """在 root 下创建 file-store tracking 数据，返回 tracking URI"""
+    os.makedirs(root, exist_ok=True)
+    tracking_uri = 'file://' + os.path.abspath(root)
+    client = MlflowClient(tracking_uri=tracking_uri)
+    rng = random.Random(seed)
+    now_ms = int(time.time() * 1000)
+
+    for e in range(experiments):
+        name = f"{experiment_prefix}-{e}"
+        experiment = client.get_experiment_by_name(name)
+        experiment_id = experiment.experiment_id if experiment else client.create_experiment(name)
+
+        for r in range(runs_per_experiment):
+            start_ms = now_ms - rng.randint(60_000, 30 * 24 * 3600 * 1000)
+            run = client.create_run(
+                experiment_id,
+                start_time=start_ms,
+                tags={'mlflow.runName': f"{name}-run-{r}", 'model': rng.choice(['gpt2', 'qwen3-0.6b'])},
+            )
+            run_id = run.info.run_id
+            client.log_batch(run_id, params=[Param(f"param_{p}", str(rng.randint(0, 100))) for p in range(params)])
+            batch = [
+                Metric(f"metric_{m}", rng.random(), start_ms + step * 1000, step)
+                for m in range(metrics) for step in range(steps)
+            ]
+            for i in range(0, len(batch), 1000):
+                client.log_batch(run_id, metrics=batch[i:i + 1000])
+            client.set_terminated(run_id, status='FINISHED', end_time=start_ms + rng.randint(60_000, 3_600_000))
+
+    return tracking_uri
+
+
+def smoke_test(root, tracking_uri):
+    """启动常驻 worker，对替身依次发送请求并打印每个请求的往返耗时"""
+    # 缓存写到替身目录，不污染 ui-panel/temp 下的正式缓存
+    env = dict(os.environ, TRAINING_HISTORY_STORE=os.path.join(os.path.abspath(root), 'training_history.sqlite3'))
+    worker = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mlflow_worker.py')],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, bufsize=1, env=env,
+    )
+    requests = [
+        ('ping', {}),
+        ('test_connection', {'tracking_uri': tracking_uri}),
+        ('history', {'tracking_uri': tracking_uri, 'full_refresh': True}),
+        ('history', {'tracking_uri': tracking_uri}),
+        ('history', {'tracking_uri': tracking_uri}),
+    ]
+    ok = True
+    for request_id, (method, params) in enumerate(requests, start=1):
+        start = time.perf_counter()
+        worker.stdin.write(json.dumps({'id': request_id, 'method': method, 'params': params}) + '\n')
+        worker.stdin.flush()
+        response = json.loads(worker.stdout.readline())
+        elapsed = (time.perf_counter() - start) * 1000
+        result = response.get('result') or {}
+        ok = ok and 'error' not in response and result.get('success', True)
+        summary = result.get('total', result.get('experiments_count', response.get('error', '')))
+        print(f"{method:16s} {elapsed:8.1f} ms  {summary}")
+
+    worker.stdin.close()
+    worker.wait(timeout=30)
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create a local file-store MLflow stand-in')
+    parser.add_argument('--root', default='/tmp/mlflow-standin')
+    parser.add_argument('--experiments', type=int, default=3)
+    parser.add_argument('--runs', type=int, default=50, help='每个实验的 run 数')
+    parser.add_argument('--metrics', type=int, default=10)
+    parser.add_argument('--params', type=int, default=10)
+    parser.add_argument('--steps', type=int, default=1, help='每个 metric 记录的 step 数')
+    parser.add_argument('--smoke', action='store_true', help='生成数据后对 mlflow_worker.py 做一次冒烟测试')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    tracking_uri = populate_standin(args.root, args.experiments, args.runs, args.metrics, args.params, args.steps)
+    print(f"✅ 本地 MLflow 替身已就绪 ({time.perf_counter() - start:.1f}s): {tracking_uri}", file=sys.stderr)
+    print(tracking_uri)
+
+    if args.smoke and not smoke_test(args.root, tracking_uri):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+批量获取 metric 时间序列并在服务端降采样，用于 Training History / Monitor 面板的曲线
+
+一次请求包含多个 (run_id, metric) 组合：
+- 每个 run 先 get_run 一次得到 last_update_time（开始/结束时间和最新 metric 时间戳的最大值）；
+- 本地缓存中 last_update_time 未变化的序列直接复用，其余并发调用 get_metric_history；
+- 长序列用 LTTB 或 min/max 分桶降采样到目标点数后返回。
+
+Usage:
+    python metric_series.py <tracking_uri> --run-ids id1,id2 --metrics train_loss,learning_rate --points 1000
+"""
+
+import os
+import sys
+import json
+import sqlite3
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from mlflow.tracking import MlflowClient
+
+from history_store import DEFAULT_STORE_PATH
+from run_fetcher import call_with_retry, latest_metrics, DEFAULT_MAX_WORKERS, DEFAULT_MAX_RETRIES
+
+DEFAULT_TARGET_POINTS = 1000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS metric_series (
+    tracking_uri TEXT NOT NULL,
+    run_id TEXT NOT NULL,
+    metric_key TEXT NOT NULL,
+    last_update_time INTEGER NOT NULL,
+    steps BLOB NOT NULL,
+    timestamps BLOB NOT NULL,
+    metric_values BLOB NOT NULL,
+    PRIMARY KEY (tracking_uri, run_id, metric_key)
+);
+"""
+
+
+def lttb_indices(x, y, n_out):
+    """Largest-Triangle-Three-Buckets 降采样，返回保留点的下标"""
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    # 首尾点固定保留，中间 n_out - 2 个桶覆盖 [1, n-1)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    edges[-1] = n - 1
+    indices = np.empty(n_out, dtype=np.int64)
+    indices[0], indices[-1] = 0, n - 1
+
+    selected = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_x = x[edges[i + 1]:edges[i + 2]].mean()
+            next_y = y[edges[i + 1]:edges[i + 2]].mean()
+        else:
+            next_x, next_y = x[n - 1], y[n - 1]
+
+        # 与上一个选中点、下一个桶均值构成的三角形面积最大的点
+        area = np.abs(
+            (x[selected] - next_x) * (y[start:end] - y[selected])
+            - (x[selected] - x[start:end]) * (next_y - y[selected])
+        )
+        selected = start + int(np.argmax(area))
+        indices[i + 1] = selected
+
+    return indices
+
+
+def minmax_indices(y, n_out):
+    """按桶保留最小值和最大值，返回排序后的下标（保留尖峰，适合 loss 抖动观察）"""
+    n = len(y)
+    if n_out >= n or n_out < 2:
+        return np.arange(n)
+
+    n_buckets = max(n_out // 2, 1)
+    buckets = np.arange(n) * n_buckets // n
+    # 先按桶、再按值排序：每个桶的第一个是最小值，最后一个是最大值
+    order = np.lexsort((y, buckets))
+    sorted_buckets = buckets[order]
+    firsts = np.flatnonzero(np.r_[True, sorted_buckets[1:] != sorted_buckets[:-1]])
+    lasts = np.r_[firsts[1:] - 1, n - 1]
+    return np.unique(np.concatenate([order[firsts], order[lasts]]))
+
+
+def downsample(steps, timestamps, values, target_points=DEFAULT_TARGET_POINTS, method='lttb'):
+    """去掉非有限值后按 method 降采样，返回三个等长数组"""
+    finite = np.isfinite(values)
+    steps, timestamps, values = steps[finite], timestamps[finite], values[finite]
+    if target_points is None or len(values) <= target_points:
+        return steps, timestamps, values
+
+    if method == 'minmax':
+        keep = minmax_indices(values, target_points)
+    else:
+        keep = lttb_indices(steps.astype(np.float64), values, target_points)
+    return steps[keep], timestamps[keep], values[keep]
+
+
+class MetricSeriesCache:
+    """按 (tracking URI, run, metric) 缓存完整序列，last_update_time 变化时失效"""
+
+    def __init__(self, tracking_uri, path=None):
+        self.tracking_uri = tracking_uri
+        self.path = os.path.abspath(path or DEFAULT_STORE_PATH)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(_SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def get(self, run_id, metric_key, last_update_time):
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT steps, timestamps, metric_values FROM metric_series "
+                "WHERE tracking_uri = ? AND run_id = ? AND metric_key = ? AND last_update_time = ?",
+                (self.tracking_uri, run_id, metric_key, last_update_time)
+            ).fetchone()
+        if row is None:
+            return None
+        return (np.frombuffer(row[0], dtype=np.int64),
+                np.frombuffer(row[1], dtype=np.int64),
+                np.frombuffer(row[2], dtype=np.float64))
+
+    def put(self, run_id, metric_key, last_update_time, steps, timestamps, values):
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO metric_series "
+                "(tracking_uri, run_id, metric_key, last_update_time, steps, timestamps, metric_values) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self.tracking_uri, run_id, metric_key, last_update_time,
+                 steps.tobytes(), timestamps.tobytes(), values.tobytes())
+            )
+
+
+def _run_last_update_time(run):
+    """run 的最近更新时间：开始 / 结束时间与最新 metric 时间戳中的最大值"""
+    latest = max(run.info.start_time or 0, run.info.end_time or 0)
+    for metric in latest_metrics(run):
+        latest = max(latest, metric.timestamp or 0)
+    return latest
+
+
+def _fetch_history(client, run_id, metric_key, max_retries):
+    history = call_with_retry(lambda: client.get_metric_history(run_id, metric_key), max_retries=max_retries)
+    history = sorted(history, key=lambda m: (m.step, m.timestamp))
+    return (np.fromiter((m.step for m in history), dtype=np.int64, count=len(history)),
+            np.fromiter((m.timestamp for m in history), dtype=np.int64, count=len(history)),
+            np.fromiter((m.value for m in history), dtype=np.float64, count=len(history)))
+
+
+def get_metric_series(client, pairs, target_points=DEFAULT_TARGET_POINTS, method='lttb',
+                      cache=None, max_workers=DEFAULT_MAX_WORKERS, max_retries=DEFAULT_MAX_RETRIES):
+    """获取多个 (run_id, metric) 的降采样序列
+
+    返回 {'success': True, 'series': [...], 'failed': [...]}，单个组合失败不影响其它组合。
+    """
+    pairs = list(dict.fromkeys((str(run_id), str(metric)) for run_id, metric in pairs))
+    run_ids = list(dict.fromkeys(run_id for run_id, _ in pairs))
+    failed = []
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        # 每个 run 只调用一次 get_run 得到缓存版本号
+        run_futures = {run_id: pool.submit(call_with_retry, lambda r=run_id: client.get_run(r), max_retries)
+                       for run_id in run_ids}
+        versions = {}
+        for run_id, future in run_futures.items():
+            try:
+                versions[run_id] = _run_last_update_time(future.result())
+            except Exception as e:
+                failed.append({'run_id': run_id, 'metric': None, 'error': str(e)})
+
+        raw = {}
+        cache_hits = 0
+        history_futures = {}
+        for run_id, metric_key in pairs:
+            if run_id not in versions:
+                continue
+            cached = cache.get(run_id, metric_key, versions[run_id]) if cache is not None else None
+            if cached is not None:
+                raw[(run_id, metric_key)] = cached
+                cache_hits += 1
+            else:
+                history_futures[(run_id, metric_key)] = pool.submit(
+                    _fetch_history, client, run_id, metric_key, max_retries)
+
+        for (run_id, metric_key), future in history_futures.items():
+            try:
+                raw[(run_id, metric_key)] = future.result()
+                if cache is not None:
+                    cache.put(run_id, metric_key, versions[run_id], *raw[(run_id, metric_key)])
+            except Exception as e:
+                failed.append({'run_id': run_id, 'metric': metric_key, 'error': str(e)})
+
+    print(f"📈 获取 {len(raw)} 条序列，其中 {cache_hits} 条来自缓存", file=sys.stderr)
+
+    series = []
+    for run_id, metric_key in pairs:
+        if (run_id, metric_key) not in raw:
+            continue
+        steps, timestamps, values = raw[(run_id, metric_key)]
+        ds_steps, ds_timestamps, ds_values = downsample(steps, timestamps, values, target_points, method)
+        series.append({
+            'run_id': run_id,
+            'metric': metric_key,
+            'total_points': int(len(values)),
+            'steps': ds_steps.tolist(),
+            'timestamps': ds_timestamps.tolist(),
+            'values': ds_values.tolist(),
+        })
+
+    return {'success': True, 'series': series, 'failed': failed}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fetch downsampled MLflow metric histories')
+    parser.add_argument('tracking_uri', help='MLflow tracking URI')
+    parser.add_argument('--run-ids', required=True, help='逗号分隔的 run ID')
+    parser.add_argument('--metrics', required=True, help='逗号分隔的 metric 名称')
+    parser.add_argument('--points', type=int, default=DEFAULT_TARGET_POINTS, help='每条曲线的目标点数')
+    parser.add_argument('--method', choices=['lttb', 'minmax'], default='lttb')
+    parser.add_argument('--no-cache', action='store_true')
+    args = parser.parse_args()
+
+    run_ids = [r for r in args.run_ids.split(',') if r]
+    metrics = [m for m in args.metrics.split(',') if m]
+    cache = None if args.no_cache else MetricSeriesCache(args.tracking_uri)
+    try:
+        result = get_metric_series(
+            MlflowClient(tracking_uri=args.tracking_uri),
+            [(r, m) for r in run_ids for m in metrics],
+            target_points=args.points,
+            method=args.method,
+            cache=cache,
+        )
+    except Exception as e:
+        result = {'success': False, 'error': str(e), 'series': []}
+    finally:
+        if cache is not None:
+            cache.close()
+    print(json.dumps(result, ensure_ascii=False))
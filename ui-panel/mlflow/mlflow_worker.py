@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+常驻 MLflow 查询进程（JSON-RPC over stdin/stdout）
+
+Node 服务端启动一次本进程，之后通过标准输入逐行发送请求：
+    {"id": 1, "method": "history", "params": {"tracking_uri": "..."}}
+每个请求在标准输出返回一行：
+    {"id": 1, "result": {...}}  或  {"id": 1, "error": "..."}
+
+mlflow / pandas 的导入、每个 tracking URI 的 MlflowClient 和本地缓存都在进程内复用，
+请求只需付出实际的查询开销。日志统一写到 stderr，stdout 只用于协议。
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import threading
+import traceback
+import multiprocessing
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
+
+from mlflow.tracking import MlflowClient
+
+from get_training_history import get_training_history
+from history_query import HistoryQuery
+from history_store import HistoryStore
+from metric_series import get_metric_series, MetricSeriesCache, DEFAULT_TARGET_POINTS
+from run_fetcher import search_all_experiments
+
+# 协议输出使用启动时的 stdout，其它 print 一律改到 stderr，避免污染协议
+_protocol_out = sys.stdout
+sys.stdout = sys.stderr
+_write_lock = threading.Lock()
+
+_clients = {}
+_stores = {}
+_series_caches = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(tracking_uri):
+    """返回 tracking URI 对应的常驻 MlflowClient 和 HistoryStore"""
+    with _clients_lock:
+        if tracking_uri not in _clients:
+            print(f"🔧 创建 MLflow client: {tracking_uri}", file=sys.stderr)
+            _clients[tracking_uri] = MlflowClient(tracking_uri=tracking_uri)
+            _stores[tracking_uri] = HistoryStore(tracking_uri)
+            _series_caches[tracking_uri] = MetricSeriesCache(tracking_uri)
+        return _clients[tracking_uri], _stores[tracking_uri]
+
+
+def handle_ping(params):
+    return {'pong': True, 'pid': os.getpid(), 'clients': sorted(_clients)}
+
+
+def handle_history(params):
+    tracking_uri = params.get('tracking_uri')
+    client, store = get_client(tracking_uri)
+    return get_training_history(
+        tracking_uri,
+        full_refresh=bool(params.get('full_refresh', False)),
+        client=client,
+        store=store,
+        query=HistoryQuery.from_params(params.get('query')),
+    )
+
+
+def handle_metric_series(params):
+    tracking_uri = params.get('tracking_uri')
+    client, _ = get_client(tracking_uri)
+    pairs = [(p['run_id'], p['metric']) for p in params.get('pairs') or []]
+    # 也支持 run_ids × metrics 的笛卡尔积写法
+    pairs += [(r, m) for r in params.get('run_ids') or [] for m in params.get('metrics') or []]
+    return get_metric_series(
+        client,
+        pairs,
+        target_points=int(params.get('target_points') or DEFAULT_TARGET_POINTS),
+        method=params.get('method') or 'lttb',
+        cache=_series_caches[tracking_uri],
+    )
+
+
+def handle_test_connection(params):
+    tracking_uri = params.get('tracking_uri')
+    try:
+        client, _ = get_client(tracking_uri)
+        # 尝试获取实验列表来测试连接
+        experiments = search_all_experiments(client, max_retries=0)
+        return {
+            'success': True,
+            'experiments_count': len(experiments),
+            'message': f"Successfully connected to MLflow. Found {len(experiments)} experiments."
+        }
+    except Exception as e:
+        return {'success': False, 'error': str(e)}
+
+
+def _sync_child(conn, config, experiment_identifier):
+    """在独立子进程中执行同步，assume role 修改的环境变量不会影响常驻进程"""
+    # 子进程继承了协议所用的 stdout，输出一律改到 stderr
+    os.dup2(sys.stderr.fileno(), 1)
+    output = io.StringIO()
+    success = True
+    try:
+        import cross_account_sync
+        with redirect_stdout(output):
+            if config.get('cross_account_role_arn'):
+                print("Assuming cross-account role for permissions (auto-refreshed before expiry)...")
+                cross_account_sync.RoleCredentials(config['cross_account_role_arn']).start_auto_refresh()
+            else:
+                print("No cross-account role specified, using current credentials")
+            cross_account_sync.sync_experiment(config, experiment_identifier)
+    except Exception as e:
+        success = False
+        output.write(f"❌ Error: {e}\n{traceback.format_exc()}")
+    sys.stderr.write(output.getvalue())
+    conn.send({'success': success, 'output': output.getvalue()})
+    conn.close()
+
+
+def handle_sync(params):
+    config = params['config']
+    experiment_identifier = params['experiment_name']
+    # 常驻进程有线程池、SQLite 连接和 HTTP 连接池，fork 可能复制到被其它线程持有的锁而死锁，
+    # 因此用 spawn 启动全新的解释器（多付出一次导入开销，同步请求很少）
+    ctx = multiprocessing.get_context('spawn')
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_sync_child, args=(child_conn, config, experiment_identifier))
+    process.start()
+    child_conn.close()
+    try:
+        result = parent_conn.recv()
+    except EOFError:
+        result = {'success': False, 'output': ''}
+    process.join()
+    result['exit_code'] = process.exitcode
+    return result
+
+
+HANDLERS = {
+    'ping': handle_ping,
+    'history': handle_history,
+    'metric_series': handle_metric_series,
+    'test_connection': handle_test_connection,
+    'sync': handle_sync,
+}
+
+
+def _respond(message):
+    line = json.dumps(message, ensure_ascii=False)
+    with _write_lock:
+        _protocol_out.write(line + '\n')
+        _protocol_out.flush()
+
+
+def _dispatch(request):
+    request_id = request.get('id')
+    method = request.get('method')
+    start = time.perf_counter()
+    try:
+        handler = HANDLERS.get(method)
+        if handler is None:
+            raise ValueError(f"Unknown method: {method}")
+        result = handler(request.get('params') or {})
+        _respond({'id': request_id, 'result': result})
+    except Exception as e:
+        print(f"❌ 处理请求 {method} 失败: {traceback.format_exc()}", file=sys.stderr)
+        _respond({'id': request_id, 'error': str(e)})
+    finally:
+        print(f"⏱️ {method} 耗时 {(time.perf_counter() - start) * 1000:.1f} ms", file=sys.stderr)
+
+
+def main():
+    max_workers = int(os.environ.get('MLFLOW_WORKER_THREADS', '4'))
+    print(f"🚀 MLflow worker 已启动 (pid={os.getpid()}, threads={max_workers})", file=sys.stderr)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for line in sys.stdin:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line)
+            except json.JSONDecodeError as e:
+                _respond({'id': None, 'error': f"Invalid JSON request: {e}"})
+                continue
+            pool.submit(_dispatch, request)
+
+    print("👋 stdin 已关闭，MLflow worker 退出", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
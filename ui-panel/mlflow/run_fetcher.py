@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+并发、分页拉取 MLflow runs
+
+每个 (experiment, filter_string) 作为一个任务，在有界线程池中通过 page_token 翻页，
+单次请求失败按指数退避重试，最终按实验汇总 runs 和失败信息。
+"""
+
+import sys
+import time
+import random
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_PAGE_SIZE = 1000
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF_SECONDS = 0.5
+
+
+def call_with_retry(fn, max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF_SECONDS):
+    """调用 fn()，失败时按指数退避（带抖动）重试，超过次数后抛出最后一次异常"""
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except Exception:
+            if attempt >= max_retries:
+                raise
+            time.sleep(backoff * (2 ** attempt) * (1 + random.random()))
+            attempt += 1
+
+
+def latest_metrics(run):
+    """run 中每个 metric 的最新一条记录（Metric，含 step / timestamp）
+
+    RunData.metrics 只有值，完整记录通过公开的 to_proto() 取得；
+    不支持时退回 metrics，step / timestamp 记为 0。
+    """
+    from mlflow.entities import Metric
+    try:
+        return [Metric.from_proto(m) for m in run.data.to_proto().metrics]
+    except (AttributeError, NotImplementedError):
+        return [Metric(key, value, 0, 0) for key, value in run.data.metrics.items()]
+
+
+def search_all_experiments(client, page_size=DEFAULT_PAGE_SIZE,
+                           max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF_SECONDS):
+    """翻页拉取 tracking server 上的全部（活跃）实验"""
+    experiments = []
+    page_token = None
+    while True:
+        page = call_with_retry(
+            lambda: client.search_experiments(max_results=page_size, page_token=page_token),
+            max_retries=max_retries,
+            backoff=backoff,
+        )
+        experiments.extend(page)
+        page_token = page.token
+        if not page_token:
+            return experiments
+
+
+def search_all_runs(client, experiment_id, filter_string='', page_size=DEFAULT_PAGE_SIZE,
+                    max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF_SECONDS, order_by=None,
+                    max_runs=None):
+    """翻页拉取单个实验中满足 filter_string 的 runs，max_runs 不为空时取够即停"""
+    runs = []
+    page_token = None
+    while True:
+        limit = page_size if max_runs is None else min(page_size, max_runs - len(runs))
+        page = call_with_retry(
+            lambda: client.search_runs(
+                experiment_ids=[experiment_id],
+                filter_string=filter_string,
+                max_results=limit,
+                order_by=order_by,
+                page_token=page_token,
+            ),
+            max_retries=max_retries,
+            backoff=backoff,
+        )
+        runs.extend(page)
+        page_token = page.token
+        if not page_token or (max_runs is not None and len(runs) >= max_runs):
+            return runs
+
+
+def fetch_runs(client, queries, max_workers=DEFAULT_MAX_WORKERS, page_size=DEFAULT_PAGE_SIZE,
+               max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF_SECONDS, order_by=None, max_runs=None):
+    """并发执行多个 (experiment_id, filter_string) 查询
+
+    order_by / max_runs 原样下推给每个查询，用于"按某字段排序取前 N 条"的场景。
+    返回 {experiment_id: {'runs': [Run, ...], 'error': str 或 None}}，
+    同一实验的多个查询结果按 run_id 去重；任一查询失败则该实验记为失败，其它实验不受影响。
+    """
+    results = {str(exp_id): {'runs': {}, 'error': None} for exp_id, _ in queries}
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        futures = {
+            pool.submit(search_all_runs, client, exp_id, filter_string, page_size, max_retries, backoff,
+                        order_by, max_runs): str(exp_id)
+            for exp_id, filter_string in queries
+        }
+        for future in as_completed(futures):
+            exp_id = futures[future]
+            try:
+                for run in future.result():
+                    results[exp_id]['runs'][run.info.run_id] = run
+            except Exception as e:
+                print(f"❌ 拉取实验 {exp_id} 的 runs 失败: {str(e)}", file=sys.stderr)
+                results[exp_id]['error'] = str(e)
+
+    return {
+        exp_id: {'runs': list(result['runs'].values()) if result['error'] is None else [], 'error': result['error']}
+        for exp_id, result in results.items()
+    }
@@ -2275,6 +2275,10 @@ app.delete('/api/training-jobs/:jobName', async (req, res) => {
 
 // MLflow配置管理
 
+// 常驻MLflow查询进程，training history / 连接测试 / 同步共用
+const MlflowWorker = require('./utils/mlflowWorker');
+const mlflowWorker = new MlflowWorker();
+
 const CONFIG_FILE = path.join(__dirname, '../config/mlflow-metric-config.json');
 
 // 确保配置目录存在
@@ -2380,104 +2384,14 @@ app.post('/api/mlflow-metric-config/test', async (req, res) => {
 
     console.log(`Testing MLflow connection to: ${tracking_uri}`);
     
-    const { spawn } = require('child_process');
-    
-    // 创建测试脚本
-    const testScript = `#!/usr/bin/env python3
-import mlflow
-import sys
-import json
-
-try:
-    tracking_uri = "${tracking_uri}"
-    mlflow.set_tracking_uri(tracking_uri)
-    
-    # 尝试获取实验列表来测试连接
-    experiments = mlflow.search_experiments()
-    
-    result = {
-        "success": True,
-        "experiments_count": len(experiments),
-        "message": f"Successfully connected to MLflow. Found {len(experiments)} experiments."
-    }
-    
-    print(json.dumps(result))
-    sys.exit(0)
-    
-except Exception as e:
-    result = {
-        "success": False,
-        "error": str(e)
-    }
-    print(json.dumps(result))
-    sys.exit(1)
-`;
-    
-    const tempScriptPath = path.join(__dirname, '../temp/test_mlflow_connection.py');
-    
-    // 确保temp目录存在
-    const tempDir = path.dirname(tempScriptPath);
-    if (!fs.existsSync(tempDir)) {
-      fs.mkdirSync(tempDir, { recursive: true });
+    // 由常驻MLflow worker执行连接测试
+    const result = await mlflowWorker.call('test_connection', { tracking_uri });
+    if (result.success) {
+      res.json(result);
+    } else {
+      res.status(400).json(result);
     }
     
-    fs.writeFileSync(tempScriptPath, testScript);
-    
-    const pythonPath = 'python3'; // 使用系统Python
-    const pythonProcess = spawn(pythonPath, [tempScriptPath], {
-      cwd: __dirname,
-      env: { ...process.env }
-    });
-    
-    let stdout = '';
-    let stderr = '';
-    
-    pythonProcess.stdout.on('data', (data) => {
-      stdout += data.toString();
-    });
-    
-    pythonProcess.stderr.on('data', (data) => {
-      stderr += data.toString();
-    });
-    
-    pythonProcess.on('close', (code) => {
-      // 清理临时文件
-      try {
-        fs.unlinkSync(tempScriptPath);
-      } catch (e) {
-        console.warn('Failed to cleanup temp file:', e);
-      }
-      
-      if (stderr) {
-        console.log('Python test script stderr:', stderr);
-      }
-      
-      try {
-        const result = JSON.parse(stdout);
-        if (result.success) {
-          res.json(result);
-        } else {
-          res.status(400).json(result);
-        }
-      } catch (parseError) {
-        console.error('Failed to parse test result:', parseError);
-        console.error('Raw output:', stdout);
-        res.status(500).json({
-          success: false,
-          error: 'Failed to test MLflow connection',
-          details: stdout || stderr
-        });
-      }
-    });
-    
-    pythonProcess.on('error', (error) => {
-      console.error('Failed to start Python test script:', error);
-      res.status(500).json({
-        success: false,
-        error: `Failed to start test script: ${error.message}`
-      });
-    });
-    
   } catch (error) {
     console.error('MLflow connection test error:', error);
     res.status(500).json({
@@ -2555,90 +2469,34 @@ app.post('/api/mlflow-sync', async (req, res) => {
       });
     }
 
-    // 2. 创建临时配置文件供Python脚本使用
-    const tempConfigPath = path.join(__dirname, '../temp/sync-config-temp.json');
-    
-    // 确保temp目录存在
-    const tempDir = path.dirname(tempConfigPath);
-    if (!fs.existsSync(tempDir)) {
-      fs.mkdirSync(tempDir, { recursive: true });
-    }
-    
-    fs.writeFileSync(tempConfigPath, JSON.stringify(configObj, null, 2));
-
-    // 3. 调用Python同步脚本
-    const { spawn } = require('child_process');
-    const pythonPath = 'python3'; // 使用系统Python
-    const syncScriptPath = path.join(__dirname, '../mlflow/cross_account_sync.py');
-    
-    const pythonProcess = spawn(pythonPath, [
-      syncScriptPath,
-      '--config-file', tempConfigPath,
-      '--experiment-name', experimentIdentifier
-    ], {
-      cwd: __dirname,
-      env: { ...process.env }
-    });
-    
-    let stdout = '';
-    let stderr = '';
-    
-    pythonProcess.stdout.on('data', (data) => {
-      stdout += data.toString();
-    });
-    
-    pythonProcess.stderr.on('data', (data) => {
-      stderr += data.toString();
-    });
-    
-    pythonProcess.on('close', (code) => {
-      // 清理临时配置文件
-      try {
-        fs.unlinkSync(tempConfigPath);
-      } catch (e) {
-        console.warn('Failed to cleanup temp config file:', e);
-      }
-      
-      if (code === 0) {
-        console.log('MLflow sync completed successfully');
-        console.log('Sync output:', stdout);
-        
-        res.json({
-          success: true,
-          message: 'Successfully synced experiment to shared MLflow server',
-          output: stdout,
-          experiment_id: experimentIdentifier,
-          contributor: configObj.contributor_name
-        });
-      } else {
-        console.error('MLflow sync failed with code:', code);
-        console.error('Sync stderr:', stderr);
-        console.error('Sync stdout:', stdout);
-        
-        res.status(500).json({
-          success: false,
-          error: 'MLflow sync failed',
-          details: stderr || stdout,
-          exit_code: code
-        });
-      }
-    });
+    // 2. 由常驻MLflow worker执行同步（worker以spawn方式启动独立子进程，assume role不影响其它请求）
+    const result = await mlflowWorker.call('sync', {
+      config: configObj,
+      experiment_name: experimentIdentifier
+    }, 2 * 60 * 60 * 1000);
     
-    pythonProcess.on('error', (error) => {
-      console.error('Failed to start MLflow sync script:', error);
+    if (result.success) {
+      console.log('MLflow sync completed successfully');
+      console.log('Sync output:', result.output);
       
-      // 清理临时配置文件
-      try {
-        fs.unlinkSync(tempConfigPath);
-      } catch (e) {
-        console.warn('Failed to cleanup temp config file:', e);
-      }
+      res.json({
+        success: true,
+        message: 'Successfully synced experiment to shared MLflow server',
+        output: result.output,
+        experiment_id: experimentIdentifier,
+        contributor: configObj.contributor_name
+      });
+    } else {
+      console.error('MLflow sync failed with code:', result.exit_code);
+      console.error('Sync output:', result.output);
       
       res.status(500).json({
         success: false,
-        error: `Failed to start sync script: ${error.message}`
+        error: 'MLflow sync failed',
+        details: result.output,
+        exit_code: result.exit_code
       });
-    });
+    }
     
   } catch (error) {
     console.error('MLflow sync API error:', error);
@@ -2700,78 +2558,81 @@ app.get('/api/training-history', async (req, res) => {
     const mlflowConfig = readMlflowConfig();
     console.log('Using MLflow URI:', mlflowConfig.tracking_uri);
     
-    const { spawn } = require('child_process');
-    const path = require('path');
-    
-    // 使用系统Python执行脚本，传递配置参数
-    const pythonPath = 'python3'; // 使用系统Python
-    const scriptPath = path.join(__dirname, '../mlflow/get_training_history.py');
-    
-    const pythonProcess = spawn(pythonPath, [scriptPath, mlflowConfig.tracking_uri], {
-      cwd: __dirname,
-      env: { ...process.env }
+    // 查询条件：实验子集、状态、时间窗口、tag条件、字段投影、排序和分页（均为可选）
+    // 例如 /api/training-history?experiment_names=exp-x&page_size=50&metric_keys=train_loss
+    const query = {};
+    const queryKeys = [
+      'experiment_ids', 'experiment_names', 'status', 'start_after', 'start_before',
+      'metric_keys', 'param_keys', 'tag_keys', 'order_by', 'page_size', 'offset'
+    ];
+    queryKeys.forEach(key => {
+      if (req.query[key] !== undefined && req.query[key] !== '') {
+        query[key] = req.query[key];
+      }
     });
+    if (req.query.tags) {
+      try {
+        query.tags = JSON.parse(req.query.tags);
+      } catch (e) {
+        return res.status(400).json({
+          success: false,
+          error: 'tags must be a JSON object, e.g. {"model":"gpt2"}'
+        });
+      }
+    }
     
-    let stdout = '';
-    let stderr = '';
-    
-    pythonProcess.stdout.on('data', (data) => {
-      stdout += data.toString();
+    // 由常驻MLflow worker查询（复用已导入的mlflow和已建立的client）
+    const result = await mlflowWorker.call('history', {
+      tracking_uri: mlflowConfig.tracking_uri,
+      full_refresh: req.query.full_refresh === 'true',
+      query
     });
     
-    pythonProcess.stderr.on('data', (data) => {
-      stderr += data.toString();
-    });
+    if (!result.success) {
+      console.error('Failed to fetch training history:', result.error);
+      return res.status(500).json(result);
+    }
     
-    let responseHandled = false;
+    console.log(`Training history fetched: ${result.data.length} of ${result.total} records`);
+    res.json(result);
     
-    pythonProcess.on('close', (code) => {
-      if (responseHandled) return;
-      
-      if (stderr) {
-        console.log('Python script stderr:', stderr);
-      }
-      
-      if (code !== 0) {
-        console.error(`Python script exited with code ${code}`);
-        responseHandled = true;
-        return res.status(500).json({ 
-          success: false, 
-          error: `Failed to fetch training history: exit code ${code}`,
-          stderr: stderr
-        });
-      }
-      
-      try {
-        const result = JSON.parse(stdout);
-        console.log(`Training history fetched: ${result.total} records`);
-        responseHandled = true;
-        res.json(result);
-      } catch (parseError) {
-        console.error('Failed to parse Python script output:', parseError);
-        console.error('Raw output:', stdout);
-        responseHandled = true;
-        res.status(500).json({ 
-          success: false, 
-          error: 'Failed to parse training history data',
-          raw_output: stdout
-        });
-      }
+  } catch (error) {
+    console.error('Training history fetch error:', error);
+    res.status(500).json({ 
+      success: false, 
+      error: error.message 
     });
+  }
+});
+
+// 批量获取metric时间序列（服务端降采样），用于loss / throughput曲线
+// body: { pairs: [{ run_id, metric }], 或 run_ids: [], metrics: [], target_points: 1000, method: 'lttb' | 'minmax' }
+app.post('/api/training-history/metrics', async (req, res) => {
+  try {
+    const { pairs = [], run_ids = [], metrics = [], target_points = 1000, method = 'lttb' } = req.body;
     
-    pythonProcess.on('error', (error) => {
-      if (responseHandled) return;
-      
-      console.error('Failed to start Python script:', error);
-      responseHandled = true;
-      res.status(500).json({ 
-        success: false, 
-        error: `Failed to start Python script: ${error.message}`
+    if (pairs.length === 0 && (run_ids.length === 0 || metrics.length === 0)) {
+      return res.status(400).json({
+        success: false,
+        error: 'pairs or run_ids + metrics are required'
       });
+    }
+    
+    const mlflowConfig = readMlflowConfig();
+    const result = await mlflowWorker.call('metric_series', {
+      tracking_uri: mlflowConfig.tracking_uri,
+      pairs,
+      run_ids,
+      metrics,
+      target_points,
+      method
     });
     
+    console.log(`Metric series fetched: ${result.series.length} series, ${result.failed.length} failed`);
+    res.json(result);
+    
   } catch (error) {
-    console.error('Training history fetch error:', error);
+    console.error('Metric series fetch error:', error);
     res.status(500).json({ 
       success: false, 
       error: error.message 
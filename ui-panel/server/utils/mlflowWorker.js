@@ -0,0 +1,136 @@
+const { spawn } = require('child_process');
+const path = require('path');
+const readline = require('readline');
+
+// 常驻 Python MLflow 查询进程的客户端（JSON-RPC over stdin/stdout）
+// 进程在第一次调用时启动，异常退出后在下一次调用时自动重启
+class MlflowWorker {
+  constructor(options = {}) {
+    this.pythonPath = options.pythonPath || 'python3'; // 使用系统Python
+    this.scriptPath = options.scriptPath || path.join(__dirname, '../../mlflow/mlflow_worker.py');
+    this.defaultTimeoutMs = options.timeoutMs || 5 * 60 * 1000;
+    this.stopTimeoutMs = options.stopTimeoutMs || 5000;
+    this.process = null;
+    this.pending = new Map();
+    this.nextId = 1;
+  }
+
+  // 启动worker进程
+  start() {
+    if (this.process) {
+      return this.process;
+    }
+
+    console.log(`Starting MLflow worker: ${this.scriptPath}`);
+    const workerProcess = spawn(this.pythonPath, [this.scriptPath], {
+      cwd: path.dirname(this.scriptPath),
+      env: { ...process.env, PYTHONUNBUFFERED: '1' }
+    });
+
+    readline.createInterface({ input: workerProcess.stdout }).on('line', (line) => {
+      this.handleResponse(line);
+    });
+
+    workerProcess.stderr.on('data', (data) => {
+      process.stdout.write(`[mlflow-worker] ${data.toString()}`);
+    });
+
+    workerProcess.on('exit', (code, signal) => {
+      console.warn(`MLflow worker exited (code=${code}, signal=${signal})`);
+      this.reset(workerProcess, new Error(`MLflow worker exited with code ${code}`));
+    });
+
+    workerProcess.on('error', (error) => {
+      console.error('Failed to start MLflow worker:', error);
+      this.reset(workerProcess, error);
+    });
+
+    // worker已退出时写入stdin会触发EPIPE，没有监听会导致Node进程崩溃
+    workerProcess.stdin.on('error', (error) => {
+      console.error('MLflow worker stdin error:', error);
+      this.reset(workerProcess, error);
+      workerProcess.kill();
+    });
+
+    this.process = workerProcess;
+    return workerProcess;
+  }
+
+  // 处理worker返回的一行JSON
+  handleResponse(line) {
+    let response;
+    try {
+      response = JSON.parse(line);
+    } catch (error) {
+      console.error('Failed to parse MLflow worker output:', line);
+      return;
+    }
+
+    const entry = this.pending.get(response.id);
+    if (!entry) {
+      return;
+    }
+    this.pending.delete(response.id);
+    clearTimeout(entry.timer);
+
+    if (response.error !== undefined) {
+      entry.reject(new Error(response.error));
+    } else {
+      entry.resolve(response.result);
+    }
+  }
+
+  // 丢弃出错的worker进程（下一次调用时重启），拒绝所有未完成的调用；已被stop()或替换的旧进程忽略
+  reset(workerProcess, error) {
+    if (this.process !== workerProcess) {
+      return;
+    }
+    this.process = null;
+    this.rejectAll(error);
+  }
+
+  rejectAll(error) {
+    for (const entry of this.pending.values()) {
+      clearTimeout(entry.timer);
+      entry.reject(error);
+    }
+    this.pending.clear();
+  }
+
+  // 调用worker方法，返回Promise
+  call(method, params = {}, timeoutMs = this.defaultTimeoutMs) {
+    const workerProcess = this.start();
+    const id = this.nextId++;
+
+    return new Promise((resolve, reject) => {
+      const timer = setTimeout(() => {
+        this.pending.delete(id);
+        reject(new Error(`MLflow worker call ${method} timed out after ${timeoutMs}ms`));
+      }, timeoutMs);
+
+      this.pending.set(id, { resolve, reject, timer });
+      workerProcess.stdin.write(JSON.stringify({ id, method, params }) + '\n');
+    });
+  }
+
+  // 关闭stdin让worker正常退出，超时仍未退出则强制kill
+  stop(timeoutMs = this.stopTimeoutMs) {
+    const workerProcess = this.process;
+    if (!workerProcess) {
+      return;
+    }
+    this.process = null;
+    this.rejectAll(new Error('MLflow worker stopped'));
+    const timer = setTimeout(() => {
+      if (workerProcess.exitCode === null && workerProcess.signalCode === null) {
+        console.warn(`MLflow worker did not exit within ${timeoutMs}ms, killing it`);
+        workerProcess.kill('SIGKILL');
+      }
+    }, timeoutMs);
+    timer.unref();
+    workerProcess.once('exit', () => clearTimeout(timer));
+    workerProcess.stdin.end();
+  }
+}
+
+module.exports = MlflowWorker;